@@ -43,11 +43,11 @@ DATABASES["default"]["ATOMIC_REQUESTS"] = True
 # CACHES
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#caches
+# Shared by every worker process, see fta.samples.caching. Instances that don't
+# share a filesystem need a cache server, e.g. memcache://127.0.0.1:11211 or
+# rediscache://127.0.0.1:6379/1 (with django-redis installed).
 CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "",
-    }
+    "default": env.cache("DJANGO_CACHE_URL", default="filecache:///tmp/fta-cache")
 }
 
 # URLS
@@ -274,3 +274,45 @@ CORS_URLS_REGEX = r"^/api/.*$"
 # Your stuff...
 # ------------------------------------------------------------------------------
 DATA_UPLOAD_MAX_MEMORY_SIZE = 250000000
+# Where Sample.frozen_page bodies live: "database" keeps them inline in the row,
+# "blob" writes them once to a content-addressed store keyed by SHA-256.
+FROZEN_PAGE_STORAGE = env("DJANGO_FROZEN_PAGE_STORAGE", default="database")
+# Storage class for the blob store, defaults to DEFAULT_FILE_STORAGE.
+FROZEN_PAGE_BLOB_STORAGE = env("DJANGO_FROZEN_PAGE_BLOB_STORAGE", default=None)
+FROZEN_PAGE_BLOB_LOCATION = "blobs/sha256"
+# Engine for the fathom <-> labeled sample conversions in fta.samples.utils:
+# "beautifulsoup" builds a full tree, "streaming" tokenizes the page once and
+# only rewrites the start tags that change.
+FATHOM_CONVERSION_ENGINE = env(
+    "DJANGO_FATHOM_CONVERSION_ENGINE", default="beautifulsoup"
+)
+# How much of an uploaded page (in characters) is read looking for the freezer's
+# metadata before falling back to scanning the whole page.
+FROZEN_METADATA_SNIFF_LIMIT = 64 * 1024
+# Processes parsing frozen page metadata and near duplicate signatures for
+# batch uploads, 0 parses inline. The pool is forked from the web worker
+# handling the upload, only turn it on where that is known to be safe.
+SAMPLE_INGEST_WORKERS = env.int("DJANGO_SAMPLE_INGEST_WORKERS", default=0)
+# Compression of the frozen and modified page columns: "zlib", "zstd" (needs
+# the zstandard package) or "none". Existing rows are read whatever they use.
+PAGE_COMPRESSION = env("DJANGO_PAGE_COMPRESSION", default="zlib")
+# Id of a CompressionDictionary (see train_page_dictionary) for new pages.
+PAGE_COMPRESSION_DICTIONARY = env.int("DJANGO_PAGE_COMPRESSION_DICTIONARY", default=0)
+# Folder in the media storage for the precomputed API sample responses.
+SAMPLE_RESPONSE_CACHE_LOCATION = "responses/samples"
+# Estimated share of page text two samples need in common to be clustered as
+# near duplicates, see fta.samples.similarity.
+NEAR_DUPLICATE_THRESHOLD = env.float("DJANGO_NEAR_DUPLICATE_THRESHOLD", default=0.8)
+# What decides the split of an exported sample: "sample", "domain" (a site is
+# only ever in one split) or "cluster" (near duplicates stay together).
+EXPORT_SPLIT_GROUP = env("DJANGO_EXPORT_SPLIT_GROUP", default="domain")
+# Processes converting labeled samples for exports (0 converts inline).
+EXPORT_WORKERS = env.int("DJANGO_EXPORT_WORKERS", default=2)
+# Convert labeled samples for fathom in the background when their labels are
+# saved, so exports only copy the result (see fta.samples.artifacts).
+FATHOM_ARTIFACTS_ON_SAVE = env.bool("DJANGO_FATHOM_ARTIFACTS_ON_SAVE", default=True)
+# Size in bytes packed exports start a new pack at.
+EXPORT_PACK_SIZE = env.int("DJANGO_EXPORT_PACK_SIZE", default=256 * 1024 * 1024)
+# Seconds the cached label lists and sample counts are kept, see
+# fta.samples.caching. Writes invalidate them before that.
+SAMPLE_CACHE_TIMEOUT = env.int("DJANGO_SAMPLE_CACHE_TIMEOUT", default=600)
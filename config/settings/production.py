@@ -36,6 +36,14 @@ else:
     DATABASES["default"]["HOST"] = "127.0.0.1"
     DATABASES["default"]["PORT"] = "5454"
 
+# CACHES
+# ------------------------------------------------------------------------------
+# https://docs.djangoproject.com/en/dev/ref/settings/#caches
+# Required: instances don't share a filesystem, and cached reads are only
+# invalidated for every worker if they all use the same cache server (see
+# fta.samples.caching), e.g. memcache://10.0.0.3:11211.
+CACHES = {"default": env.cache("DJANGO_CACHE_URL")}
+
 
 # SECURITY
 # ------------------------------------------------------------------------------
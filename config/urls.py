@@ -18,6 +18,11 @@ urlpatterns = [
     path("add_sample", sample_views.UploadSampleView.as_view(), name="add_sample"),
     path("samples", sample_views.SampleListView.as_view(), name="list_samples"),
     path("label/<int:sample>", sample_views.SampleLabelView.as_view(), name="label"),
+    path(
+        "label/<int:sample>/document",
+        sample_views.SampleDocumentView.as_view(),
+        name="label_document",
+    ),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 # API URLS
@@ -4,3 +4,14 @@ import pytest
 @pytest.fixture(autouse=True)
 def media_storage(settings, tmpdir):
     settings.MEDIA_ROOT = tmpdir.strpath
+
+
+@pytest.fixture(autouse=True)
+def shared_cache(settings, tmpdir):
+    # A file based cache like the default one, empty for every test.
+    settings.CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": tmpdir.join("cache").strpath,
+        }
+    }
@@ -1,20 +1,15 @@
-from datetime import datetime
-from uuid import uuid4
-
 from django.conf import settings
 from django.contrib import admin, messages
-from django.core.files.base import ContentFile
-from django.core.files.storage import get_storage_class
+from django.db.models import F
 from django.template.defaultfilters import truncatechars
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 
-from .models import Label, LabeledElement, LabeledSample, Sample
-from .utils import (
-    convert_labeled_sample_to_fathom_sample,
-    get_splits_from_queryset,
-    humansize,
-)
+from .caching import label_counts, label_ids
+from .exports import describe_diff, enqueue_export
+from .models import ExportJob, Label, LabeledElement, LabeledSample, Sample
+from .utils import humansize
 
 
 @admin.register(Label)
@@ -27,6 +22,25 @@ class LabeledElementAdmin(admin.ModelAdmin):
     list_display = ("id", "labeled_sample", "label", "data_fta_id")
 
 
+class NearDuplicateListFilter(admin.SimpleListFilter):
+    title = "near duplicates"
+    parameter_name = "cluster"
+
+    def lookups(self, request, model_admin):
+        # A single cluster is picked from the "Near duplicates" column.
+        return (("any", "In a cluster"),)
+
+    def queryset(self, request, queryset):
+        val = self.used_parameters.get("cluster")
+        if val == "any":
+            return queryset.exclude(signature__cluster=None).order_by(
+                "signature__cluster", "pk"
+            )
+        if val and val.isdigit():
+            return queryset.filter(signature__cluster=val)
+        return queryset
+
+
 @admin.register(Sample)
 class SampleAdmin(admin.ModelAdmin):
     list_display = (
@@ -35,7 +49,31 @@ class SampleAdmin(admin.ModelAdmin):
         "truncated_url",
         "freeze_time",
         "freeze_software",
+        "near_duplicates",
     )
+    list_filter = (NearDuplicateListFilter,)
+
+    def get_queryset(self, request):
+        # The change form loads the page when it needs it.
+        return (
+            super()
+            .get_queryset(request)
+            .slim()
+            .annotate(cluster=F("signature__cluster"))
+        )
+
+    def get_exclude(self, request, obj=None):
+        # The page can't change once saved, don't send it back and forth.
+        return ("frozen_page",) if obj else ()
+
+    def get_readonly_fields(self, request, obj=None):
+        return ("url", "freeze_time", "freeze_software") if obj else ()
+
+    # Search - url, domain and notes, through Sample.search_vector
+    search_fields = ["url"]
+
+    def get_search_results(self, request, queryset, search_term):
+        return queryset.search(search_term), False
 
     def pretty_page_size(self, obj):
         return humansize(obj.page_size)
@@ -49,6 +87,14 @@ class SampleAdmin(admin.ModelAdmin):
     truncated_url.short_description = "Url"
     truncated_url.admin_order_field = "url"
 
+    def near_duplicates(self, obj):
+        if obj.cluster is None:
+            return "-"
+        return format_html('<a href="?cluster={}">{}</a>', obj.cluster, obj.cluster)
+
+    near_duplicates.short_description = "Near duplicates"
+    near_duplicates.admin_order_field = "cluster"
+
 
 class PageSizeListFilter(admin.SimpleListFilter):
     title = "page size"
@@ -72,15 +118,19 @@ class LabelListFilter(admin.SimpleListFilter):
     parameter_name = "label"
 
     def lookups(self, request, model_admin):
-        labels = LabeledElement.objects.distinct("label").values_list(
-            "label__slug", flat=True
-        )
-        return [(slug, slug) for slug in labels]
+        # Labels currently in use, counted from the summary rows (and cached)
+        # rather than a distinct over every labeled element.
+        return [(slug, f"{slug} ({count})") for slug, count in label_counts()]
 
     def queryset(self, request, queryset):
         val = self.used_parameters.get("label")
         if val:
-            queryset = queryset.filter(labeled_elements__label__slug=val)
+            label_id = label_ids().get(val)
+            if label_id is None:
+                return queryset.none()
+            queryset = queryset.filter(
+                original_sample__label_summary__label_ids__contains=[label_id]
+            )
         return queryset
 
 
@@ -91,45 +141,86 @@ class LabeledSampleAdmin(admin.ModelAdmin):
     # Currently not a modifiable field, do not expose.
     exclude = ["superseded_by"]
 
+    def get_queryset(self, request):
+        # Label stats come from the sample's SampleLabelSummary rather than the
+        # count/prefetch of LabeledSample.objects. list_select_related joins in
+        # the sample, leave both pages behind.
+        queryset = (
+            LabeledSample._base_manager.filter(superseded_by=None)
+            .defer("modified_sample", "original_sample__frozen_page")
+            .annotate(
+                nlabels=F("original_sample__label_summary__nlabels"),
+                label_slugs=F("original_sample__label_summary__label_slugs"),
+            )
+        )
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
     # Search - only filters labels
     search_fields = ["labeled_elements__label__slug"]
 
     def get_search_results(self, request, queryset, search_term):
         # See: https://docs.djangoproject.com/en/3.1/ref/contrib/admin/#django.contrib.admin.ModelAdmin.get_search_results # noqa
-        use_distinct = True
+        use_distinct = False
         if search_term:
             slug_fields = [x.strip() for x in search_term.split(",")]
-            queryset = queryset.filter(labeled_elements__label__slug__in=slug_fields)
+            queryset = queryset.filter(
+                original_sample__label_summary__label_slugs__overlap=slug_fields
+            )
         return queryset, use_distinct
 
     # Export actions
     actions = [
         "export_labeled_samples",
+        "export_labeled_samples_without_duplicates",
+        "export_labeled_samples_packed",
     ]
 
-    def export_labeled_samples(self, request, queryset):
-        storage_class = get_storage_class()
-        storage = storage_class()
-        folder = f"{datetime.now():%Y-%m-%d}-{str(uuid4())[0:6]}"
-        split_dict = get_splits_from_queryset(qs=queryset, train_pct=0.6, test_pct=0.2)
-        for split_type, sample_set in split_dict.items():
-            for sample in sample_set:
-                processed_sample, suffix = convert_labeled_sample_to_fathom_sample(
-                    sample
-                )
-                storage.save(
-                    name=f"{folder}/{split_type}/{sample.pk}{suffix}",
-                    content=ContentFile(processed_sample),
-                )
-
+    def export_labeled_samples(
+        self, request, queryset, skip_duplicates=False, format="files"
+    ):
+        # The export itself runs in the run_export_jobs worker.
+        job = enqueue_export(
+            queryset,
+            train_pct=0.6,
+            test_pct=0.2,
+            skip_duplicates=skip_duplicates,
+            format=format,
+        )
+        job_url = reverse("admin:samples_exportjob_change", args=[job.pk])
         self.message_user(
             request,
-            f"Samples were exported to {settings.MEDIA_URL}/{folder}",
+            format_html(
+                "<a href='{}'>Export job {}</a> was queued for {} samples ({}). They "
+                "will be exported to {}/{}",
+                job_url,
+                job.pk,
+                job.total,
+                describe_diff(job.diff) if job.base else "no earlier export",
+                settings.MEDIA_URL,
+                job.folder,
+            ),
             messages.SUCCESS,
         )
 
     export_labeled_samples.short_description = "Export selected samples as fathom set"
 
+    def export_labeled_samples_without_duplicates(self, request, queryset):
+        self.export_labeled_samples(request, queryset, skip_duplicates=True)
+
+    export_labeled_samples_without_duplicates.short_description = (
+        "Export selected samples as fathom set, skipping near duplicates"
+    )
+
+    def export_labeled_samples_packed(self, request, queryset):
+        self.export_labeled_samples(request, queryset, format="packed")
+
+    export_labeled_samples_packed.short_description = (
+        "Export selected samples as packed fathom set"
+    )
+
     # Filters
     list_filter = (
         "original_sample__freeze_software",
@@ -169,9 +260,7 @@ class LabeledSampleAdmin(admin.ModelAdmin):
     nlabels.short_description = "N labels"
 
     def labels(self, obj):
-        return ", ".join(
-            obj.labeled_elements.all().values_list("label__slug", flat=True)
-        )
+        return ", ".join(obj.label_slugs or [])
 
     def page_size(self, obj):
         return humansize(obj.original_sample.page_size)
@@ -188,3 +277,61 @@ class LabeledSampleAdmin(admin.ModelAdmin):
 
     def freeze_software(self, obj):
         return obj.original_sample.freeze_software
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "folder",
+        "status",
+        "progress",
+        "throughput",
+        "changes",
+        "created",
+        "finished",
+    )
+    list_filter = ("status",)
+    readonly_fields = (
+        "folder",
+        "location",
+        "format",
+        "status",
+        "progress",
+        "throughput",
+        "base",
+        "changes",
+        "error",
+        "created",
+        "started",
+        "finished",
+        "updated",
+    )
+    exclude = ("total", "processed", "diff")
+    actions = ["retry_export_jobs"]
+
+    def has_add_permission(self, request):
+        # Jobs are created by the export action on labeled samples.
+        return False
+
+    def progress(self, obj):
+        percent = 100 * obj.processed / obj.total if obj.total else 100
+        return f"{obj.processed}/{obj.total} ({percent:.0f}%)"
+
+    def throughput(self, obj):
+        if not obj.started or not obj.processed:
+            return "-"
+        elapsed = ((obj.finished or timezone.now()) - obj.started).total_seconds()
+        return f"{obj.processed / max(elapsed, 1):.1f} samples/s"
+
+    def changes(self, obj):
+        return describe_diff(obj.diff)
+
+    changes.short_description = "Changes since base"
+
+    def retry_export_jobs(self, request, queryset):
+        # Done samples are kept, the worker carries on with the rest.
+        n = queryset.filter(status="failed").update(status="queued", error=None)
+        self.message_user(request, f"{n} export jobs were re-queued.", messages.SUCCESS)
+
+    retry_export_jobs.short_description = "Retry failed export jobs"
@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import brotli
+except ImportError:  # Optional, only gzip is offered without it
+    brotli = None
+
+from .serializers import SampleListSerializer, SampleSerializer
+
+
+def _compressors():
+    # In order of preference.
+    if brotli is not None:
+        yield "br", lambda body: brotli.compress(body, quality=9)
+    yield "gzip", lambda body: gzip.compress(body, compresslevel=9)
+    yield "identity", lambda body: body
+
+
+def sample_etag(sample):
+    # Everything but the page, plus the page's digest. Doesn't need the page
+    # loaded unless it predates frozen_page_sha256.
+    fields = SampleListSerializer(sample).data
+    if not fields.get("frozen_page_sha256"):
+        fields["frozen_page"] = hashlib.sha256(
+            sample.frozen_page.encode("utf-8")
+        ).hexdigest()
+    digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8"))
+    return f'"{digest.hexdigest()}"'
+
+
+def unquote_etag(etag):
+    return etag.strip('"')
+
+
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                pass
+        accepted[name.strip().lower()] = quality
+    for encoding, compressor in _compressors():
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding, compressor
+    return "identity", lambda body: body
+
+
+class SampleResponseVariants:
+    """
+    Compressed SampleSerializer bodies, kept in the media storage by sample
+    and ETag. Samples barely change, so each variant is built once and then
+    served as is. Uncompressed bodies are rendered on every request instead,
+    they would be a second full copy of the page. Variants of an older ETag
+    are removed when a new one is written, and all of a sample's when it is
+    deleted (see remove_response_variants). Samples deleted behind Django's
+    back leave their folder under SAMPLE_RESPONSE_CACHE_LOCATION, which can
+    be deleted at any time: it is only a cache.
+    """
+
+    def __init__(self, storage=None, location=None):
+        self.storage = storage or get_storage_class()()
+        self.location = location or settings.SAMPLE_RESPONSE_CACHE_LOCATION
+
+    def name(self, sample_pk, etag, encoding):
+        return f"{self.location}/{sample_pk}/{unquote_etag(etag)}.{encoding}"
+
+    def get(self, sample, etag, encoding, compressor):
+        if encoding == "identity":
+            return JSONRenderer().render(SampleSerializer(sample).data)
+        name = self.name(sample.pk, etag, encoding)
+        if self.storage.exists(name):
+            with self.storage.open(name, "rb") as f:
+                return f.read()
+        body = compressor(JSONRenderer().render(SampleSerializer(sample).data))
+        self.remove_stale(sample.pk, etag)
+        self.storage.save(name=name, content=ContentFile(body))
+        return body
+
+    def remove_stale(self, sample_pk, etag=None):
+        # Every variant of the sample but those of `etag`.
+        folder = f"{self.location}/{sample_pk}"
+        try:
+            _, files = self.storage.listdir(folder)
+        except FileNotFoundError:
+            return
+        for file in files:
+            if etag is None or not file.startswith(unquote_etag(etag)):
+                self.storage.delete(f"{folder}/{file}")
@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+
+class SampleCursorPagination(CursorPagination):
+    # Keyset pagination: every page is an indexed range scan from the cursor,
+    # however deep into the corpus it is. Order with ?ordering=freeze_time,
+    # -freeze_time, id or -id.
+    ordering = "-id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
@@ -3,13 +3,36 @@ from rest_framework import serializers
 from ..models import Sample
 
 
+class SparseFieldsetMixin:
+    """Only renders the fields named in a comma separated ?fields= parameter."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get("request"))
+        if fields is None:
+            return
+        unknown = fields.difference(self.fields)
+        if unknown:
+            raise serializers.ValidationError(
+                {"fields": f"Unknown fields: {', '.join(sorted(unknown))}"}
+            )
+        for name in set(self.fields).difference(fields):
+            self.fields.pop(name)
+
+
+def requested_fields(request):
+    if request is None or not request.query_params.get("fields"):
+        return None
+    return {name.strip() for name in request.query_params["fields"].split(",")}
+
+
 class SampleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Sample
-        exclude = []
+        exclude = ["search_vector"]
 
 
-class SampleListSerializer(serializers.ModelSerializer):
+class SampleListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Sample
-        exclude = ["frozen_page"]
+        exclude = ["frozen_page", "search_vector"]
@@ -1,11 +1,22 @@
-from rest_framework import mixins, viewsets
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http import HttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags
+from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter
 from rest_framework.response import Response
 
-from ..models import Label, LabeledElement, LabeledSample, Sample
+from ..artifacts import schedule_fathom_artifact
+from ..caching import bump_generation, label_ids
+from ..ingest import ingest_samples, multipart_items, ndjson_items
+from ..models import LabeledSample, Sample, SampleSignature
 from ..utils import convert_fathom_sample_to_labeled_sample
 from ..views import sample_from_required
-from .serializers import SampleListSerializer, SampleSerializer
+from .caching import SampleResponseVariants, choose_encoding, sample_etag
+from .pagination import SampleCursorPagination
+from .serializers import SampleListSerializer, SampleSerializer, requested_fields
 
 
 class SampleViewSet(
@@ -16,6 +27,10 @@ class SampleViewSet(
 ):
     serializer_class = SampleSerializer
     queryset = Sample.objects.all()
+    pagination_class = SampleCursorPagination
+    filter_backends = [OrderingFilter]
+    ordering_fields = ["id", "freeze_time"]
+    ordering = "-id"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -25,6 +40,86 @@ class SampleViewSet(
             "retrieve": SampleSerializer,
         }
 
+    def get_queryset(self):
+        # The list serializer leaves out the page, so don't fetch it either.
+        # retrieve() only reads it when it has no cached response to send.
+        queryset = Sample.objects.slim()
+        if self.action not in ("list", "domains"):
+            return queryset
+        params = self.request.query_params
+        # Each filter is backed by an index, see Sample.Meta and
+        # SampleLabelSummary.
+        if params.get("freeze_software"):
+            queryset = queryset.filter(freeze_software=params["freeze_software"])
+        if params.get("domain"):
+            queryset = queryset.filter(domain=params["domain"])
+        queryset = queryset.search(params.get("q", ""))
+        if params.get("label"):
+            label_id = label_ids().get(params["label"])
+            if label_id is None:
+                return queryset.none()
+            queryset = queryset.filter(label_summary__label_ids__contains=[label_id])
+        for param, lookup in [
+            ("freeze_time_after", "freeze_time__gte"),
+            ("freeze_time_before", "freeze_time__lt"),
+        ]:
+            if params.get(param):
+                value = parse_datetime(params[param]) or parse_date(params[param])
+                if value is None:
+                    raise ValidationError({param: "Expected an ISO 8601 date or time."})
+                queryset = queryset.filter(**{lookup: value})
+        fields = requested_fields(self.request)
+        if fields is not None:
+            # Ordering fields are needed to build the cursor. Unknown names are
+            # left for the serializer to reject.
+            columns = {field.attname for field in Sample._meta.concrete_fields}
+            queryset = queryset.only("id", "freeze_time", *fields & columns)
+        return queryset
+
+    @action(detail=False)
+    def domains(self, request):
+        # Facet counts for the samples the same filters would list.
+        return Response(list(self.get_queryset().domain_facets()))
+
+    @action(detail=False)
+    def duplicates(self, request):
+        # Near duplicate clusters, a page at a time: ?after=<last cluster seen>.
+        clusters = SampleSignature.objects.clusters()
+        try:
+            after = int(request.query_params.get("after", 0))
+            limit = min(int(request.query_params.get("limit", 100)), 1000)
+        except ValueError:
+            raise ValidationError("after and limit must be integers.")
+        return Response(list(clusters.filter(cluster__gt=after)[:limit]))
+
+    def retrieve(self, request, *args, **kwargs):
+        sample = self.get_object()
+        etag = sample_etag(sample)
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            # Samples can only change their notes, but always check.
+            "Cache-Control": "private, no-cache",
+        }
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and (
+            if_none_match.strip() == "*" or etag in parse_etags(if_none_match)
+        ):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if request.accepted_renderer.format != "json":
+            # The browsable API, rendered as usual.
+            return Response(self.get_serializer(sample).data, headers=headers)
+        encoding, compressor = choose_encoding(
+            request.headers.get("Accept-Encoding", "")
+        )
+        body = SampleResponseVariants().get(sample, etag, encoding, compressor)
+        response = HttpResponse(body, content_type="application/json")
+        for header, value in headers.items():
+            response[header] = value
+        if encoding != "identity":
+            response["Content-Encoding"] = encoding
+        return response
+
     def get_serializer_class(self, *args, **kwargs):
         """Instantiate the list of serializers per action from class attribute (must be defined)."""
         kwargs["partial"] = True
@@ -37,6 +132,13 @@ class SampleViewSet(
 class AddSampleViewSet(viewsets.ViewSet):
     basename = "add_sample"
 
+    def initialize_request(self, request, *args, **kwargs):
+        drf_request = super().initialize_request(request, *args, **kwargs)
+        if self.action == "add_samples":
+            # Spool uploaded pages to disk however small, a batch can hold many.
+            request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return drf_request
+
     @action(detail=False, methods=["post"])
     def add_sample(self, request, format=None):
         frozen_page = request.data["frozen_page"]
@@ -46,6 +148,21 @@ class AddSampleViewSet(viewsets.ViewSet):
         sample.save()
         return Response({"id": sample.id})
 
+    @action(detail=False, methods=["post"])
+    def add_samples(self, request, format=None):
+        # Either newline delimited JSON, one sample per line, or multipart with
+        # any number of frozen_page files sharing freeze_software and notes.
+        # The body is streamed instead of going through request.data.
+        if request.content_type.startswith("multipart/form-data"):
+            items = multipart_items(
+                request.FILES.getlist("frozen_page"),
+                request.POST.get("freeze_software", ""),
+                request.POST.get("notes", ""),
+            )
+        else:
+            items = ndjson_items(request.stream or [])
+        return Response({"samples": ingest_samples(items)})
+
 
 class AddLabeledSampleViewSet(viewsets.ViewSet):
     basename = "add_labeled_sample"
@@ -79,23 +196,19 @@ class AddLabeledSampleViewSet(viewsets.ViewSet):
         fta_sample, fta_ids_to_label = convert_fathom_sample_to_labeled_sample(
             labeled_page
         )
-        labeled_sample, _ = LabeledSample.objects.get_or_create(
-            original_sample=sample, modified_sample=fta_sample
-        )
+        labeled_sample = LabeledSample(original_sample=sample)
+        labeled_sample.set_modified_sample(fta_sample)
+        labeled_sample.save()
 
         # 4. If the sample did exist then update the superseded_by fields
         if existing_labeled_sample:
             LabeledSample.objects.filter(id=labeled_sample_id).update(
                 superseded_by=labeled_sample.id
             )
+            bump_generation("samples.labeledsample")
 
         # 5. Create LabeledElements
-        for fta_id, fathom_label in fta_ids_to_label.items():
-            stored_label, created = Label.objects.get_or_create(slug=fathom_label)
-            LabeledElement.objects.get_or_create(
-                labeled_sample=labeled_sample,
-                data_fta_id=fta_id,
-                label=stored_label,
-            )
+        labeled_sample.set_labels(fta_ids_to_label)
+        schedule_fathom_artifact(labeled_sample)
 
         return Response({"id": sample.id})
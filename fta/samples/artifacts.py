@@ -0,0 +1,121 @@
+"""
+Fathom artifacts: labeled samples converted for fathom ahead of export.
+
+An artifact is rebuilt in the background whenever labels are saved, and is
+current while its version matches LabeledSample.version (which the database
+bumps on every change to the page or its labels). Exports copy current
+artifacts and only convert the rest.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from .blobs import ContentAddressedStore, sha256_hexdigest
+from .models import FathomArtifact, LabeledSample, Sample
+from .utils import convert_page_to_fathom_sample
+
+UPSERT_ARTIFACT = """
+INSERT INTO samples_fathomartifact (labeled_sample_id, version, suffix, sha256, updated)
+VALUES (%s, %s, %s, %s, now())
+ON CONFLICT (labeled_sample_id) DO UPDATE
+SET version = EXCLUDED.version, suffix = EXCLUDED.suffix,
+    sha256 = EXCLUDED.sha256, updated = EXCLUDED.updated
+WHERE samples_fathomartifact.version < EXCLUDED.version
+"""
+
+# Held while a blob is stored and referenced, or checked and deleted, so a
+# blob is never deleted from under an artifact that is being saved.
+LOCK_BLOB = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+
+_executor = None
+
+
+def stale_labeled_samples():
+    """Current labeled samples without an artifact of their current version."""
+    return LabeledSample.objects.filter(superseded_by=None).exclude(
+        fathom_artifact__version=F("version")
+    )
+
+
+def build_fathom_artifact(labeled_sample_pk, store=None):
+    """
+    Converts the labeled sample and stores the result. Returns the artifact,
+    or None if the labeled sample is gone. The blob of the artifact it
+    replaces is deleted, unless something else uses it too.
+    """
+    # The version is read before the labels, so if they change in between the
+    # artifact is only ever marked older than it is and gets rebuilt.
+    labeled_sample = (
+        LabeledSample.objects.filter(pk=labeled_sample_pk)
+        .select_related("original_sample")
+        .first()
+    )
+    if labeled_sample is None:
+        return None
+    fta_id_to_slug = {
+        label.data_fta_id: label.label.slug
+        for label in labeled_sample.labeled_elements.select_related("label")
+    }
+    converted, suffix = convert_page_to_fathom_sample(
+        labeled_sample.materialized_sample, fta_id_to_slug
+    )
+    store = store or ContentAddressedStore()
+    digest = sha256_hexdigest(converted)
+    # Concurrent builds may finish in any order, the newest version wins.
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LOCK_BLOB, [digest])
+        store.put(converted, digest=digest)
+        previous = (
+            FathomArtifact.objects.select_for_update()
+            .filter(pk=labeled_sample.pk)
+            .values_list("sha256", flat=True)
+            .first()
+        )
+        cursor.execute(
+            UPSERT_ARTIFACT, [labeled_sample.pk, labeled_sample.version, suffix, digest]
+        )
+        if cursor.rowcount:
+            unused = previous if previous != digest else None
+        else:
+            # A newer build won, nothing may need this one's blob.
+            unused = digest
+    if unused is not None:
+        delete_unused_blob(store, unused)
+    return FathomArtifact.objects.filter(pk=labeled_sample.pk).first()
+
+
+def delete_unused_blob(store, digest):
+    # Identical artifacts share a blob, and pages are in the same store.
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LOCK_BLOB, [digest])
+        if FathomArtifact.objects.filter(sha256=digest).exists():
+            return
+        if Sample.objects.filter(frozen_page_sha256=digest).exists():
+            return
+        store.delete(digest)
+
+
+def _build_in_background(labeled_sample_pk):
+    try:
+        build_fathom_artifact(labeled_sample_pk)
+    finally:
+        # Threads get their own connection, don't leave it open.
+        connection.close()
+
+
+def schedule_fathom_artifact(labeled_sample):
+    """
+    Rebuilds the artifact of `labeled_sample` in a background thread once the
+    current transaction commits. Anything lost on the way (a restart, an
+    error) is left to build_fathom_artifacts.
+    """
+    global _executor
+    if not settings.FATHOM_ARTIFACTS_ON_SAVE:
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    pk = labeled_sample.pk
+    transaction.on_commit(lambda: _executor.submit(_build_in_background, pk))
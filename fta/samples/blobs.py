@@ -0,0 +1,56 @@
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import get_storage_class
+
+
+def sha256_hexdigest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class ContentAddressedStore:
+    """Write-once store for page bodies, keyed by the SHA-256 of their bytes.
+
+    Blobs go through the configured Django storage (the media bucket in
+    production, the local filesystem everywhere else), so identical uploads
+    share one object.
+    """
+
+    def __init__(self, storage=None, location=None):
+        if storage is None:
+            storage = get_storage_class(settings.FROZEN_PAGE_BLOB_STORAGE)()
+        self.storage = storage
+        self.location = location or settings.FROZEN_PAGE_BLOB_LOCATION
+
+    def name(self, digest):
+        # Fan out over two directory levels to keep listings small.
+        return f"{self.location}/{digest[0:2]}/{digest[2:4]}/{digest}"
+
+    def exists(self, digest):
+        return self.storage.exists(self.name(digest))
+
+    def put(self, content, digest=None):
+        """Store `content` (bytes) unless it is already there. Returns the digest."""
+        if digest is None:
+            digest = sha256_hexdigest(content)
+        if not self.exists(digest):
+            self.storage.save(name=self.name(digest), content=ContentFile(content))
+        return digest
+
+    def put_file(self, file, digest):
+        """Store the contents of the binary `file`, whose digest is already known."""
+        if not self.exists(digest):
+            file.seek(0)
+            self.storage.save(name=self.name(digest), content=File(file))
+        return digest
+
+    def delete(self, digest):
+        self.storage.delete(self.name(digest))
+
+    def open(self, digest):
+        return self.storage.open(self.name(digest), "rb")
+
+    def read(self, digest):
+        with self.open(digest) as blob:
+            return blob.read()
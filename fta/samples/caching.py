@@ -0,0 +1,184 @@
+"""
+Cached reads for the sample list, the admin and the API, down to the
+rendered pages of the sample table.
+
+Values are kept in the default cache, which all workers share (see CACHES).
+Each model they're computed from has a generation number in the cache that
+is bumped on every write to it: by post_save/post_delete, and
+by hand after bulk writes. Keys include the generations of the models the
+value depends on, so after a write no worker reads the old value again, and
+it expires on its own (SAMPLE_CACHE_TIMEOUT, which also bounds how long
+writes made behind Django's back go unnoticed).
+
+Hits and misses of every read are counted in the cache too, see
+cache_stats().
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Func
+
+PREFIX = "samples"
+# Everything that shows up in the sample list and label lookups.
+SAMPLE_MODELS = (
+    "samples.sample",
+    "samples.labeledsample",
+    "samples.labeledelement",
+    "samples.label",
+)
+CACHED_READS = [
+    "label_ids",
+    "label_counts",
+    "sample_count",
+    "domain_facets",
+    "sample_table",
+]
+
+_missing = object()
+
+
+def _generation_key(model):
+    return f"{PREFIX}:generation:{model}"
+
+
+def _new_generation():
+    # From the clock, so a generation lost to eviction never comes back to a
+    # value it already had.
+    return time.time_ns()
+
+
+def generations(models):
+    keys = [_generation_key(model) for model in models]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, _new_generation(), timeout=None)
+            found[key] = cache.get(key, 0)
+    return [found[key] for key in keys]
+
+
+def bump_generation(*models):
+    """
+    Invalidates everything computed from `models` ("app_label.model_name"):
+    right away, so the transaction making the write doesn't read old values,
+    and again once it commits, in case another worker cached what it could
+    see in between.
+    """
+
+    def bump():
+        for model in models:
+            try:
+                cache.incr(_generation_key(model))
+            except ValueError:
+                cache.add(_generation_key(model), _new_generation(), timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def _count(name, outcome):
+    key = f"{PREFIX}:stats:{name}:{outcome}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cached(name, models, compute, *key_parts):
+    """
+    The value of compute() for `key_parts`, computed again once any of
+    `models` was written to.
+    """
+    versions = "-".join(str(generation) for generation in generations(models))
+    parts = hashlib.md5(repr(key_parts).encode("utf-8")).hexdigest()
+    key = f"{PREFIX}:{name}:{parts}:{versions}"
+    value = cache.get(key, _missing)
+    if value is not _missing:
+        _count(name, "hits")
+        return value
+    _count(name, "misses")
+    value = compute()
+    cache.set(key, value, settings.SAMPLE_CACHE_TIMEOUT)
+    return value
+
+
+def cache_stats():
+    keys = [
+        f"{PREFIX}:stats:{name}:{outcome}"
+        for name in CACHED_READS
+        for outcome in ["hits", "misses"]
+    ]
+    counts = cache.get_many(keys)
+    stats = {}
+    for name in CACHED_READS:
+        hits = counts.get(f"{PREFIX}:stats:{name}:hits", 0)
+        misses = counts.get(f"{PREFIX}:stats:{name}:misses", 0)
+        total = hits + misses
+        stats[name] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else None,
+        }
+    return stats
+
+
+def reset_cache_stats():
+    cache.delete_many(
+        [
+            f"{PREFIX}:stats:{name}:{outcome}"
+            for name in CACHED_READS
+            for outcome in ["hits", "misses"]
+        ]
+    )
+
+
+def label_ids():
+    """{slug: pk} of every label, for filtering by label."""
+    from .models import Label
+
+    return cached(
+        "label_ids",
+        ["samples.label"],
+        lambda: dict(Label.objects.values_list("slug", "pk")),
+    )
+
+
+def label_counts():
+    """(slug, number of samples) of the labels in use, by slug."""
+    from .models import SampleLabelSummary
+
+    def count():
+        in_use = SampleLabelSummary.objects.annotate(
+            label_slug=Func(F("label_slugs"), function="unnest")
+        )
+        return list(
+            in_use.order_by("label_slug")
+            .values("label_slug")
+            .annotate(count=Count("sample_id"))
+            .values_list("label_slug", "count")
+        )
+
+    return cached("label_counts", SAMPLE_MODELS, count)
+
+
+def sample_count(queryset, *key_parts):
+    """queryset.count() of a sample list filtered as `key_parts` say."""
+    return cached("sample_count", SAMPLE_MODELS, queryset.count, *key_parts)
+
+
+def domain_facets(queryset, *key_parts):
+    return cached(
+        "domain_facets",
+        SAMPLE_MODELS,
+        lambda: list(queryset.domain_facets()),
+        *key_parts,
+    )
+
+
+def sample_table(render, *key_parts):
+    """The HTML of the page of the sample table that `key_parts` select."""
+    return cached("sample_table", SAMPLE_MODELS, render, *key_parts)
@@ -0,0 +1,128 @@
+"""
+Compression for the page columns, see CompressedTextField.
+
+A compressed value starts with a NUL byte (which a page never does), then the
+codec and the id of the CompressionDictionary it was compressed with, or 0.
+Anything else is a plain UTF-8 page from before compression, so existing rows
+keep working as they are.
+"""
+
+import struct
+import zlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:  # Optional, zlib is used without it
+    zstandard = None
+
+HEADER = struct.Struct(">ccI")
+HEADER_SIZE = HEADER.size
+MARKER = b"\x00"
+CODECS = {"zlib": b"z", "zstd": b"s"}
+CODEC_NAMES = {tag: name for name, tag in CODECS.items()}
+# zlib only looks back 32KB, a bigger dictionary is wasted.
+ZLIB_MAX_DICTIONARY_SIZE = 32 * 1024
+
+_dictionaries = {}
+
+
+def get_dictionary(pk):
+    # Dictionaries never change once trained, so they're kept for good.
+    if pk not in _dictionaries:
+        from .models import CompressionDictionary
+
+        dictionary = CompressionDictionary.objects.get(pk=pk)
+        data = prepare_dictionary(bytes(dictionary.data), dictionary.codec)
+        _dictionaries[pk] = dictionary.codec, data
+    return _dictionaries[pk]
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ImproperlyConfigured("zstd compression needs the zstandard package.")
+    return zstandard
+
+
+def prepare_dictionary(data, codec):
+    if codec == "zstd":
+        return _zstandard().ZstdCompressionDict(data)
+    return data
+
+
+def compress(data, codec, dictionary=None):
+    """Compresses bytes, `dictionary` comes from prepare_dictionary()."""
+    if codec == "zstd":
+        return _zstandard().ZstdCompressor(dict_data=dictionary).compress(data)
+    if codec == "zlib":
+        if dictionary is None:
+            compressor = zlib.compressobj()
+        else:
+            compressor = zlib.compressobj(zdict=dictionary)
+        return compressor.compress(data) + compressor.flush()
+    raise ImproperlyConfigured(f"Unknown page compression {codec!r}.")
+
+
+def decompress(data, codec, dictionary=None):
+    if codec == "zstd":
+        # Frames always carry their size, compress() writes it.
+        return _zstandard().ZstdDecompressor(dict_data=dictionary).decompress(data)
+    if dictionary is None:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def compress_page(text, codec=None, dictionary_id=None):
+    """Returns `text` as bytes for a CompressedTextField column."""
+    if codec is None:
+        codec = settings.PAGE_COMPRESSION
+        dictionary_id = settings.PAGE_COMPRESSION_DICTIONARY
+    data = text.encode("utf-8")
+    # Empty stays empty, so lookups against "" keep working.
+    if codec == "none" or not data:
+        return data
+    dictionary = None
+    if dictionary_id:
+        dictionary_codec, dictionary = get_dictionary(dictionary_id)
+        if dictionary_codec != codec:
+            raise ImproperlyConfigured(
+                f"Dictionary {dictionary_id} is for {dictionary_codec}, not {codec}."
+            )
+    header = HEADER.pack(MARKER, CODECS[codec], dictionary_id or 0)
+    return header + compress(data, codec, dictionary)
+
+
+def decompress_page(data):
+    """The inverse of compress_page(), `data` is any bytes-like object."""
+    # psycopg2 hands bytea over as a memoryview of chars, compare as bytes.
+    data = memoryview(data).cast("B")
+    if data[:1] != MARKER:
+        return str(data, "utf-8")
+    _, tag, dictionary_id = HEADER.unpack(data[:HEADER_SIZE])
+    dictionary = get_dictionary(dictionary_id)[1] if dictionary_id else None
+    return str(decompress(data[HEADER_SIZE:], CODEC_NAMES[tag], dictionary), "utf-8")
+
+
+def train_dictionary(pages, codec, size=112 * 1024):
+    """Builds a dictionary of the boilerplate shared by `pages` (bytes)."""
+    if codec == "zstd":
+        return _zstandard().train_dictionary(size, pages).as_bytes()
+    # zlib has no trainer. Use the tags and text that turn up in the most
+    # pages, most common last since zlib finds closer matches cheaper.
+    counts = Counter()
+    for page in pages:
+        counts.update(set(piece + b">" for piece in page.split(b">")))
+    common = [piece for piece, count in counts.most_common() if count > 1]
+    budget = min(size, ZLIB_MAX_DICTIONARY_SIZE)
+    chosen = []
+    for piece in common:
+        if len(piece) > budget:
+            continue
+        chosen.append(piece)
+        budget -= len(piece)
+    return b"".join(reversed(chosen))
@@ -0,0 +1,600 @@
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.db import connection, transaction
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    CharField,
+    Count,
+    F,
+    Func,
+    Min,
+    Prefetch,
+    Q,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce, NullIf
+from django.utils import timezone
+
+from .blobs import ContentAddressedStore, sha256_hexdigest
+from .models import (
+    ExportJob,
+    ExportJobItem,
+    FathomArtifact,
+    LabeledElement,
+    LabeledSample,
+)
+from .packs import PACK_NAME, PACK_SUFFIX, PackWriter, index_path
+from .pools import process_pool
+from .utils import (
+    SPLITS,
+    convert_page_to_fathom_sample,
+    split_thresholds,
+    use_streaming_rewriter,
+)
+
+# A running job that hasn't checkpointed for this long is assumed to belong to
+# a dead worker and is picked up again.
+STALE_JOB_AFTER = timedelta(minutes=10)
+
+
+def without_near_duplicates(queryset):
+    # Keeps the first labeled sample of each near duplicate cluster in
+    # `queryset`, and every labeled sample that isn't in one.
+    first_in_cluster = (
+        queryset.exclude(original_sample__signature__cluster=None)
+        .order_by()
+        .values("original_sample__signature__cluster")
+        .annotate(first=Min("pk"))
+        .values("first")
+    )
+    return queryset.filter(
+        Q(original_sample__signature__cluster=None) | Q(pk__in=first_in_cluster)
+    )
+
+
+class SplitBucket(Func):
+    # utils.split_bucket() of an expression, in SQL.
+    template = "('x' || substr(md5((%(expressions)s)::text), 1, 8))::bit(32)::bigint"
+    output_field = BigIntegerField()
+
+
+# What keeps samples together in one split: the sample itself, the domain of
+# its page (so a site is never in two splits) or its near duplicate cluster.
+SPLIT_GROUPS = {
+    "sample": F("original_sample_id"),
+    # Samples without a domain are on their own, not all in one group.
+    "domain": Coalesce(
+        NullIf("original_sample__domain", Value("")),
+        Cast("original_sample_id", CharField()),
+    ),
+    "cluster": Coalesce("original_sample__signature__cluster", "original_sample_id"),
+}
+
+
+def with_splits(queryset, train_pct, test_pct, group_by):
+    # Annotates each labeled sample with its split, see utils.split_for_key().
+    train, test = split_thresholds(train_pct, test_pct)
+    return queryset.annotate(
+        split_bucket=SplitBucket(SPLIT_GROUPS[group_by]),
+        split=Case(
+            When(split_bucket__lt=train, then=Value(SPLITS[0])),
+            When(split_bucket__lt=test, then=Value(SPLITS[1])),
+            default=Value(SPLITS[2]),
+            output_field=CharField(),
+        ),
+    )
+
+
+def enqueue_export(
+    queryset,
+    train_pct=0.6,
+    test_pct=0.2,
+    skip_duplicates=False,
+    group_by=None,
+    incremental=True,
+    format="files",
+    location="",
+):
+    # Splits are decided up front so that a resumed job writes each sample to
+    # the same place. They're worked out in the database, nothing is loaded.
+    # (Annotations come after fields in the SELECT, whatever the order here.)
+    # Incremental exports copy the files of the last finished export for
+    # labeled samples that haven't changed since, instead of converting them.
+    folder = f"{datetime.now():%Y-%m-%d}-{str(uuid4())[0:6]}"
+    if skip_duplicates:
+        queryset = without_near_duplicates(queryset)
+    items = with_splits(
+        queryset, train_pct, test_pct, group_by or settings.EXPORT_SPLIT_GROUP
+    ).values_list("pk", "version", "split")
+    sql, params = items.query.sql_with_params()
+    base = None
+    if incremental:
+        base = (
+            ExportJob.objects.filter(status="done", location=location)
+            .order_by("-finished")
+            .first()
+        )
+    with transaction.atomic():
+        job = ExportJob.objects.create(
+            folder=folder, base=base, format=format, location=location
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {ExportJobItem._meta.db_table}
+                    (job_id, labeled_sample_id, split, version, done, name, pack)
+                SELECT %s, item.pk, item.split, item.version, false, '', ''
+                FROM ({sql}) AS item (pk, version, split)
+                """,
+                [job.pk, *params],
+            )
+            job.total = cursor.rowcount
+        if base is not None:
+            job.diff = reuse_unchanged_items(job, base)
+        job.save(update_fields=["total", "diff"])
+    return job
+
+
+def describe_diff(diff):
+    if not diff:
+        return "-"
+    return ", ".join(f"{count} {change}" for change, count in diff.items())
+
+
+def reuse_unchanged_items(job, base):
+    # Points the items of `job` at the items of `base` with the same labeled
+    # sample and version, and returns how the two exports differ by sample.
+    table = ExportJobItem._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {table} AS item SET reused_from_id = base_item.id
+            FROM {table} AS base_item
+            WHERE item.job_id = %s AND base_item.job_id = %s
+                AND base_item.labeled_sample_id = item.labeled_sample_id
+                AND base_item.version = item.version
+                AND base_item.done AND base_item.sha256 IS NOT NULL
+            """,
+            [job.pk, base.pk],
+        )
+        cursor.execute(
+            f"""
+            WITH new AS (
+                SELECT item.split, item.reused_from_id, ls.original_sample_id
+                FROM {table} item
+                JOIN {LabeledSample._meta.db_table} ls ON ls.id = item.labeled_sample_id
+                WHERE item.job_id = %s
+            ), old AS (
+                SELECT item.split, ls.original_sample_id
+                FROM {table} item
+                JOIN {LabeledSample._meta.db_table} ls ON ls.id = item.labeled_sample_id
+                WHERE item.job_id = %s
+            )
+            SELECT
+                count(*) FILTER (WHERE old.original_sample_id IS NULL),
+                count(*) FILTER (
+                    WHERE new.original_sample_id IS NOT NULL
+                    AND old.original_sample_id IS NOT NULL
+                    AND new.reused_from_id IS NULL
+                ),
+                count(*) FILTER (WHERE new.reused_from_id IS NOT NULL),
+                count(*) FILTER (WHERE new.original_sample_id IS NULL),
+                count(*) FILTER (WHERE new.split <> old.split)
+            FROM new FULL JOIN old USING (original_sample_id)
+            """,
+            [job.pk, base.pk],
+        )
+        added, changed, unchanged, removed, moved = cursor.fetchone()
+    # Items of deleted labeled samples went with them.
+    removed += base.total - base.items.count()
+    return {
+        "added": added,
+        "changed": changed,
+        "unchanged": unchanged,
+        "removed": removed,
+        "moved": moved,
+    }
+
+
+def claim_export_job():
+    stale = timezone.now() - STALE_JOB_AFTER
+    with transaction.atomic():
+        job = (
+            ExportJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(status="queued") | Q(status="running", updated__lt=stale))
+            .order_by("created")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = "running"
+        job.started = job.started or timezone.now()
+        job.save(update_fields=["status", "started", "updated"])
+    return job
+
+
+def copy_artifact(storage, source, name):
+    # Server side when the storage can (see fta.utils.storages), else a hard
+    # link for local files, else through here.
+    if storage.exists(name):
+        storage.delete(name)
+    if hasattr(storage, "copy"):
+        storage.copy(source, name)
+        return
+    try:
+        source_path, path = storage.path(source), storage.path(name)
+    except NotImplementedError:
+        with storage.open(source, "rb") as f:
+            storage.save(name=name, content=File(f))
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.link(source_path, path)
+    except OSError:
+        shutil.copyfile(source_path, path)
+
+
+def write_manifest(job, storage):
+    # Sample, labeled sample version, content hash and split of every file,
+    # written item by item to a temporary file rather than built in memory.
+    # Packed exports also say where in which pack.
+    keys = ["sample", "labeled_sample", "version", "sha256", "split", "name"]
+    fields = [
+        "labeled_sample__original_sample_id",
+        "labeled_sample_id",
+        "version",
+        "sha256",
+        "split",
+        "name",
+    ]
+    if job.format == "packed":
+        keys += ["pack", "offset", "size"]
+        fields += ["pack", "offset", "size"]
+    items = job.items.order_by("pk").values_list(*fields)
+    name = f"{job.folder}/manifest.json"
+    with tempfile.TemporaryFile() as f:
+        header = {
+            "folder": job.folder,
+            "base": job.base.folder if job.base else None,
+            "diff": job.diff,
+            "format": job.format,
+        }
+        # The header object, left open for the samples to go in.
+        f.write(json.dumps(header)[:-1].encode("utf-8") + b', "samples": [\n')
+        for i, values in enumerate(items.iterator()):
+            line = json.dumps(dict(zip(keys, values)))
+            f.write((",\n" if i else "").encode("utf-8") + line.encode("utf-8"))
+        f.write(b"\n]}\n")
+        f.seek(0)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name=name, content=File(f))
+
+
+def _convert(args):
+    return convert_page_to_fathom_sample(*args)
+
+
+def pending_items(job, batch_size):
+    # In id order from where the last batch ended: items handed to the pool
+    # aren't done yet, they mustn't come round again. Pages and labels are
+    # loaded with the batch, but only for the items that will be converted
+    # (if a copy turns out to be missing after all, they're loaded one by one).
+    pending = (
+        job.items.filter(done=False)
+        .order_by("pk")
+        .select_related("labeled_sample__fathom_artifact", "reused_from")
+        .defer("labeled_sample__modified_sample")
+    )
+    with_pages = LabeledSample._base_manager.select_related(
+        "original_sample"
+    ).prefetch_related(
+        Prefetch(
+            "labeled_elements",
+            queryset=LabeledElement._base_manager.select_related("label"),
+            to_attr="export_labels",
+        )
+    )
+    last_pk = 0
+    while True:
+        batch = list(pending.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        converted = [
+            item
+            for item in batch
+            if item.reused_from is None and current_artifact(item) is None
+        ]
+        labeled_samples = with_pages.in_bulk(
+            [item.labeled_sample_id for item in converted]
+        )
+        for item in converted:
+            item.labeled_sample = labeled_samples[item.labeled_sample_id]
+        yield from batch
+        last_pk = batch[-1].pk
+
+
+def export_labels(labeled_sample):
+    # Labeled elements of superseded labeled samples are hidden by the default
+    # manager, but a job queued before the sample was labeled again still
+    # exports them.
+    labels = getattr(labeled_sample, "export_labels", None)
+    if labels is None:
+        labels = LabeledElement._base_manager.filter(
+            labeled_sample=labeled_sample
+        ).select_related("label")
+    return labels
+
+
+def current_artifact(item):
+    # The fathom artifact of the item's labeled sample, if it was built from
+    # the version being exported.
+    try:
+        artifact = item.labeled_sample.fathom_artifact
+    except FathomArtifact.DoesNotExist:
+        return None
+    return artifact if artifact.version == item.version else None
+
+
+def copy_blob(store, digest, storage, name):
+    if store.storage.deconstruct() == storage.deconstruct():
+        copy_artifact(storage, store.name(digest), name)
+        return
+    if storage.exists(name):
+        storage.delete(name)
+    with store.open(digest) as blob:
+        storage.save(name=name, content=File(blob))
+
+
+def checkpoint(job, item, name, digest):
+    with transaction.atomic():
+        ExportJobItem.objects.filter(pk=item.pk).update(
+            done=True, name=name, sha256=digest
+        )
+        ExportJob.objects.filter(pk=job.pk).update(
+            processed=F("processed") + 1, updated=timezone.now()
+        )
+
+
+def read_exported(storage, item):
+    # The bytes written for an item of a finished job, in a pack or not.
+    if not item.pack:
+        with storage.open(item.name, "rb") as f:
+            return f.read()
+    with storage.open(item.pack, "rb") as f:
+        f.seek(item.offset)
+        return f.read(item.size)
+
+
+class FileSink:
+    """Writes every sample of an export to its own storage object."""
+
+    def __init__(self, storage, job):
+        self.storage = storage
+        self.job = job
+
+    def name(self, item, filename):
+        return f"{self.job.folder}/{item.split}/{filename}"
+
+    def copy_item(self, item, reused):
+        # Same file as for `reused`, an item of an earlier job.
+        filename = posixpath.basename(reused.name)
+        if reused.pack:
+            self.add(item, filename, read_exported(self.storage, reused), reused.sha256)
+            return
+        name = self.name(item, filename)
+        copy_artifact(self.storage, reused.name, name)
+        checkpoint(self.job, item, name, reused.sha256)
+
+    def copy_blob(self, item, store, artifact):
+        name = self.name(item, f"{item.labeled_sample_id}{artifact.suffix}")
+        copy_blob(store, artifact.sha256, self.storage, name)
+        checkpoint(self.job, item, name, artifact.sha256)
+
+    def write(self, item, converted):
+        processed_sample, suffix = converted
+        self.add(item, f"{item.labeled_sample_id}{suffix}", processed_sample)
+
+    def add(self, item, filename, data, digest=None):
+        name = self.name(item, filename)
+        # A crash between saving and checkpointing leaves the object
+        # behind, don't let the storage pick a new name for it.
+        if self.storage.exists(name):
+            self.storage.delete(name)
+        self.storage.save(name=name, content=ContentFile(data))
+        checkpoint(self.job, item, name, digest or sha256_hexdigest(data))
+
+    def close(self):
+        pass
+
+
+class PackSink(FileSink):
+    """
+    Writes the samples of each split into packs of about EXPORT_PACK_SIZE
+    bytes, see packs.py. Items are checkpointed when their pack is saved, a
+    resumed job starts the pack they were in over.
+    """
+
+    def __init__(self, storage, job):
+        super().__init__(storage, job)
+        self.packs = {}
+        self.heartbeat = timezone.now()
+        self.written = dict(
+            job.items.filter(done=True)
+            .exclude(pack="")
+            .values("split")
+            .annotate(packs=Count("pack", distinct=True))
+            .values_list("split", "packs")
+        )
+
+    def copy_item(self, item, reused):
+        filename = posixpath.basename(reused.name)
+        self.add(item, filename, read_exported(self.storage, reused), reused.sha256)
+
+    def copy_blob(self, item, store, artifact):
+        filename = f"{item.labeled_sample_id}{artifact.suffix}"
+        self.add(item, filename, store.read(artifact.sha256), artifact.sha256)
+
+    def add(self, item, filename, data, digest=None):
+        if item.split not in self.packs:
+            number = self.written.get(item.split, 0)
+            name = self.name(item, PACK_NAME.format(number) + PACK_SUFFIX)
+            self.packs[item.split] = PackWriter(name), []
+        pack, items = self.packs[item.split]
+        digest = digest or sha256_hexdigest(data)
+        original_sample_id = item.labeled_sample.original_sample_id
+        offset = pack.add(
+            item.labeled_sample_id, original_sample_id, filename, data, digest
+        )
+        item.done = True
+        item.name = self.name(item, filename)
+        item.sha256 = digest
+        item.pack = pack.name
+        item.offset = offset
+        item.size = len(data)
+        items.append(item)
+        if pack.size >= settings.EXPORT_PACK_SIZE:
+            self.flush(item.split)
+        elif timezone.now() - self.heartbeat > STALE_JOB_AFTER / 10:
+            # Nothing is checkpointed until the pack is full, keep the job
+            # from looking abandoned meanwhile.
+            self.heartbeat = timezone.now()
+            ExportJob.objects.filter(pk=self.job.pk).update(updated=self.heartbeat)
+
+    def flush(self, split):
+        pack, items = self.packs.pop(split)
+        try:
+            index = index_path(pack.name)
+            for name, content in [
+                (pack.name, File(pack.file)),
+                (index, ContentFile(pack.index())),
+            ]:
+                if self.storage.exists(name):
+                    self.storage.delete(name)
+                content.seek(0)
+                self.storage.save(name=name, content=content)
+        finally:
+            pack.close()
+        with transaction.atomic():
+            ExportJobItem.objects.bulk_update(
+                items, ["done", "name", "sha256", "pack", "offset", "size"]
+            )
+            ExportJob.objects.filter(pk=self.job.pk).update(
+                processed=F("processed") + len(items), updated=timezone.now()
+            )
+        self.written[split] = self.written.get(split, 0) + 1
+
+    def close(self):
+        for split in list(self.packs):
+            self.flush(split)
+
+
+@contextmanager
+def timed(timings, stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] += time.monotonic() - start
+
+
+def export_storage(job):
+    # The media storage, or the local folder the job was made for.
+    if job.location:
+        return FileSystemStorage(location=job.location)
+    return get_storage_class()()
+
+
+def run_export_job(job, batch_size=50, workers=None, timings=None):
+    # Conversions are spread over `workers` processes (EXPORT_WORKERS by
+    # default), each sent just the labeled page and its labels. At most two
+    # per worker are in flight, results are written as they come back.
+    # Files of the base job and current fathom artifacts are copied instead.
+    # Seconds spent in each stage are added to `timings` (a Counter) if given.
+    storage = export_storage(job)
+    store = ContentAddressedStore()
+    if workers is None:
+        workers = settings.EXPORT_WORKERS
+    if timings is None:
+        timings = Counter()
+    pool = process_pool("export", workers)
+    streaming = use_streaming_rewriter()
+    sink = (PackSink if job.format == "packed" else FileSink)(storage, job)
+    items = pending_items(job, batch_size)
+    in_flight = {}
+
+    def write_completed(return_when):
+        with timed(timings, "convert"):
+            done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            with timed(timings, "write"):
+                sink.write(in_flight.pop(future), future.result())
+
+    try:
+        while True:
+            with timed(timings, "read"):
+                item = next(items, None)
+            if item is None:
+                break
+            reused = item.reused_from
+            if reused is not None and storage.exists(reused.pack or reused.name):
+                with timed(timings, "copy"):
+                    sink.copy_item(item, reused)
+                continue
+            artifact = current_artifact(item)
+            if artifact is not None and store.exists(artifact.sha256):
+                with timed(timings, "copy"):
+                    sink.copy_blob(item, store, artifact)
+                continue
+            with timed(timings, "read"):
+                labeled_sample = item.labeled_sample
+                args = (
+                    labeled_sample.materialized_sample,
+                    {
+                        label.data_fta_id: label.label.slug
+                        for label in export_labels(labeled_sample)
+                    },
+                    streaming,
+                )
+            if pool is None:
+                with timed(timings, "convert"):
+                    converted = _convert(args)
+                with timed(timings, "write"):
+                    sink.write(item, converted)
+                continue
+            if len(in_flight) >= 2 * workers:
+                write_completed(FIRST_COMPLETED)
+            in_flight[pool.submit(_convert, args)] = item
+        if in_flight:
+            write_completed(ALL_COMPLETED)
+        with timed(timings, "write"):
+            sink.close()
+        with timed(timings, "manifest"):
+            write_manifest(job, storage)
+    except Exception as e:
+        for future in in_flight:
+            future.cancel()
+        ExportJob.objects.filter(pk=job.pk).update(
+            status="failed", error=repr(e), updated=timezone.now()
+        )
+        raise
+    ExportJob.objects.filter(pk=job.pk).update(
+        status="done", finished=timezone.now(), updated=timezone.now()
+    )
+    job.refresh_from_db()
+    return job
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+from .blobs import ContentAddressedStore, sha256_hexdigest
+from .compression import compress_page, decompress_page
+
+
+class ContentAddressedTextAttribute(DeferredAttribute):
+    """Loads the value from the blob store the first time it is read."""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if value == "":
+            digest = getattr(instance, self.field.hash_field)
+            if digest:
+                value = ContentAddressedStore().read(digest).decode("utf-8")
+                instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # Being a data descriptor means reads always go through __get__, even
+        # once the (empty) column value has been loaded from the database.
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """A TextField stored compressed in a bytea column.
+
+    New values are compressed with settings.PAGE_COMPRESSION (and
+    PAGE_COMPRESSION_DICTIONARY), values written before compression or with
+    another codec are still read. See compression.py.
+    """
+
+    def db_type(self, connection):
+        return "bytea"
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        return connection.Database.Binary(compress_page(value))
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_page(value)
+
+
+class ContentAddressedTextField(CompressedTextField):
+    """A TextField whose body can live in the content-addressed blob store.
+
+    The SHA-256 of the value is written to `hash_field` on every save. When
+    settings.FROZEN_PAGE_STORAGE is "blob" the body is written to the blob
+    store and the column is left empty; reading the attribute then fetches it
+    lazily. `hash_field` must be declared after this field so that its own
+    pre_save picks up the fresh digest. Inline bodies are compressed like a
+    CompressedTextField's, unless `compressed` is False (as it was before).
+    """
+
+    descriptor_class = ContentAddressedTextAttribute
+
+    def __init__(self, *args, hash_field, compressed=False, **kwargs):
+        self.hash_field = hash_field
+        self.compressed = compressed
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["hash_field"] = self.hash_field
+        if self.compressed:
+            kwargs["compressed"] = True
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        if self.compressed:
+            return super().db_type(connection)
+        return models.TextField.db_type(self, connection)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if self.compressed:
+            return super().get_db_prep_value(value, connection, prepared)
+        return models.TextField.get_db_prep_value(self, value, connection, prepared)
+
+    def from_db_value(self, value, expression, connection):
+        if self.compressed:
+            return super().from_db_value(value, expression, connection)
+        return value
+
+    def has_stored_blob(self, model_instance):
+        # True for an instance pointed at a body that is already in the blob
+        # store (e.g. streamed there by an upload) and that hasn't been read.
+        return model_instance.__dict__.get(self.attname) == "" and bool(
+            getattr(model_instance, self.hash_field)
+        )
+
+    def pre_save(self, model_instance, add):
+        if settings.FROZEN_PAGE_STORAGE == "blob" and self.has_stored_blob(
+            model_instance
+        ):
+            return ""
+        value = super().pre_save(model_instance, add)
+        content = value.encode("utf-8")
+        digest = sha256_hexdigest(content)
+        setattr(model_instance, self.hash_field, digest)
+        if settings.FROZEN_PAGE_STORAGE == "blob":
+            ContentAddressedStore().put(content, digest=digest)
+            return ""
+        return value
@@ -0,0 +1,103 @@
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.encoding import smart_str
+
+from .caching import bump_generation
+from .models import Sample, SampleSignature
+from .pools import process_pool
+from .similarity import page_minhash
+from .utils import url_domain
+from .views import get_frozen_metadata
+
+# How many samples are parsed and inserted together. Only this many pages are
+# held in memory at a time.
+INGEST_CHUNK_SIZE = 50
+
+
+def _parse_page(args):
+    frozen_page, freeze_software = args
+    return get_frozen_metadata(frozen_page, freeze_software), page_minhash(frozen_page)
+
+
+def ndjson_items(stream):
+    # One {"frozen_page": ..., "freeze_software": ..., "notes": ...} object per
+    # line, read line by line so the body is never held in memory at once.
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            fields = item["frozen_page"], item["freeze_software"], item.get("notes", "")
+            if not all(isinstance(field, str) for field in fields):
+                raise TypeError(
+                    "frozen_page, freeze_software and notes must be strings"
+                )
+        except (ValueError, KeyError, TypeError) as e:
+            yield e
+        else:
+            yield fields
+
+
+def multipart_items(files, freeze_software, notes):
+    for frozen_page in files:
+        yield smart_str(frozen_page.read()), freeze_software, notes
+
+
+def ingest_samples(items):
+    """Saves samples from an iterable of (frozen_page, freeze_software, notes).
+
+    Items can also be exceptions, for input that couldn't be read. Returns a
+    {"id": ...} or {"error": ...} dict per item, in order.
+    """
+    results = []
+    items = iter(items)
+    # Opt-in, this runs in web workers, see SAMPLE_INGEST_WORKERS.
+    pool = process_pool("ingest", settings.SAMPLE_INGEST_WORKERS)
+    while True:
+        chunk = list(islice(items, INGEST_CHUNK_SIZE))
+        if not chunk:
+            break
+        valid = [item for item in chunk if not isinstance(item, Exception)]
+        args = [
+            (frozen_page, freeze_software) for frozen_page, freeze_software, _ in valid
+        ]
+        if pool is None:
+            parsed_pages = map(_parse_page, args)
+        else:
+            parsed_pages = pool.map(_parse_page, args)
+        samples = []
+        minhashes = []
+        for (frozen_page, _, notes), (metadata, minhash) in zip(valid, parsed_pages):
+            url, freeze_time, freeze_software, page_width, page_height = metadata
+            minhashes.append(minhash)
+            samples.append(
+                Sample(
+                    frozen_page=frozen_page,
+                    url=url,
+                    freeze_time=freeze_time,
+                    freeze_software=freeze_software,
+                    notes=notes,
+                    page_width=page_width,
+                    page_height=page_height,
+                    # bulk_create doesn't go through Sample.save()
+                    page_size=len(frozen_page.encode("utf-8")),
+                    domain=url_domain(url),
+                )
+            )
+        try:
+            with transaction.atomic():
+                Sample.objects.bulk_create(samples)
+                SampleSignature.objects.index(samples, minhashes)
+                bump_generation("samples.sample")
+            saved = iter({"id": sample.pk} for sample in samples)
+        except Exception as e:
+            saved = iter({"error": repr(e)} for _ in samples)
+        for item in chunk:
+            if isinstance(item, Exception):
+                results.append({"error": repr(item)})
+            else:
+                results.append(next(saved))
+    return results
@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fta.samples import compression
+from fta.samples.models import Sample
+from fta.samples.utils import humansize
+
+
+class Command(BaseCommand):
+    help = (
+        "Report compression ratio and encode/decode throughput of each page "
+        "codec on a random sample of frozen pages. Dictionaries are trained on "
+        "one half of the pages and measured on the other."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--samples", type=int, default=200)
+        parser.add_argument("--dictionary-size", type=int, default=112 * 1024)
+
+    def handle(self, *args, **options):
+        pages = [
+            sample.frozen_page.encode("utf-8")
+            for sample in Sample.objects.order_by("?").only(
+                "pk", "frozen_page", "frozen_page_sha256"
+            )[: options["samples"]]
+        ]
+        training, pages = pages[0::2], pages[1::2]
+        if not pages:
+            self.stderr.write("Not enough samples to benchmark on.")
+            return
+        raw_size = sum(len(page) for page in pages)
+        self.stdout.write(
+            f"{len(pages)} pages, {humansize(raw_size)} "
+            f"(dictionaries trained on {len(training)} others)"
+        )
+        codecs = ["zlib"] if compression.zstandard is None else ["zlib", "zstd"]
+        for codec in codecs:
+            dictionary = compression.prepare_dictionary(
+                compression.train_dictionary(
+                    training, codec, size=options["dictionary_size"]
+                ),
+                codec,
+            )
+            for name, used in [(codec, None), (f"{codec}+dictionary", dictionary)]:
+                self.report(name, pages, raw_size, codec, used)
+
+    def report(self, name, pages, raw_size, codec, dictionary):
+        start = time.perf_counter()
+        compressed = [compression.compress(page, codec, dictionary) for page in pages]
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in compressed:
+            compression.decompress(data, codec, dictionary)
+        decode = time.perf_counter() - start
+        compressed_size = sum(len(data) for data in compressed)
+        mb = raw_size / 1024 / 1024
+        self.stdout.write(
+            f"{name:>16}: {humansize(compressed_size):>10}  "
+            f"ratio {raw_size / compressed_size:5.2f}  "
+            f"encode {mb / encode:7.1f} MB/s  decode {mb / decode:7.1f} MB/s"
+        )
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from fta.samples.artifacts import build_fathom_artifact, stale_labeled_samples
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert the current labeled samples whose fathom artifact is missing or "
+        "older than their labels (e.g. from before artifacts were introduced, or "
+        "lost to a restart), in batches. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+
+    def handle(self, *args, **options):
+        stale = stale_labeled_samples().order_by("pk")
+        last_pk = 0
+        built = 0
+        while True:
+            batch = list(
+                stale.filter(pk__gt=last_pk).values_list("pk", flat=True)[
+                    : options["batch_size"]
+                ]
+            )
+            if not batch:
+                break
+            for pk in batch:
+                build_fathom_artifact(pk)
+            last_pk = batch[-1]
+            built += len(batch)
+            self.stdout.write(f"Built {built} artifacts (up to id {last_pk})")
+        self.stdout.write(self.style.SUCCESS(f"Done, {built} artifacts built."))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from fta.samples.caching import cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Report hits, misses and hit rate of the cached sample list and label "
+        "reads, counted across all workers sharing the cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset", action="store_true", help="Start counting again afterwards."
+        )
+
+    def handle(self, *args, **options):
+        for name, stats in cache_stats().items():
+            hit_rate = stats["hit_rate"]
+            hit_rate = "-" if hit_rate is None else f"{100 * hit_rate:.1f}%"
+            self.stdout.write(
+                f"{name:>14}: {stats['hits']:8} hits {stats['misses']:8} misses  "
+                f"hit rate {hit_rate}"
+            )
+        if options["reset"]:
+            reset_cache_stats()
+            self.stdout.write(self.style.SUCCESS("Counts were reset."))
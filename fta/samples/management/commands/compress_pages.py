@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Func, IntegerField, Value
+
+from fta.samples.blobs import sha256_hexdigest
+from fta.samples.models import LabeledSample, Sample
+
+
+class Command(BaseCommand):
+    help = (
+        "Compress frozen and modified pages stored before compression, in "
+        "batches, with the current PAGE_COMPRESSION settings. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompress every page, e.g. after training a new dictionary.",
+        )
+
+    def handle(self, *args, **options):
+        self.compress(Sample.objects, "frozen_page", options)
+        # The default manager leaves out superseded labeled samples, whose
+        # pages are kept (and take up room) all the same.
+        self.compress(LabeledSample._base_manager, "modified_sample", options)
+
+    def compress(self, manager, field, options):
+        pages = manager.exclude(**{field: ""}).order_by("pk")
+        if not options["all"]:
+            # Compressed pages start with a NUL byte, see compression.py
+            pages = pages.annotate(
+                first_byte=Func(
+                    F(field), Value(0), function="get_byte", output_field=IntegerField()
+                )
+            ).exclude(first_byte=0)
+        last_pk = 0
+        compressed = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    pages.filter(pk__gt=last_pk)
+                    .select_for_update(of=("self",))
+                    .only("pk", field)[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+                for obj in batch:
+                    page = getattr(obj, field)
+                    changes = {field: page}
+                    if field == "frozen_page":
+                        # Lets the immutability trigger accept the new bytes.
+                        changes["frozen_page_sha256"] = sha256_hexdigest(
+                            page.encode("utf-8")
+                        )
+                    # Sample.save() never writes the page of an existing
+                    # sample. The text stays the same, only its bytes in the
+                    # column change.
+                    manager.filter(pk=obj.pk).update(**changes)
+            last_pk = batch[-1].pk
+            compressed += len(batch)
+            self.stdout.write(f"Compressed {compressed} {field}s (up to id {last_pk})")
+        self.stdout.write(
+            self.style.SUCCESS(f"Done, {compressed} {field}s compressed.")
+        )
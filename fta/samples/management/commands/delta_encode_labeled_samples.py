@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fta.samples.models import LabeledSample
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-store labeled samples that hold a full page copy as fta id patches "
+        "against their original sample, where possible. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+
+    def handle(self, *args, **options):
+        # Plain manager, superseded labeled samples should shrink too.
+        full_copies = LabeledSample._base_manager.filter(fta_id_patches=None).order_by(
+            "pk"
+        )
+        last_pk = 0
+        encoded = 0
+        kept = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    full_copies.filter(pk__gt=last_pk)
+                    .select_for_update(of=("self",))
+                    .select_related("original_sample")[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+                for labeled_sample in batch:
+                    labeled_sample.set_modified_sample(labeled_sample.modified_sample)
+                    if labeled_sample.fta_id_patches is None:
+                        kept += 1
+                        continue
+                    labeled_sample.save(
+                        update_fields=["modified_sample", "fta_id_patches"]
+                    )
+                    encoded += 1
+            last_pk = batch[-1].pk
+            self.stdout.write(f"Encoded {encoded}, kept {kept} (up to id {last_pk})")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Done, {encoded} labeled samples encoded, {kept} kept as full pages."
+            )
+        )
@@ -0,0 +1,194 @@
+import json
+import os
+from collections import Counter
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from fta.samples.exports import (
+    SPLIT_GROUPS,
+    describe_diff,
+    enqueue_export,
+    run_export_job,
+    timed,
+)
+from fta.samples.models import EXPORT_FORMATS, ExportJob, Label, LabeledSample
+
+STAGES = ["select", "read", "copy", "convert", "write", "manifest"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Export current labeled samples as a fathom set, without going through "
+        "the admin. Samples are selected and split in the database and read back "
+        "in batches, nothing is loaded all at once. With --checkpoint, a rerun "
+        "after an interruption resumes the same export."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--label",
+            action="append",
+            default=[],
+            help="Only samples with this label (any of them, if repeated).",
+        )
+        parser.add_argument(
+            "--software",
+            action="append",
+            default=[],
+            help="Only samples frozen with this software (any of them, if repeated).",
+        )
+        parser.add_argument(
+            "--after",
+            type=date.fromisoformat,
+            help="Only samples frozen on or after YYYY-MM-DD.",
+        )
+        parser.add_argument(
+            "--before",
+            type=date.fromisoformat,
+            help="Only samples frozen before YYYY-MM-DD.",
+        )
+        parser.add_argument("--train", type=float, default=0.6)
+        parser.add_argument("--test", type=float, default=0.2)
+        parser.add_argument(
+            "--group-by",
+            choices=sorted(SPLIT_GROUPS),
+            default=None,
+            help="What decides the split, defaults to EXPORT_SPLIT_GROUP.",
+        )
+        parser.add_argument("--skip-duplicates", action="store_true")
+        parser.add_argument(
+            "--format", choices=[name for name, _ in EXPORT_FORMATS], default="files"
+        )
+        parser.add_argument(
+            "--no-incremental",
+            action="store_true",
+            help="Convert every sample rather than copy files of the last export.",
+        )
+        parser.add_argument(
+            "--output",
+            help="Local folder to export to, instead of the media storage.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Processes converting samples, defaults to EXPORT_WORKERS.",
+        )
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--checkpoint",
+            help=(
+                "JSON file recording the export. If it exists the export in it "
+                "is resumed, and the other options are ignored."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        path = options["checkpoint"]
+        timings = Counter()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            timings.update(state["timings"])
+            job = ExportJob.objects.filter(pk=state["job"]).first()
+            if job is None:
+                raise CommandError(f"Export job {state['job']} no longer exists.")
+            if job.status == "done":
+                self.stdout.write(f"Export job {job.pk} is already done.")
+                return
+            self.stdout.write(
+                f"Resuming export job {job.pk}: {job.processed}/{job.total} done"
+            )
+            job.status = "running"
+            job.save(update_fields=["status", "updated"])
+        else:
+            queryset = self.labeled_samples(options)
+            location = ""
+            if options["output"]:
+                location = os.path.abspath(options["output"])
+            # Marked as running before anyone can see it, so that
+            # run_export_jobs leaves it alone.
+            with timed(timings, "select"), transaction.atomic():
+                job = enqueue_export(
+                    queryset,
+                    train_pct=options["train"],
+                    test_pct=options["test"],
+                    skip_duplicates=options["skip_duplicates"],
+                    group_by=options["group_by"],
+                    incremental=not options["no_incremental"],
+                    format=options["format"],
+                    location=location,
+                )
+                job.status = "running"
+                job.started = timezone.now()
+                job.save(update_fields=["status", "started", "updated"])
+            self.stdout.write(
+                f"Export job {job.pk}: {job.total} samples, changes since the last "
+                f"export: {describe_diff(job.diff) if job.base else 'no earlier export'}"
+            )
+        self.save_checkpoint(path, job, timings)
+
+        try:
+            job = run_export_job(
+                job,
+                batch_size=options["batch_size"],
+                workers=options["workers"],
+                timings=timings,
+            )
+        except Exception as e:
+            raise CommandError(f"Export job {job.pk} failed: {e!r}") from e
+        finally:
+            self.save_checkpoint(path, job, timings)
+            self.report(timings)
+        where = os.path.join(job.location, job.folder) if job.location else job.folder
+        self.stdout.write(
+            self.style.SUCCESS(f"Exported {job.processed} samples to {where}")
+        )
+
+    def labeled_samples(self, options):
+        queryset = LabeledSample.objects.filter(superseded_by=None)
+        if options["label"]:
+            labels = dict(
+                Label.objects.filter(slug__in=options["label"]).values_list(
+                    "slug", "pk"
+                )
+            )
+            unknown = set(options["label"]) - set(labels)
+            if unknown:
+                raise CommandError(f"Unknown labels: {', '.join(sorted(unknown))}")
+            queryset = queryset.filter(
+                original_sample__label_summary__label_ids__overlap=list(labels.values())
+            )
+        if options["software"]:
+            queryset = queryset.filter(
+                original_sample__freeze_software__in=options["software"]
+            )
+        # From midnight in TIME_ZONE, compared with the column as it is so that
+        # the freeze_time index can be used.
+        for option, lookup in [
+            ("after", "original_sample__freeze_time__gte"),
+            ("before", "original_sample__freeze_time__lt"),
+        ]:
+            if options[option]:
+                midnight = datetime.combine(options[option], time.min)
+                queryset = queryset.filter(**{lookup: timezone.make_aware(midnight)})
+        return queryset
+
+    def save_checkpoint(self, path, job, timings):
+        if not path:
+            return
+        state = {"job": job.pk, "folder": job.folder, "timings": dict(timings)}
+        # Replaced in one go, an interruption never leaves half a file.
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+    def report(self, timings):
+        total = sum(timings.values())
+        for stage in STAGES:
+            seconds = timings.get(stage, 0)
+            share = 100 * seconds / total if total else 0
+            self.stdout.write(f"{stage:>10}: {seconds:8.2f}s ({share:3.0f}%)")
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fta.samples.models import Sample, SampleSignature
+from fta.samples.similarity import page_minhash
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute near duplicate signatures for samples that don't have one yet "
+        "(e.g. from before they were introduced, or streamed to the blob store), "
+        "in batches. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--recluster",
+            action="store_true",
+            help="Also redo every cluster, e.g. after NEAR_DUPLICATE_THRESHOLD changed.",
+        )
+
+    def handle(self, *args, **options):
+        unsigned = Sample.objects.filter(signature=None).order_by("pk")
+        last_pk = 0
+        indexed = 0
+        while True:
+            batch = list(
+                unsigned.filter(pk__gt=last_pk).only("pk", "frozen_page")[
+                    : options["batch_size"]
+                ]
+            )
+            if not batch:
+                break
+            minhashes = [page_minhash(sample.frozen_page) for sample in batch]
+            SampleSignature.objects.index(batch, minhashes)
+            last_pk = batch[-1].pk
+            indexed += len(batch)
+            self.stdout.write(f"Indexed {indexed} samples (up to id {last_pk})")
+
+        if options["recluster"]:
+            with transaction.atomic():
+                SampleSignature.objects.update(cluster=None)
+                # In id order, so every cluster ends up named after its first sample.
+                for signature in SampleSignature.objects.order_by("pk").iterator():
+                    signature.join_cluster()
+            self.stdout.write("Reclustered all samples")
+        self.stdout.write(self.style.SUCCESS(f"Done, {indexed} samples indexed."))
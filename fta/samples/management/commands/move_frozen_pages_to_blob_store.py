@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fta.samples.blobs import ContentAddressedStore
+from fta.samples.models import Sample
+
+
+class Command(BaseCommand):
+    help = (
+        "Move frozen pages that are still stored inline into the content-addressed "
+        "blob store, in batches. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+
+    def handle(self, *args, **options):
+        if settings.FROZEN_PAGE_STORAGE != "blob":
+            self.stderr.write(
+                "FROZEN_PAGE_STORAGE is not 'blob': moved pages will be written back "
+                "inline the next time their sample is saved."
+            )
+        store = ContentAddressedStore()
+        inline = Sample.objects.exclude(frozen_page="").order_by("pk")
+        last_pk = 0
+        moved = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    inline.filter(pk__gt=last_pk)
+                    .select_for_update()
+                    .only("pk", "frozen_page")[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+                for sample in batch:
+                    content = sample.frozen_page.encode("utf-8")
+                    digest = store.put(content)
+                    # update() skips the pre_save guard, the page itself is unchanged.
+                    Sample.objects.filter(pk=sample.pk).update(
+                        frozen_page="",
+                        frozen_page_sha256=digest,
+                        page_size=len(content),
+                    )
+            last_pk = batch[-1].pk
+            moved += len(batch)
+            self.stdout.write(f"Moved {moved} pages (up to id {last_pk})")
+        self.stdout.write(self.style.SUCCESS(f"Done, {moved} pages moved."))
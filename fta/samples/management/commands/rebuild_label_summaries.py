@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from fta.samples.models import Sample, SampleLabelSummary
+
+
+class Command(BaseCommand):
+    help = (
+        "Recreate every SampleLabelSummary row from the labeled samples. The rows "
+        "are kept up to date by triggers, this is for repairs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Existing rows are overwritten in place so readers never see gaps.
+        SampleLabelSummary.objects.exclude(
+            sample__in=Sample.objects.values("pk")
+        ).delete()
+        sample_ids = Sample.objects.order_by("pk").values_list("pk", flat=True)
+        last_pk = 0
+        rebuilt = 0
+        while True:
+            batch = list(sample_ids.filter(pk__gt=last_pk)[: options["batch_size"]])
+            if not batch:
+                break
+            # samples_refresh_label_summary is created in migration 0014
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT samples_refresh_label_summary(id) "
+                    "FROM unnest(%s::integer[]) AS id",
+                    [batch],
+                )
+            last_pk = batch[-1]
+            rebuilt += len(batch)
+            self.stdout.write(f"Rebuilt {rebuilt} summaries (up to id {last_pk})")
+        self.stdout.write(self.style.SUCCESS(f"Done, {rebuilt} summaries rebuilt."))
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fta.samples.exports import claim_export_job, describe_diff, run_export_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued fathom export jobs. Jobs checkpoint after every sample, "
+        "so an interrupted job resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no more queued jobs instead of polling.",
+        )
+        parser.add_argument("--poll-interval", type=float, default=5.0)
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Processes converting samples, defaults to EXPORT_WORKERS.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_export_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+            self.stdout.write(
+                f"Export job {job.pk}: {job.processed}/{job.total} done, "
+                f"changes since the last export: {describe_diff(job.diff)}"
+            )
+            try:
+                job = run_export_job(
+                    job, batch_size=options["batch_size"], workers=options["workers"]
+                )
+            except Exception as e:
+                self.stderr.write(f"Export job {job.pk} failed: {e!r}")
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(f"Export job {job.pk} exported to {job.folder}")
+            )
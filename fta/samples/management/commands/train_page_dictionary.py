@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from fta.samples.compression import CODECS, train_dictionary
+from fta.samples.models import CompressionDictionary, Sample
+
+
+class Command(BaseCommand):
+    help = (
+        "Train a compression dictionary on a random sample of frozen pages. Set "
+        "DJANGO_PAGE_COMPRESSION_DICTIONARY to its id to compress new pages with it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--codec",
+            choices=list(CODECS),
+            default=(
+                settings.PAGE_COMPRESSION
+                if settings.PAGE_COMPRESSION in CODECS
+                else "zlib"
+            ),
+        )
+        parser.add_argument("--samples", type=int, default=500)
+        parser.add_argument("--size", type=int, default=112 * 1024)
+
+    def handle(self, *args, **options):
+        pages = [
+            sample.frozen_page.encode("utf-8")
+            for sample in Sample.objects.order_by("?").only(
+                "pk", "frozen_page", "frozen_page_sha256"
+            )[: options["samples"]]
+        ]
+        data = train_dictionary(pages, options["codec"], size=options["size"])
+        dictionary = CompressionDictionary.objects.create(
+            codec=options["codec"], data=data, samples=len(pages)
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Trained {dictionary} on {len(pages)} pages, "
+                f"set DJANGO_PAGE_COMPRESSION_DICTIONARY={dictionary.pk} to use it."
+            )
+        )
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+import fta.samples.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0010_auto_20210115_0859'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sample',
+            name='frozen_page_sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text="This is updated on save, don't bother manually changing.", max_length=64, null=True, verbose_name='SHA-256 of frozen page'),
+        ),
+        migrations.AlterField(
+            model_name='labeledsample',
+            name='superseded_by',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='superseded_labeled_samples', to='samples.LabeledSample'),
+        ),
+        migrations.AlterField(
+            model_name='sample',
+            name='frozen_page',
+            field=fta.samples.fields.ContentAddressedTextField(hash_field='frozen_page_sha256', verbose_name='Frozen page'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:11
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0011_sample_frozen_page_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labeledsample',
+            name='fta_id_patches',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='data-fta_id attributes to set on the original sample, as [tag, position, fta_id] entries. Used instead of modified_sample.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='labeledsample',
+            name='modified_sample',
+            field=models.TextField(blank=True, help_text='Sample page modified with labeling ids. This is mutable. Empty when the page is stored as fta id patches.'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0012_labeledsample_fta_id_patches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder', models.CharField(help_text='Folder in the media storage the samples are exported to.', max_length=200)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExportJobItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('split', models.CharField(max_length=20)),
+                ('done', models.BooleanField(default=False)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='samples.ExportJob')),
+                ('labeled_sample', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='samples.LabeledSample')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='exportjobitem',
+            index=models.Index(fields=['job', 'done'], name='samples_exp_job_id_f5c6fe_idx'),
+        ),
+    ]
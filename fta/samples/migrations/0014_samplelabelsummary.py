@@ -0,0 +1,176 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:18
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Keeps samples_samplelabelsummary in step with the tables it summarizes. The
+# statement level triggers use transition tables, so each bulk write refreshes
+# every affected sample once. Requires PostgreSQL 10+.
+CREATE_TRIGGERS = """
+CREATE FUNCTION samples_refresh_label_summary(sample integer) RETURNS void AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM samples_sample WHERE id = sample) THEN
+        DELETE FROM samples_samplelabelsummary WHERE sample_id = sample;
+        RETURN;
+    END IF;
+    INSERT INTO samples_samplelabelsummary
+        (sample_id, labeled_sample_id, label_ids, label_slugs, nlabels)
+    SELECT
+        sample,
+        current.id,
+        COALESCE(array_agg(DISTINCT label.id) FILTER (WHERE label.id IS NOT NULL), '{}'),
+        COALESCE(array_agg(DISTINCT label.slug) FILTER (WHERE label.id IS NOT NULL), '{}'),
+        count(element.id)
+    FROM (SELECT sample AS id) this_sample
+    LEFT JOIN LATERAL (
+        SELECT id FROM samples_labeledsample
+        WHERE original_sample_id = this_sample.id AND superseded_by_id IS NULL
+        ORDER BY id DESC LIMIT 1
+    ) current ON true
+    LEFT JOIN samples_labeledelement element ON element.labeled_sample_id = current.id
+    LEFT JOIN samples_label label ON label.id = element.label_id
+    GROUP BY current.id
+    ON CONFLICT (sample_id) DO UPDATE SET
+        labeled_sample_id = EXCLUDED.labeled_sample_id,
+        label_ids = EXCLUDED.label_ids,
+        label_slugs = EXCLUDED.label_slugs,
+        nlabels = EXCLUDED.nlabels;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_sample_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM samples_refresh_label_summary(id) FROM new_rows;
+    ELSE
+        DELETE FROM samples_samplelabelsummary
+        WHERE sample_id IN (SELECT id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_labeledsample_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM samples_refresh_label_summary(original_sample_id)
+        FROM (SELECT DISTINCT original_sample_id FROM new_rows) changed;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM samples_refresh_label_summary(original_sample_id)
+        FROM (SELECT DISTINCT original_sample_id FROM old_rows) changed;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_labeledelement_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM samples_refresh_label_summary(original_sample_id)
+        FROM (
+            SELECT DISTINCT labeled_sample.original_sample_id
+            FROM new_rows
+            JOIN samples_labeledsample labeled_sample
+                ON labeled_sample.id = new_rows.labeled_sample_id
+        ) changed;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM samples_refresh_label_summary(original_sample_id)
+        FROM (
+            SELECT DISTINCT labeled_sample.original_sample_id
+            FROM old_rows
+            JOIN samples_labeledsample labeled_sample
+                ON labeled_sample.id = old_rows.labeled_sample_id
+        ) changed;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_label_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM samples_refresh_label_summary(sample_id)
+    FROM samples_samplelabelsummary
+    WHERE label_ids @> ARRAY[NEW.id];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_sample_inserted AFTER INSERT ON samples_sample
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_sample_changed();
+CREATE TRIGGER samples_sample_deleted AFTER DELETE ON samples_sample
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_sample_changed();
+
+CREATE TRIGGER samples_labeledsample_inserted AFTER INSERT ON samples_labeledsample
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledsample_changed();
+CREATE TRIGGER samples_labeledsample_updated AFTER UPDATE ON samples_labeledsample
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledsample_changed();
+CREATE TRIGGER samples_labeledsample_deleted AFTER DELETE ON samples_labeledsample
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledsample_changed();
+
+CREATE TRIGGER samples_labeledelement_inserted AFTER INSERT ON samples_labeledelement
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_changed();
+CREATE TRIGGER samples_labeledelement_updated AFTER UPDATE ON samples_labeledelement
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_changed();
+CREATE TRIGGER samples_labeledelement_deleted AFTER DELETE ON samples_labeledelement
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_changed();
+
+CREATE TRIGGER samples_label_updated AFTER UPDATE OF slug ON samples_label
+    FOR EACH ROW EXECUTE PROCEDURE samples_label_changed();
+
+SELECT samples_refresh_label_summary(id) FROM samples_sample;
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER samples_sample_inserted ON samples_sample;
+DROP TRIGGER samples_sample_deleted ON samples_sample;
+DROP TRIGGER samples_labeledsample_inserted ON samples_labeledsample;
+DROP TRIGGER samples_labeledsample_updated ON samples_labeledsample;
+DROP TRIGGER samples_labeledsample_deleted ON samples_labeledsample;
+DROP TRIGGER samples_labeledelement_inserted ON samples_labeledelement;
+DROP TRIGGER samples_labeledelement_updated ON samples_labeledelement;
+DROP TRIGGER samples_labeledelement_deleted ON samples_labeledelement;
+DROP TRIGGER samples_label_updated ON samples_label;
+DROP FUNCTION samples_sample_changed();
+DROP FUNCTION samples_labeledsample_changed();
+DROP FUNCTION samples_labeledelement_changed();
+DROP FUNCTION samples_label_changed();
+DROP FUNCTION samples_refresh_label_summary(integer);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0013_exportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SampleLabelSummary',
+            fields=[
+                ('sample', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='label_summary', serialize=False, to='samples.Sample')),
+                ('label_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('label_slugs', django.contrib.postgres.fields.ArrayField(base_field=models.SlugField(), default=list, size=None)),
+                ('nlabels', models.IntegerField(db_index=True, default=0, help_text='Number of labeled elements')),
+                ('labeled_sample', models.ForeignKey(db_constraint=False, help_text='Current labeled sample of the sample', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='samples.LabeledSample')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='samplelabelsummary',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['label_ids'], name='samples_sam_label_i_8cc48a_gin'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations
+
+
+# Backs up the pre_save guard on Sample for writes that skip it, like
+# QuerySet.update(). It only fires when one of the guarded columns is in the
+# UPDATE, so notes edits don't pay for it. Moving the page between the row and
+# the blob store is allowed as long as the content (its SHA-256) stays the same.
+# Requires PostgreSQL 11+ for sha256().
+CREATE_TRIGGER = """
+CREATE FUNCTION samples_sample_immutable() RETURNS trigger AS $$
+DECLARE
+    digest varchar(64) := COALESCE(
+        OLD.frozen_page_sha256,
+        encode(sha256(convert_to(OLD.frozen_page, 'UTF8')), 'hex')
+    );
+BEGIN
+    IF NEW.url IS DISTINCT FROM OLD.url
+        OR NEW.freeze_time IS DISTINCT FROM OLD.freeze_time
+        OR NEW.freeze_software IS DISTINCT FROM OLD.freeze_software
+        OR NEW.frozen_page_sha256 IS DISTINCT FROM digest
+            AND NOT (NEW.frozen_page_sha256 IS NULL AND OLD.frozen_page_sha256 IS NULL)
+        OR NEW.frozen_page = '' AND NEW.frozen_page_sha256 IS NULL
+        OR NEW.frozen_page <> ''
+            AND encode(sha256(convert_to(NEW.frozen_page, 'UTF8')), 'hex') <> digest
+    THEN
+        RAISE EXCEPTION 'Only notes can be changed after initial creation.'
+            USING ERRCODE = 'integrity_constraint_violation',
+                  DETAIL = format('Sample %s', OLD.id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_sample_immutable
+BEFORE UPDATE OF frozen_page, frozen_page_sha256, url, freeze_time, freeze_software
+ON samples_sample
+FOR EACH ROW EXECUTE PROCEDURE samples_sample_immutable();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER samples_sample_immutable ON samples_sample;
+DROP FUNCTION samples_sample_immutable();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0014_samplelabelsummary'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,151 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:27
+
+from django.db import migrations, models
+import fta.samples.fields
+from fta.samples.compression import decompress_page
+
+
+# The page columns become bytea. Existing pages are kept as their UTF-8 bytes,
+# which CompressedTextField reads as they are; compress_pages compresses them.
+# The immutability trigger has to go while the column type changes, and can
+# only check the content of pages that aren't compressed afterwards. For
+# compressed ones it relies on the SHA-256 the application writes.
+TO_BYTEA = """
+DROP TRIGGER samples_sample_immutable ON samples_sample;
+
+ALTER TABLE samples_sample
+    ALTER COLUMN frozen_page TYPE bytea USING convert_to(frozen_page, 'UTF8');
+ALTER TABLE samples_labeledsample
+    ALTER COLUMN modified_sample TYPE bytea USING convert_to(modified_sample, 'UTF8');
+
+-- Digest of a page stored uncompressed, NULL for compressed or empty pages.
+CREATE FUNCTION samples_page_sha256(page bytea) RETURNS varchar AS $$
+    SELECT CASE WHEN length(page) > 0 AND get_byte(page, 0) <> 0
+        THEN encode(sha256(page), 'hex') END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION samples_sample_immutable() RETURNS trigger AS $$
+DECLARE
+    digest varchar(64) := COALESCE(
+        OLD.frozen_page_sha256, samples_page_sha256(OLD.frozen_page)
+    );
+BEGIN
+    IF NEW.url IS DISTINCT FROM OLD.url
+        OR NEW.freeze_time IS DISTINCT FROM OLD.freeze_time
+        OR NEW.freeze_software IS DISTINCT FROM OLD.freeze_software
+        OR NEW.frozen_page_sha256 IS DISTINCT FROM OLD.frozen_page_sha256
+            AND (NEW.frozen_page_sha256 IS NULL OR NEW.frozen_page_sha256 <> digest)
+        OR NEW.frozen_page = '' AND NEW.frozen_page_sha256 IS NULL
+        OR NEW.frozen_page IS DISTINCT FROM OLD.frozen_page AND (
+            samples_page_sha256(NEW.frozen_page) <> digest
+            OR NEW.frozen_page <> '' AND NEW.frozen_page_sha256 IS NULL
+        )
+    THEN
+        RAISE EXCEPTION 'Only notes can be changed after initial creation.'
+            USING ERRCODE = 'integrity_constraint_violation',
+                  DETAIL = format('Sample %s', OLD.id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_sample_immutable
+BEFORE UPDATE OF frozen_page, frozen_page_sha256, url, freeze_time, freeze_software
+ON samples_sample
+FOR EACH ROW EXECUTE PROCEDURE samples_sample_immutable();
+"""
+
+TO_TEXT = """
+DROP TRIGGER samples_sample_immutable ON samples_sample;
+DROP FUNCTION samples_page_sha256(bytea);
+
+ALTER TABLE samples_sample
+    ALTER COLUMN frozen_page TYPE text USING convert_from(frozen_page, 'UTF8');
+ALTER TABLE samples_labeledsample
+    ALTER COLUMN modified_sample TYPE text USING convert_from(modified_sample, 'UTF8');
+
+CREATE OR REPLACE FUNCTION samples_sample_immutable() RETURNS trigger AS $$
+DECLARE
+    digest varchar(64) := COALESCE(
+        OLD.frozen_page_sha256,
+        encode(sha256(convert_to(OLD.frozen_page, 'UTF8')), 'hex')
+    );
+BEGIN
+    IF NEW.url IS DISTINCT FROM OLD.url
+        OR NEW.freeze_time IS DISTINCT FROM OLD.freeze_time
+        OR NEW.freeze_software IS DISTINCT FROM OLD.freeze_software
+        OR NEW.frozen_page_sha256 IS DISTINCT FROM digest
+            AND NOT (NEW.frozen_page_sha256 IS NULL AND OLD.frozen_page_sha256 IS NULL)
+        OR NEW.frozen_page = '' AND NEW.frozen_page_sha256 IS NULL
+        OR NEW.frozen_page <> ''
+            AND encode(sha256(convert_to(NEW.frozen_page, 'UTF8')), 'hex') <> digest
+    THEN
+        RAISE EXCEPTION 'Only notes can be changed after initial creation.'
+            USING ERRCODE = 'integrity_constraint_violation',
+                  DETAIL = format('Sample %s', OLD.id);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_sample_immutable
+BEFORE UPDATE OF frozen_page, frozen_page_sha256, url, freeze_time, freeze_software
+ON samples_sample
+FOR EACH ROW EXECUTE PROCEDURE samples_sample_immutable();
+"""
+
+
+def decompress_pages(apps, schema_editor):
+    # Going back to text columns, which can't hold compressed pages.
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in [
+            ("samples_sample", "frozen_page"),
+            ("samples_labeledsample", "modified_sample"),
+        ]:
+            cursor.execute(
+                f"SELECT id FROM {table} "
+                f"WHERE length({column}) > 0 AND get_byte({column}, 0) = 0"
+            )
+            for (pk,) in cursor.fetchall():
+                cursor.execute(f"SELECT {column} FROM {table} WHERE id = %s", [pk])
+                page = decompress_page(cursor.fetchone()[0])
+                cursor.execute(
+                    f"UPDATE {table} SET {column} = %s WHERE id = %s",
+                    [page.encode("utf-8"), pk],
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0015_sample_immutable_trigger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompressionDictionary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('codec', models.CharField(max_length=10)),
+                ('data', models.BinaryField()),
+                ('samples', models.IntegerField(help_text='Number of pages it was trained on.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunSQL(TO_BYTEA, TO_TEXT)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='sample',
+                    name='frozen_page',
+                    field=fta.samples.fields.ContentAddressedTextField(compressed=True, hash_field='frozen_page_sha256', verbose_name='Frozen page'),
+                ),
+                migrations.AlterField(
+                    model_name='labeledsample',
+                    name='modified_sample',
+                    field=fta.samples.fields.CompressedTextField(blank=True, help_text='Sample page modified with labeling ids. This is mutable. Empty when the page is stored as fta id patches.'),
+                ),
+            ],
+        ),
+        migrations.RunPython(migrations.RunPython.noop, decompress_pages),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0016_compressed_pages'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sample',
+            index=models.Index(fields=['freeze_software', 'id'], name='samples_sam_freeze__1fe548_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sample',
+            index=models.Index(fields=['freeze_time', 'id'], name='samples_sam_freeze__29c0bc_idx'),
+        ),
+    ]
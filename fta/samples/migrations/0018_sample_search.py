@@ -0,0 +1,71 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:36
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+# Sample.search_vector holds the words of the url, domain and notes, split on
+# anything that isn't a letter or digit so parts of urls can be searched for.
+# The "simple" configuration keeps them as they are, no stemming or stop
+# words. utils.search_terms() splits search text the same way. Existing rows
+# get their domain worked out like utils.url_domain() does, which fills in
+# their search_vector too.
+CREATE_TRIGGER = r"""
+CREATE FUNCTION samples_sample_search_vector(url varchar, domain varchar, notes text)
+RETURNS tsvector AS $$
+    SELECT to_tsvector('simple', regexp_replace(
+        lower(concat_ws(' ', url, domain, notes)), '[^[:alnum:]]+', ' ', 'g'
+    ))
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION samples_sample_search() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := samples_sample_search_vector(NEW.url, NEW.domain, NEW.notes);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_sample_search
+BEFORE INSERT OR UPDATE OF url, domain, notes, search_vector ON samples_sample
+FOR EACH ROW EXECUTE PROCEDURE samples_sample_search();
+
+UPDATE samples_sample SET domain = COALESCE(regexp_replace(
+    lower(substring(url from '^[^:/?#]+://(?:[^@/?#]*@)?([^:/?#]*)')), '^www\.', ''
+), '');
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER samples_sample_search ON samples_sample;
+DROP FUNCTION samples_sample_search();
+DROP FUNCTION samples_sample_search_vector(varchar, varchar, text);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0017_sample_api_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sample',
+            name='domain',
+            field=models.CharField(blank=True, default='', editable=False, max_length=253, verbose_name='Domain of frozen page'),
+        ),
+        migrations.AddField(
+            model_name='sample',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.AddIndex(
+            model_name='sample',
+            index=models.Index(fields=['domain', 'id'], name='samples_sam_domain_bb1833_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sample',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='samples_sam_search__7ba8d3_gin'),
+        ),
+    ]
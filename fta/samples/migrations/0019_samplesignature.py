@@ -0,0 +1,29 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:39
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0018_sample_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SampleSignature',
+            fields=[
+                ('sample', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='signature', serialize=False, to='samples.Sample')),
+                ('minhash', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('lsh_keys', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('cluster', models.IntegerField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='samplesignature',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['lsh_keys'], name='samples_sam_lsh_key_af07f3_gin'),
+        ),
+    ]
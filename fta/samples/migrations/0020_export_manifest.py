@@ -0,0 +1,134 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:42
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+# LabeledSample.version goes up whenever what an export would write for it
+# changes: its page or patches, its labeled elements, or the slug of one of
+# their labels. It never goes down, whatever a save() sends. Element changes
+# are handled per statement, so a bulk write bumps each labeled sample it
+# touches once per statement.
+CREATE_TRIGGERS = """
+CREATE FUNCTION samples_labeledsample_versioned() RETURNS trigger AS $$
+BEGIN
+    IF NEW.modified_sample IS DISTINCT FROM OLD.modified_sample
+        OR NEW.fta_id_patches IS DISTINCT FROM OLD.fta_id_patches
+    THEN
+        NEW.version := OLD.version + 1;
+    ELSIF NEW.version < OLD.version THEN
+        -- A save() of an instance loaded before a bump
+        NEW.version := OLD.version;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_labeledelement_versioned() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE samples_labeledsample SET version = version + 1
+        WHERE id IN (SELECT labeled_sample_id FROM new_rows);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE samples_labeledsample SET version = version + 1
+        WHERE id IN (SELECT labeled_sample_id FROM old_rows);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION samples_label_versioned() RETURNS trigger AS $$
+BEGIN
+    IF NEW.slug IS DISTINCT FROM OLD.slug THEN
+        UPDATE samples_labeledsample SET version = version + 1
+        WHERE id IN (
+            SELECT labeled_sample_id FROM samples_labeledelement WHERE label_id = NEW.id
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER samples_labeledsample_versioned
+BEFORE UPDATE ON samples_labeledsample
+    FOR EACH ROW EXECUTE PROCEDURE samples_labeledsample_versioned();
+
+CREATE TRIGGER samples_labeledelement_versioned_inserted
+AFTER INSERT ON samples_labeledelement
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_versioned();
+CREATE TRIGGER samples_labeledelement_versioned_updated
+AFTER UPDATE ON samples_labeledelement
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_versioned();
+CREATE TRIGGER samples_labeledelement_versioned_deleted
+AFTER DELETE ON samples_labeledelement
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE samples_labeledelement_versioned();
+
+CREATE TRIGGER samples_label_versioned AFTER UPDATE OF slug ON samples_label
+    FOR EACH ROW EXECUTE PROCEDURE samples_label_versioned();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER samples_labeledsample_versioned ON samples_labeledsample;
+DROP TRIGGER samples_labeledelement_versioned_inserted ON samples_labeledelement;
+DROP TRIGGER samples_labeledelement_versioned_updated ON samples_labeledelement;
+DROP TRIGGER samples_labeledelement_versioned_deleted ON samples_labeledelement;
+DROP TRIGGER samples_label_versioned ON samples_label;
+DROP FUNCTION samples_labeledsample_versioned();
+DROP FUNCTION samples_labeledelement_versioned();
+DROP FUNCTION samples_label_versioned();
+"""
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0019_samplesignature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='base',
+            field=models.ForeignKey(blank=True, help_text='Earlier export whose files are reused for unchanged samples.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='samples.ExportJob'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='diff',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Number of samples added, changed, unchanged and removed since base.', null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='name',
+            field=models.CharField(blank=True, max_length=300),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='reused_from',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='samples.ExportJobItem'),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='version',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='labeledsample',
+            name='version',
+            field=models.IntegerField(default=1, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='exportjobitem',
+            index=models.Index(fields=['job', 'labeled_sample'], name='samples_exp_job_id_f51667_idx'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0020_export_manifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FathomArtifact',
+            fields=[
+                ('labeled_sample', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='fathom_artifact', serialize=False, to='samples.LabeledSample')),
+                ('version', models.IntegerField()),
+                ('suffix', models.CharField(max_length=20)),
+                ('sha256', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0021_fathomartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='format',
+            field=models.CharField(choices=[('files', 'One file per sample'), ('packed', 'Packs with an offset index')], default='files', help_text='Packed exports put each split in a few large files, see packs.py.', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='offset',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='pack',
+            field=models.CharField(blank=True, max_length=300),
+        ),
+        migrations.AddField(
+            model_name='exportjobitem',
+            name='size',
+            field=models.IntegerField(null=True),
+        ),
+    ]
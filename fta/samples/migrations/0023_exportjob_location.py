@@ -0,0 +1,18 @@
+# Generated by Django 3.0.10 on 2026-10-18 19:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0022_packed_exports'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='location',
+            field=models.CharField(blank=True, help_text='Local folder exported to instead of the media storage.', max_length=500),
+        ),
+    ]
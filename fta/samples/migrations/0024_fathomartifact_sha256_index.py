@@ -0,0 +1,18 @@
+# Generated by Django 3.0.10 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('samples', '0023_exportjob_location'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fathomartifact',
+            name='sha256',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+    ]
@@ -1,32 +1,93 @@
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models.functions import Coalesce
 from django.dispatch import receiver
+from django.utils.functional import cached_property
+
+from .blobs import sha256_hexdigest
+from .caching import bump_generation
+from .fields import CompressedTextField, ContentAddressedTextField
+from .similarity import lsh_keys, page_minhash, similarity
+from .utils import (
+    apply_fta_id_patches,
+    compute_fta_id_patches,
+    search_terms,
+    url_domain,
+)
 
 # These are the freezers we know how to parse the meta data from
 SAMPLE_SOFTWARE_PARSERS = (("SingleFile", "SingleFile"), ("freezedry", "freezedry"))
 
 
-class SampleManager(models.Manager):
-    def get_queryset(self):
+class SampleQuerySet(models.QuerySet):
+    def slim(self):
+        # Everything but the page body, for lists and lookups that don't need it.
+        return self.defer("frozen_page", "search_vector")
+
+    def detail(self):
+        return self.all()
+
+    def with_label_stats(self):
+        # Labels of the current labeled sample, from SampleLabelSummary.
+        return self.annotate(
+            nlabels=Coalesce("label_summary__nlabels", 0),
+            label_slugs=models.F("label_summary__label_slugs"),
+        )
+
+    def search(self, text):
+        # Every word has to prefix a word of the url, domain or notes, so
+        # "example.com" finds https://www.example.com/ and "exam" does too.
+        terms = search_terms(text)
+        if not terms:
+            return self
+        query = " & ".join(f"{term}:*" for term in terms)
+        return self.filter(
+            search_vector=SearchQuery(query, config="simple", search_type="raw")
+        )
+
+    def domain_facets(self, limit=20):
+        # The most common domains and their counts, read off the domain index.
         return (
-            super()
-            .get_queryset()
-            .prefetch_related("labeled_sample__labeled_elements")
-            .annotate(nlabels=models.Count("labeled_sample__labeled_elements"))
+            self.order_by()
+            .values("domain")
+            .annotate(count=models.Count("id"))
+            .order_by("-count", "domain")[:limit]
         )
 
 
+SampleManager = models.Manager.from_queryset(SampleQuerySet)
+
+# Fields of a Sample that are fixed once it is created.
+IMMUTABLE_SAMPLE_FIELDS = ("frozen_page", "url", "freeze_time", "freeze_software")
+
+
 # Create your models here.
 class Sample(models.Model):
-    # We are using binary fields for simplicity for the time being.
-    # May want to change to external storage later.
+    # The page body is either stored inline or, with FROZEN_PAGE_STORAGE set
+    # to "blob", in the content-addressed blob store. See fields.py.
 
     objects = SampleManager()
 
     # Required
-    frozen_page = models.TextField(
+    frozen_page = ContentAddressedTextField(
         verbose_name="Frozen page",
         blank=False,
         max_length=None,
+        hash_field="frozen_page_sha256",
+        compressed=True,
+    )
+    frozen_page_sha256 = models.CharField(
+        verbose_name="SHA-256 of frozen page",
+        help_text="This is updated on save, don't bother manually changing.",
+        max_length=64,
+        blank=True,
+        null=True,
+        editable=False,
+        db_index=True,
     )
     url = models.URLField(
         verbose_name="Url of frozen page",
@@ -58,27 +119,90 @@ class Sample(models.Model):
     page_height = models.IntegerField(
         verbose_name="Page height in pixels", blank=True, null=True
     )
+    # Derived from the url on creation
+    domain = models.CharField(
+        verbose_name="Domain of frozen page",
+        max_length=253,
+        blank=True,
+        default="",
+        editable=False,
+    )
+    # Words of the url, domain and notes. Maintained by the
+    # samples_sample_search trigger, see migration 0018.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        # For the API's filters, ending in id so a filtered page of results
+        # can be read straight off the index.
+        indexes = [
+            models.Index(fields=["freeze_software", "id"]),
+            models.Index(fields=["freeze_time", "id"]),
+            models.Index(fields=["domain", "id"]),
+            GinIndex(fields=["search_vector"]),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.take_snapshot()
+        return instance
+
+    def take_snapshot(self):
+        # What the immutable fields looked like when loaded, for the pre_save
+        # guard. Only references are kept, nothing is copied or hashed.
+        self._loaded_values = {
+            name: self.__dict__[name]
+            for name in IMMUTABLE_SAMPLE_FIELDS + ("frozen_page_sha256",)
+            if name in self.__dict__
+        }
 
     def save(self, *args, **kwargs):
-        self.page_size = len(self.frozen_page.encode("utf-8"))
+        if self._state.adding:
+            # Streamed uploads come with their size, don't read them back for it.
+            if not self._meta.get_field("frozen_page").has_stored_blob(self):
+                self.page_size = len(self.frozen_page.encode("utf-8"))
+            self.domain = url_domain(self.url)
+        elif kwargs.get("update_fields") is None:
+            # The page and its metadata can't change, so leave them out of
+            # the UPDATE instead of sending the page back.
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.attname
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.attname not in IMMUTABLE_SAMPLE_FIELDS
+                and field.attname
+                not in ("frozen_page_sha256", "page_size", "domain", "search_vector")
+                and field.attname not in deferred
+            ]
         super().save(*args, **kwargs)
+        self.take_snapshot()
 
 
 @receiver(models.signals.pre_save, sender=Sample)
 def prevent_updating_of_frozen_page_and_data(sender, instance, **kwargs):
-    try:
-        obj = sender.objects.get(pk=instance.pk)
-    except sender.DoesNotExist:
-        pass  # Initial save -- do nothing
-    else:
-        if (
-            (obj.frozen_page != instance.frozen_page)
-            or (obj.url != instance.url)
-            or (obj.freeze_time != instance.freeze_time)
-            or (obj.freeze_software != instance.freeze_software)
-        ):
+    # Checked against the snapshot taken when the instance was loaded. Anything
+    # that gets past this (bulk updates, instances built by hand) is caught by
+    # the samples_sample_immutable trigger, see migration 0015.
+    loaded = getattr(instance, "_loaded_values", None)
+    if loaded is None:
+        return  # Initial save -- do nothing
+    for name in IMMUTABLE_SAMPLE_FIELDS:
+        if name not in instance.__dict__:
+            continue  # Deferred and never touched
+        current = instance.__dict__[name]
+        if name == "frozen_page" and current is not loaded.get(name):
+            # Loaded later, from the blob store or an assignment: compare hashes.
+            digest = loaded.get("frozen_page_sha256")
+            if digest is None:
+                changed = name in loaded and current != loaded[name]
+            else:
+                changed = sha256_hexdigest(current.encode("utf-8")) != digest
+        else:
+            changed = name in loaded and current != loaded[name]
+        if changed:
             raise models.ProtectedError(
-                "Only notes can be changed after initial creation."
+                "Only notes can be changed after initial creation.", [instance]
             )
 
 
@@ -114,15 +238,242 @@ class LabeledSample(models.Model):
         null=True,
     )
 
-    modified_sample = models.TextField(
-        help_text="Sample page modified with labeling ids. This is mutable.",
-        blank=False,
+    modified_sample = CompressedTextField(
+        help_text=(
+            "Sample page modified with labeling ids. This is mutable. "
+            "Empty when the page is stored as fta id patches."
+        ),
+        blank=True,
         max_length=None,
     )
 
+    fta_id_patches = JSONField(
+        help_text=(
+            "data-fta_id attributes to set on the original sample, as "
+            "[tag, position, fta_id] entries. Used instead of modified_sample."
+        ),
+        blank=True,
+        null=True,
+    )
+
+    # Bumped by triggers whenever the page, its labels or their slugs change,
+    # see migration 0020. Exports reuse what they wrote for an unchanged one.
+    version = models.IntegerField(default=1, editable=False)
+
     def __str__(self):
         return f"{self.original_sample.pk} - {self.original_sample.url}"
 
+    @cached_property
+    def materialized_sample(self):
+        # The modified sample page, whichever way it is stored.
+        if self.fta_id_patches is None:
+            return self.modified_sample
+        return apply_fta_id_patches(
+            self.original_sample.frozen_page, self.fta_id_patches
+        )
+
+    def set_modified_sample(self, page):
+        # Stores `page` as patches against the original sample when it can.
+        patches = compute_fta_id_patches(self.original_sample.frozen_page, page)
+        if patches is None:
+            self.modified_sample = page
+        else:
+            self.modified_sample = ""
+        self.fta_id_patches = patches
+        self.materialized_sample = page
+
+    def set_labels(self, fta_id_to_slug):
+        # Labels elements by their fta id in a fixed number of queries,
+        # overriding any label an element already has.
+        fta_id_to_slug = {str(fta_id): slug for fta_id, slug in fta_id_to_slug.items()}
+        if not fta_id_to_slug:
+            return
+        slugs = set(fta_id_to_slug.values())
+        with transaction.atomic():
+            Label.objects.bulk_create(
+                [Label(slug=slug) for slug in slugs], ignore_conflicts=True
+            )
+            label_ids = dict(
+                Label.objects.filter(slug__in=slugs).values_list("slug", "pk")
+            )
+            fta_ids = list(fta_id_to_slug)
+            # bulk_create can't update on conflict (yet), so upsert by hand.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {LabeledElement._meta.db_table}
+                        (labeled_sample_id, data_fta_id, label_id)
+                    SELECT %s, fta_id, label_id
+                    FROM unnest(%s::varchar[], %s::integer[]) AS t(fta_id, label_id)
+                    ON CONFLICT (data_fta_id, labeled_sample_id)
+                    DO UPDATE SET label_id = EXCLUDED.label_id
+                    """,
+                    [
+                        self.pk,
+                        fta_ids,
+                        [label_ids[fta_id_to_slug[fta_id]] for fta_id in fta_ids],
+                    ],
+                )
+            bump_generation("samples.label", "samples.labeledelement")
+
+
+class FathomArtifact(models.Model):
+    """
+    A labeled sample as exported for fathom, kept in the blob store so exports
+    only copy bytes. Current while its version is the labeled sample's, see
+    artifacts.py.
+    """
+
+    labeled_sample = models.OneToOneField(
+        to=LabeledSample,
+        primary_key=True,
+        related_name="fathom_artifact",
+        on_delete=models.CASCADE,
+    )
+    version = models.IntegerField()
+    # ".n.html" for samples without labels, ".html" otherwise
+    suffix = models.CharField(max_length=20)
+    # Indexed, to tell whether a blob is still used.
+    sha256 = models.CharField(max_length=64, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.labeled_sample_id} v{self.version}"
+
+
+class SampleLabelSummary(models.Model):
+    """
+    Labels of the current labeled sample of each sample, for cheap filtering
+    and counting. Rows are maintained by database triggers on the sample,
+    labeled sample, labeled element and label tables, see migration 0014.
+    Run rebuild_label_summaries to recreate them from scratch.
+    """
+
+    sample = models.OneToOneField(
+        to=Sample,
+        primary_key=True,
+        related_name="label_summary",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+    labeled_sample = models.ForeignKey(
+        to=LabeledSample,
+        related_name="+",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        help_text="Current labeled sample of the sample",
+    )
+    label_ids = ArrayField(models.IntegerField(), default=list)
+    label_slugs = ArrayField(models.SlugField(), default=list)
+    nlabels = models.IntegerField(
+        default=0, db_index=True, help_text="Number of labeled elements"
+    )
+
+    class Meta:
+        indexes = [GinIndex(fields=["label_ids"])]
+
+    def __str__(self):
+        return f"{self.sample_id} - {', '.join(self.label_slugs)}"
+
+
+class SampleSignatureManager(models.Manager):
+    def index(self, samples, minhashes):
+        # Stores the signatures of new samples and puts each in the cluster of
+        # its near duplicates, if it has any.
+        signatures = [
+            SampleSignature(sample=sample, minhash=minhash, lsh_keys=lsh_keys(minhash))
+            for sample, minhash in zip(samples, minhashes)
+        ]
+        with transaction.atomic():
+            self.bulk_create(signatures)
+            for signature in signatures:
+                signature.join_cluster()
+        return signatures
+
+    def clusters(self):
+        # One row per cluster, in order of cluster id (its first sample).
+        return (
+            self.exclude(cluster=None)
+            .order_by("cluster")
+            .values("cluster")
+            .annotate(
+                size=models.Count("sample_id"),
+                samples=ArrayAgg("sample_id", ordering="sample_id"),
+            )
+        )
+
+
+class SampleSignature(models.Model):
+    """
+    MinHash signature of a sample's page and its LSH keys, see similarity.py.
+    Samples whose signatures are at least NEAR_DUPLICATE_THRESHOLD similar
+    share a cluster, named after the lowest sample id in it. Written when a
+    sample is created, index_near_duplicates fills in the rest.
+    """
+
+    objects = SampleSignatureManager()
+
+    sample = models.OneToOneField(
+        to=Sample,
+        primary_key=True,
+        related_name="signature",
+        on_delete=models.CASCADE,
+    )
+    minhash = ArrayField(models.BigIntegerField())
+    lsh_keys = ArrayField(models.BigIntegerField())
+    cluster = models.IntegerField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [GinIndex(fields=["lsh_keys"])]
+
+    def __str__(self):
+        return f"{self.sample_id} - {self.cluster or '-'}"
+
+    def join_cluster(self):
+        # Candidates share an LSH key, found through the GIN index.
+        candidates = (
+            SampleSignature.objects.filter(lsh_keys__overlap=self.lsh_keys)
+            .exclude(pk=self.pk)
+            .values_list("sample_id", "minhash", "cluster")
+        )
+        matches = {}
+        for sample_id, minhash, cluster in candidates:
+            if similarity(self.minhash, minhash) >= settings.NEAR_DUPLICATE_THRESHOLD:
+                matches[sample_id] = cluster or sample_id
+        if not matches:
+            return
+        # Merges every cluster this sample bridges.
+        self.cluster = min(min(matches.values()), self.pk)
+        SampleSignature.objects.filter(
+            models.Q(pk__in=[self.pk, *matches])
+            | models.Q(cluster__in=set(matches.values()))
+        ).update(cluster=self.cluster)
+
+
+@receiver(models.signals.post_save, sender=Sample)
+def index_new_sample(sender, instance, created, raw=False, **kwargs):
+    if not created or raw:
+        return
+    # Uploads come with their signature, worked out as they were streamed in.
+    minhash = getattr(instance, "minhash", None)
+    if minhash is None:
+        # A page already in the blob store isn't read back just for this,
+        # index_near_duplicates picks it up.
+        if Sample._meta.get_field("frozen_page").has_stored_blob(instance):
+            return
+        minhash = page_minhash(instance.frozen_page)
+    SampleSignature.objects.index([instance], [minhash])
+
+
+@receiver(models.signals.post_delete, sender=Sample)
+def remove_response_variants(sender, instance, **kwargs):
+    # The API responses stored for the sample. Only a cache, it doesn't wait
+    # for the transaction to commit.
+    from .api.caching import SampleResponseVariants
+
+    SampleResponseVariants().remove_stale(instance.pk)
+
 
 class Label(models.Model):
     slug = models.SlugField(
@@ -175,3 +526,132 @@ class LabeledElement(models.Model):
 
     def __str__(self):
         return f"{self.labeled_sample.pk} - {self.label} - {self.data_fta_id}"
+
+
+@receiver(models.signals.post_save, sender=Sample)
+@receiver(models.signals.post_delete, sender=Sample)
+@receiver(models.signals.post_save, sender=LabeledSample)
+@receiver(models.signals.post_delete, sender=LabeledSample)
+@receiver(models.signals.post_save, sender=LabeledElement)
+@receiver(models.signals.post_delete, sender=LabeledElement)
+@receiver(models.signals.post_save, sender=Label)
+@receiver(models.signals.post_delete, sender=Label)
+def invalidate_cached_reads(sender, **kwargs):
+    # See caching.py, bulk writes call bump_generation() themselves.
+    bump_generation(sender._meta.label_lower)
+
+
+EXPORT_JOB_STATUSES = (
+    ("queued", "Queued"),
+    ("running", "Running"),
+    ("done", "Done"),
+    ("failed", "Failed"),
+)
+
+EXPORT_FORMATS = (
+    ("files", "One file per sample"),
+    ("packed", "Packs with an offset index"),
+)
+
+
+class ExportJob(models.Model):
+    folder = models.CharField(
+        max_length=200,
+        help_text="Folder in the media storage the samples are exported to.",
+    )
+    format = models.CharField(
+        max_length=20,
+        choices=EXPORT_FORMATS,
+        default="files",
+        help_text="Packed exports put each split in a few large files, see packs.py.",
+    )
+    location = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text="Local folder exported to instead of the media storage.",
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=EXPORT_JOB_STATUSES,
+        default="queued",
+        db_index=True,
+    )
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # Doubles as a heartbeat for the worker, see run_export_jobs.
+    updated = models.DateTimeField(auto_now=True)
+    base = models.ForeignKey(
+        to="self",
+        related_name="+",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        help_text="Earlier export whose files are reused for unchanged samples.",
+    )
+    diff = JSONField(
+        blank=True,
+        null=True,
+        help_text="Number of samples added, changed, unchanged and removed since base.",
+    )
+
+    def __str__(self):
+        return f"{self.folder} ({self.status})"
+
+
+class ExportJobItem(models.Model):
+    job = models.ForeignKey(
+        to=ExportJob,
+        related_name="items",
+        on_delete=models.CASCADE,
+    )
+    labeled_sample = models.ForeignKey(
+        to=LabeledSample,
+        related_name="+",
+        on_delete=models.CASCADE,
+    )
+    split = models.CharField(max_length=20)
+    # LabeledSample.version when the job was queued
+    version = models.IntegerField(null=True)
+    # Item of the base job with the same labeled sample and version, its file
+    # is copied instead of converting the sample again.
+    reused_from = models.ForeignKey(
+        to="self",
+        related_name="+",
+        on_delete=models.SET_NULL,
+        null=True,
+    )
+    # Checkpoint, set once the sample has been written to storage.
+    done = models.BooleanField(default=False)
+    # Where it was written and the SHA-256 of what was written, set with done.
+    name = models.CharField(max_length=300, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, null=True)
+    # Packed exports: the pack holding the file, and where in it. `name` is
+    # still where the file would be in a regular export.
+    pack = models.CharField(max_length=300, blank=True)
+    offset = models.BigIntegerField(null=True)
+    size = models.IntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["job", "done"]),
+            models.Index(fields=["job", "labeled_sample"]),
+        ]
+
+
+class CompressionDictionary(models.Model):
+    """
+    Trained compression dictionary for the page columns. Pages compressed with
+    one refer to it by id, so these must never be changed or deleted.
+    """
+
+    codec = models.CharField(max_length=10)
+    data = models.BinaryField()
+    samples = models.IntegerField(help_text="Number of pages it was trained on.")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.codec} dictionary {self.pk} ({len(self.data)} bytes)"
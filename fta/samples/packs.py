@@ -0,0 +1,149 @@
+"""
+Packed exports: the files of a split stored back to back in a few large packs.
+
+A split folder of a packed export holds pack-00000.pack, pack-00001.pack, ...
+each next to an index, pack-00000.index.json:
+
+    {"pack": "pack-00000.pack", "files": [
+        {"id": 12, "sample": 7, "name": "12.n.html", "offset": 0,
+         "size": 5120, "sha256": "..."},
+        ...
+    ]}
+
+`id` is the labeled sample, the number in the file names of a regular export.
+Trainers can read packs with PackReader (or SplitReader for all the packs of
+a split), which memory-maps them, so any page can be read without unpacking.
+Only the standard library is needed, this module can be copied on its own.
+"""
+
+import glob
+import json
+import mmap
+import os
+import tempfile
+
+PACK_NAME = "pack-{:05d}"
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".index.json"
+
+
+def index_path(pack_path):
+    return pack_path[: -len(PACK_SUFFIX)] + INDEX_SUFFIX
+
+
+class PackWriter:
+    """Builds a pack and its index in a temporary file."""
+
+    def __init__(self, name):
+        self.name = name
+        self.file = tempfile.TemporaryFile()
+        self.files = []
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+    def add(self, id, sample, name, data, sha256):
+        """Appends `data` (bytes), returns its offset."""
+        offset = self.file.tell()
+        self.file.write(data)
+        self.files.append(
+            {
+                "id": id,
+                "sample": sample,
+                "name": name,
+                "offset": offset,
+                "size": len(data),
+                "sha256": sha256,
+            }
+        )
+        return offset
+
+    def index(self):
+        pack = os.path.basename(self.name)
+        return json.dumps({"pack": pack, "files": self.files}).encode("utf-8")
+
+    def close(self):
+        self.file.close()
+
+
+class PackReader:
+    """
+    A pack on the local filesystem, memory-mapped. Iterating gives the index
+    entries in pack order, reader[id] the bytes of a labeled sample.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path), encoding="utf-8") as f:
+            self.files = json.load(f)["files"]
+        self._by_id = {entry["id"]: entry for entry in self.files}
+        with open(path, "rb") as f:
+            # An empty file can't be mapped, and a pack never is.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __getitem__(self, id):
+        return self.read(self._by_id[id])
+
+    def read(self, entry):
+        start, end = entry["offset"], entry["offset"] + entry["size"]
+        return self._map[start:end]
+
+    def items(self):
+        """(entry, bytes) for every file, in pack order."""
+        for entry in self.files:
+            yield entry, self.read(entry)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SplitReader:
+    """All the packs in a split folder of a packed export, e.g. `.../training`."""
+
+    def __init__(self, folder):
+        paths = sorted(glob.glob(os.path.join(folder, "*" + PACK_SUFFIX)))
+        self.packs = [PackReader(path) for path in paths]
+        self._by_id = {id: pack for pack in self.packs for id in pack._by_id}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        for pack in self.packs:
+            yield from pack
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __getitem__(self, id):
+        return self._by_id[id][id]
+
+    def items(self):
+        for pack in self.packs:
+            yield from pack.items()
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,26 @@
+"""
+Process pools for CPU bound work: converting samples for exports and parsing
+uploaded pages. One pool per purpose and process, started on first use.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+# name: (workers, pool)
+_pools = {}
+
+
+def process_pool(name, workers):
+    """
+    The pool called `name`, with `workers` processes. It is started again if
+    the number changed since, and None is returned for 0 workers, meaning the
+    work should be done inline.
+    """
+    started_with, pool = _pools.get(name, (0, None))
+    if not workers:
+        return None
+    if pool is None or started_with != workers:
+        if pool is not None:
+            pool.shutdown()
+        pool = ProcessPoolExecutor(max_workers=workers)
+        _pools[name] = workers, pool
+    return pool
@@ -0,0 +1,198 @@
+"""
+Single pass alternatives to the BeautifulSoup based conversions in utils.py.
+
+The page is tokenized once with html.parser, the same tokenizer BeautifulSoup
+uses with features="html.parser", so both engines see the same elements in the
+same order. Only the start tags that need changing are rewritten, everything
+else is copied through untouched.
+"""
+
+import re
+from collections import Counter
+from html import escape
+from html.parser import HTMLParser
+from uuid import uuid4
+
+# The patterns html.parser uses to split a start tag into its name and
+# attributes, used here to find the span of each attribute in the raw tag.
+tagfind = re.compile(r"([a-zA-Z][^\t\n\r\f />\x00]*)(?:\s|/(?!>))*")
+attrfind = re.compile(
+    r'((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*'
+    r'(\'[^\']*\'|"[^"]*"|(?![\'"])[^>\s]*))?(?:\s|/(?!>))*'
+)
+
+
+def edit_start_tag(raw, remove, add):
+    # Drops the attributes named in `remove` and inserts the (name, value)
+    # pairs in `add` right after the tag name.
+    match = tagfind.match(raw, 1)
+    name_end = match.end(1)
+    pieces = [raw[:name_end]]
+    pieces += [f' {name}="{escape(value)}"' for name, value in add]
+    k = match.end()
+    pieces.append(raw[name_end:k])
+    while k < len(raw):
+        attr = attrfind.match(raw, k)
+        if not attr:
+            break
+        if attr.group(1).lower() not in remove:
+            pieces.append(attr.group(0))
+        k = attr.end()
+    pieces.append(raw[k:])
+    return "".join(pieces)
+
+
+class StartTagRewriter(HTMLParser):
+    def __init__(self, rewrite):
+        super().__init__(convert_charrefs=False)
+        self.rewrite = rewrite
+        self.edits = []
+        # Offset of self.rawdata within the page, it only moves on close().
+        # (HTMLParser already uses self.offset for the column number.)
+        self.rawdata_offset = 0
+        self.tag_start = 0
+
+    def parse_starttag(self, i):
+        self.tag_start = self.rawdata_offset + i
+        return super().parse_starttag(i)
+
+    def handle_starttag(self, tag, attrs):
+        # Valueless attributes come through as None, BeautifulSoup uses "".
+        attrs = {name: "" if value is None else value for name, value in attrs}
+        edit = self.rewrite(tag, attrs)
+        if edit:
+            remove, add = edit
+            raw = self.get_starttag_text()
+            self.edits.append(
+                (
+                    self.tag_start,
+                    self.tag_start + len(raw),
+                    edit_start_tag(raw, remove, add),
+                )
+            )
+
+
+def rewrite_start_tags(page, rewrite):
+    """Calls `rewrite(tag, attrs)` for every start tag of `page` in document order.
+
+    `rewrite` returns None to leave the tag alone, or a (remove, add) pair of
+    attribute names to drop and (name, value) pairs to insert.
+    """
+    parser = StartTagRewriter(rewrite)
+    parser.feed(page)
+    parser.rawdata_offset = len(page) - len(parser.rawdata)
+    parser.close()
+    if not parser.edits:
+        return page
+    pieces = []
+    copied_up_to = 0
+    for start, end, replacement in parser.edits:
+        pieces.append(page[copied_up_to:start])
+        pieces.append(replacement)
+        copied_up_to = end
+    pieces.append(page[copied_up_to:])
+    return "".join(pieces)
+
+
+def convert_fathom_sample_to_labeled_sample(fathom_sample):
+    fta_id_to_label = {}
+
+    def rewrite(tag, attrs):
+        if "data-fathom" in attrs:
+            fta_id = uuid4()
+            fta_id_to_label[fta_id] = attrs["data-fathom"]
+            return {"data-fathom", "data-fta_id"}, [("data-fta_id", str(fta_id))]
+        if "data-fta_id" in attrs:
+            return {"data-fta_id"}, []
+        return None
+
+    return rewrite_start_tags(fathom_sample, rewrite), fta_id_to_label
+
+
+def convert_labeled_sample_to_fathom_sample(labeled_page, fta_id_to_slug):
+    def rewrite(tag, attrs):
+        slug = fta_id_to_slug.get(attrs.get("data-fta_id"))
+        if slug is None:
+            return None
+        return {"data-fathom"}, [("data-fathom", slug)]
+
+    return rewrite_start_tags(labeled_page, rewrite)
+
+
+def count_start_tags(page, visit=None):
+    # Tag name counts, optionally calling `visit(tag, position, attrs)` where
+    # position is the index of the element among the tags of its name.
+    counts = Counter()
+
+    def rewrite(tag, attrs):
+        if visit is not None:
+            visit(tag, counts[tag], attrs)
+        counts[tag] += 1
+
+    rewrite_start_tags(page, rewrite)
+    return counts
+
+
+def unlabeled_attrs(attrs):
+    # A tag's attributes without the ones labeling adds.
+    return {
+        name: value
+        for name, value in attrs.items()
+        if name not in ("data-fta_id", "data-fathom")
+    }
+
+
+def same_attrs(original_counts, original_attrs, modified_counts, modified_attrs):
+    # Whether the elements of two pages agree on their unlabeled attributes,
+    # position by position, for every tag the pages have as many of. The
+    # counts are by tag name, the attributes by (tag name, position).
+    return all(
+        modified_attrs[key] == attrs
+        for key, attrs in original_attrs.items()
+        if original_counts[key[0]] == modified_counts[key[0]]
+    )
+
+
+def compute_fta_id_patches(original_page, modified_page):
+    patches = []
+    has_fathom_labels = False
+    modified_attrs = {}
+    original_attrs = {}
+
+    def visit(tag, position, attrs):
+        nonlocal has_fathom_labels
+        has_fathom_labels = has_fathom_labels or "data-fathom" in attrs
+        if "data-fta_id" in attrs:
+            patches.append([tag, position, attrs["data-fta_id"]])
+        modified_attrs[tag, position] = unlabeled_attrs(attrs)
+
+    def visit_original(tag, position, attrs):
+        original_attrs[tag, position] = unlabeled_attrs(attrs)
+
+    modified_counts = count_start_tags(modified_page, visit)
+    if has_fathom_labels:
+        return None
+    original_counts = count_start_tags(original_page, visit_original)
+    for tag in {tag for tag, _, _ in patches}:
+        if original_counts[tag] != modified_counts[tag]:
+            return None
+    if not same_attrs(original_counts, original_attrs, modified_counts, modified_attrs):
+        return None
+    return patches
+
+
+def apply_fta_id_patches(original_page, patches):
+    fta_ids = {(tag, position): fta_id for tag, position, fta_id in patches}
+    counts = Counter()
+
+    def rewrite(tag, attrs):
+        fta_id = fta_ids.get((tag, counts[tag]))
+        counts[tag] += 1
+        remove = {"data-fta_id", "data-fathom"}.intersection(attrs)
+        if fta_id is not None:
+            return remove | {"data-fta_id"}, [("data-fta_id", fta_id)]
+        if remove:
+            return remove, []
+        return None
+
+    return rewrite_start_tags(original_page, rewrite)
@@ -0,0 +1,150 @@
+"""
+Near-duplicate detection for frozen pages, see SampleSignature.
+
+A page is reduced to the set of its word 5-grams (shingles) and summarized by
+a MinHash signature: for each of NUM_HASHES hash functions, the smallest hash
+of any shingle. The fraction of signature positions two pages agree on
+estimates the Jaccard similarity of their shingle sets.
+
+The signature is cut into LSH_BANDS bands of LSH_ROWS values and each band is
+hashed to a key. Pages sharing a key are candidates, so finding the candidates
+for a page is a handful of index lookups rather than a comparison with every
+other page. With 16 bands of 4 rows a pair at 0.8 similarity shares a key
+with probability ~0.9998, and one at 0.3 with ~0.12.
+"""
+
+import hashlib
+import random
+import re
+
+NUM_HASHES = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_HASHES // LSH_BANDS
+SHINGLE_SIZE = 5
+
+# Fixed, the signatures stored in the database depend on them.
+_MASKS = [random.Random(20210612 + i).getrandbits(64) for i in range(NUM_HASHES)]
+_INVISIBLE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_OPENER = re.compile(r"<(script|style)\b", re.IGNORECASE)
+_TAG = re.compile(r"<[^>]*>")
+_TAG_NAME = re.compile(r"<([a-zA-Z][a-zA-Z0-9]*)")
+_WORD = re.compile(r"\w+")
+
+
+def _hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def _signed(value):
+    # Stored in bigint columns.
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _visible_words(page):
+    return _WORD.findall(_TAG.sub(" ", _INVISIBLE.sub(" ", page)).lower())
+
+
+def _tag_names(page):
+    return _TAG_NAME.findall(page.lower())
+
+
+def _gram_hashes(words):
+    grams = zip(*(words[offset:] for offset in range(SHINGLE_SIZE)))
+    return {_hash64(" ".join(gram).encode("utf-8")) for gram in grams}
+
+
+def page_shingles(page):
+    """Hashes of the word 5-grams of the visible text of `page`."""
+    words = _visible_words(page)
+    if not words:
+        # Nothing but markup, go by the structure instead.
+        words = _tag_names(page)
+    if len(words) < SHINGLE_SIZE:
+        return {_hash64(" ".join(words).encode("utf-8"))}
+    return _gram_hashes(words)
+
+
+def page_minhash(page):
+    shingles = page_shingles(page)
+    # Each hash function is the shingle hash xored with a fixed random mask.
+    return [_signed(min(shingle ^ mask for shingle in shingles)) for mask in _MASKS]
+
+
+class _RunningMinHash:
+    # Minima of the 5-grams of a stream of words, given a list at a time.
+
+    def __init__(self):
+        # Above any 64 bit hash.
+        self.minima = [1 << 64] * NUM_HASHES
+        self.count = 0
+        # Enough to finish the grams that continue in the next list, and all
+        # the words of streams too short for a single gram.
+        self.tail = []
+
+    def update(self, words):
+        self.count += len(words)
+        words = self.tail + words
+        keep = SHINGLE_SIZE - 1
+        self.tail = words[-keep:]
+        shingles = _gram_hashes(words)
+        if shingles:
+            self.minima = [
+                min(low, min(shingle ^ mask for shingle in shingles))
+                for low, mask in zip(self.minima, _MASKS)
+            ]
+
+    def minhash(self):
+        if self.count < SHINGLE_SIZE:
+            shingle = _hash64(" ".join(self.tail).encode("utf-8"))
+            return [_signed(shingle ^ mask) for mask in _MASKS]
+        return [_signed(low) for low in self.minima]
+
+
+class MinHasher:
+    """
+    page_minhash of a page read a piece at a time, e.g. as it is uploaded.
+    Pieces are taken in up to the last ">" that doesn't leave a tag or a
+    script open, so the signature is the same as for the whole page while
+    only an unfinished tag or script is held back.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.words = _RunningMinHash()
+        self.tags = _RunningMinHash()
+
+    def update(self, text):
+        self.pending += text
+        end = self.pending.rfind(">") + 1
+        if not end:
+            return
+        visible = _INVISIBLE.sub(" ", self.pending[:end])
+        if _OPENER.search(visible) or "<" in _TAG.sub(" ", visible):
+            return
+        self._take(self.pending[:end])
+        self.pending = self.pending[end:]
+
+    def _take(self, piece):
+        self.words.update(_visible_words(piece))
+        # Only needed if the page turns out to have no text at all.
+        if not self.words.count:
+            self.tags.update(_tag_names(piece))
+
+    def minhash(self):
+        self._take(self.pending)
+        self.pending = ""
+        return (self.words if self.words.count else self.tags).minhash()
+
+
+def lsh_keys(minhash):
+    keys = []
+    bands = zip(*[iter(minhash)] * LSH_ROWS)
+    for band, rows in enumerate(bands):
+        data = ",".join(str(value) for value in (band,) + rows).encode("ascii")
+        keys.append(_signed(_hash64(data)))
+    return keys
+
+
+def similarity(minhash, other):
+    """Estimated Jaccard similarity of the pages two signatures came from."""
+    return sum(a == b for a, b in zip(minhash, other)) / NUM_HASHES
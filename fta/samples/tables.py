@@ -1,6 +1,6 @@
 import django_tables2 as tables
 from django.template.defaultfilters import truncatechars
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django_tables2.utils import A
 
 from .models import Sample
@@ -21,6 +21,7 @@ class SampleTable(tables.Table):
             "edit",
             "labels",
             "url",
+            "domain",
             "freeze_time",
             "freeze_software",
             "page_size",
@@ -28,30 +29,26 @@ class SampleTable(tables.Table):
         )
 
     def render_labels(self, value, record):
-        default = format_html('<a href="?label=-">-</a>')
-        if hasattr(record, "labeled_sample"):
-            # This was a one-to-one relationship but is now a FK relationship so there can be more than 1
-            # LabeledSample for the Sample.  However the default filtering is superseded_by=None so only 1 is returned.
-            if record.labeled_sample.all().exists():
-                labeled_elements = (
-                    record.labeled_sample.all().first().labeled_elements.all()
-                )
-                labels = labeled_elements.values_list(
-                    "label__slug", flat=True
-                ).distinct()
-                if labels:
-                    label_links = [
-                        f'<a href="?label={label}">{label}</a>' for label in labels
-                    ]
-                    return format_html(", ".join(label_links))
-        return default
+        # label_slugs is annotated by Sample.objects.with_label_stats()
+        if record.label_slugs:
+            return format_html_join(
+                ", ",
+                '<a href="?label={}">{}</a>',
+                ((label, label) for label in record.label_slugs),
+            )
+        return format_html('<a href="?label=-">-</a>')
 
     def order_labels(self, queryset, is_descending):
-        queryset = queryset.order_by(("-" if is_descending else "") + "nlabels")
+        queryset = queryset.order_by(
+            ("-" if is_descending else "") + "label_summary__nlabels"
+        )
         return (queryset, True)
 
     def render_page_size(self, value, record):
         return humansize(value)
 
+    def render_domain(self, value, record):
+        return format_html('<a href="?domain={}">{}</a>', value, value)
+
     def render_url(self, value, record):
         return f"{truncatechars(value, 80)}"
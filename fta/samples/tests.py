@@ -1,6 +1,61 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import random
+import tracemalloc
+from collections import Counter
+from datetime import date, datetime
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from urllib.parse import quote
+from uuid import UUID
+
+import pytest
 from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, ProtectedError
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
 
-from .utils import convert_fathom_sample_to_labeled_sample
+from . import artifacts
+from .artifacts import build_fathom_artifact, stale_labeled_samples
+from .blobs import ContentAddressedStore, sha256_hexdigest
+from .caching import cache_stats, label_counts, label_ids, sample_count
+from .exports import enqueue_export, run_export_job
+from .models import (
+    CompressionDictionary,
+    ExportJob,
+    ExportJobItem,
+    FathomArtifact,
+    Label,
+    LabeledElement,
+    LabeledSample,
+    Sample,
+    SampleLabelSummary,
+    SampleSignature,
+)
+from .packs import PackReader, SplitReader
+from .rewriter import rewrite_start_tags
+from .similarity import MinHasher, page_minhash, similarity
+from .uploads import spooled_frozen_page
+from .utils import (
+    FrozenMetadataSniffer,
+    apply_fta_id_patches,
+    compute_fta_id_patches,
+    convert_fathom_sample_to_labeled_sample,
+    convert_labeled_sample_to_fathom_sample,
+    convert_page_to_fathom_sample,
+    split_for_key,
+)
+from .views import get_frozen_metadata
 
 PAGE_BEGIN = (
     '<html lang="en-us">'
@@ -21,6 +76,16 @@ MULTIPLE_ELEMENTS_SAME_LABEL = (
     '<input data-fta_id="aaa" data-fathom="email"/>'
     '<input data-fta_id="bbb" data-fathom="email"/>'
 )
+# Things a rewriter could trip on: markup in scripts and comments, entities,
+# odd quoting and casing, valueless attributes.
+AWKWARD_MARKUP = (
+    "<!-- <input data-fathom='comment'> -->"
+    "<script>var s = '<input data-fathom=\"script\">';</script>"
+    "<DIV DATA-FATHOM=upper class='a &amp; b'>x &lt; y</DIV>"
+    "<p data-fathom data-fta_id = 'old' >empty label</p>"
+    '<img data-fathom="image" src="a.png">'
+    '<br data-fathom="br"/>'
+)
 
 
 def test_convert_fathom_sample_to_labeled_sample_1_labeled_element():
@@ -71,3 +136,1446 @@ def test_convert_fathom_sample_to_labeled_sample_multiple_elements_same_label():
         item for item in soup.find_all() if "data-fta_id" in item.attrs
     ]
     assert len(fta_labeled_elements) == 2
+
+
+SINGLEFILE_HEAD = (
+    "<!DOCTYPE html> <html lang=en><!--\n"
+    " Page saved with SingleFile \n"
+    " url: https://example.com/shop \n"
+    " saved date: Thu Nov 05 2020 14:39:51 GMT-0600 (Central Standard Time)\n"
+    " window width: 1366\n"
+    " window height: 768\n"
+    "--><head><meta charset=utf-8><title>Shop</title></head>"
+)
+FREEZEDRY_HEAD = (
+    "<html><head>"
+    '<link rel="original" href="https://example.com/news">'
+    '<meta http-equiv="Memento-Datetime" content="Tue, 10 Nov 2020 20:00:00 GMT">'
+    "</head>"
+)
+# Big enough to notice if it gets parsed
+BODY = "<body>" + NO_LABEL * 20000 + PAGE_END
+
+
+@pytest.mark.parametrize("declared", ["SingleFile", "freezedry", "Unknown"])
+def test_get_frozen_metadata_singlefile(declared):
+    url, freeze_time, software, width, height = get_frozen_metadata(
+        SINGLEFILE_HEAD + BODY, declared
+    )
+    assert software == "SingleFile"
+    assert url == "https://example.com/shop"
+    assert (freeze_time.year, freeze_time.month, freeze_time.day) == (2020, 11, 5)
+    assert (width, height) == (1366, 768)
+
+
+@pytest.mark.parametrize("declared", ["SingleFile", "freezedry"])
+def test_get_frozen_metadata_freezedry(declared):
+    url, freeze_time, software, _, _ = get_frozen_metadata(
+        FREEZEDRY_HEAD + BODY, declared
+    )
+    assert software == "freezedry"
+    assert url == "https://example.com/news"
+    assert freeze_time.hour == 20
+
+
+def test_get_frozen_metadata_only_reads_the_head(monkeypatch):
+    fed = []
+    feed = FrozenMetadataSniffer.feed
+
+    def recording_feed(self, data):
+        fed.append(len(data))
+        feed(self, data)
+
+    monkeypatch.setattr(FrozenMetadataSniffer, "feed", recording_feed)
+    get_frozen_metadata(FREEZEDRY_HEAD + BODY, "freezedry")
+    assert fed == [settings.FROZEN_METADATA_SNIFF_LIMIT]
+
+
+def test_get_frozen_metadata_falls_back_to_whole_page(settings):
+    # Inlined styles push the freezedry tags past the sniffed prefix
+    head = "<html><head><style>" + "a{}" * 100 + "</style>" + FREEZEDRY_HEAD[12:]
+    settings.FROZEN_METADATA_SNIFF_LIMIT = 100
+    url, _, software, _, _ = get_frozen_metadata(head + BODY, "freezedry")
+    assert (url, software) == ("https://example.com/news", "freezedry")
+
+    url, _, software, _, _ = get_frozen_metadata(PAGE_BEGIN + BODY, "SingleFile")
+    assert (url, software) == ("", "Unknown")
+
+
+def labels_by_position(page, attr):
+    soup = BeautifulSoup(page, features="html.parser")
+    return [
+        (position, element.attrs[attr])
+        for position, element in enumerate(soup.find_all())
+        if attr in element.attrs
+    ]
+
+
+@pytest.mark.parametrize(
+    "page",
+    [
+        PAGE_BEGIN + SEARCH_FATHOM_LABEL + NO_LABEL + WITH_FTA_ID + PAGE_END,
+        PAGE_BEGIN + MULTIPLE_ELEMENTS_SAME_LABEL + PAGE_END,
+        PAGE_BEGIN + AWKWARD_MARKUP + EMAIL_FATHOM_LABEL + PAGE_END,
+    ],
+)
+def test_streaming_engine_matches_beautifulsoup(settings, page):
+    results = {}
+    for engine in ("beautifulsoup", "streaming"):
+        settings.FATHOM_CONVERSION_ENGINE = engine
+        labeled_page, fta_id_to_label = convert_fathom_sample_to_labeled_sample(page)
+        fta_ids = labels_by_position(labeled_page, "data-fta_id")
+        results[engine] = [
+            (position, fta_id_to_label[UUID(fta_id)]) for position, fta_id in fta_ids
+        ]
+        assert len(fta_ids) == len(fta_id_to_label)
+    assert results["streaming"] == results["beautifulsoup"]
+
+    # and back to a fathom page
+    fta_id_to_slug = {fta_id: f"label-{fta_id}" for fta_id in ["aaa", "1234", "old"]}
+    for engine in ("beautifulsoup", "streaming"):
+        settings.FATHOM_CONVERSION_ENGINE = engine
+        fathom_page = fathom_page_from(page, fta_id_to_slug)
+        results[engine] = labels_by_position(fathom_page, "data-fathom")
+    assert results["streaming"] == results["beautifulsoup"]
+
+
+def fathom_page_from(page, fta_id_to_slug):
+    labeled_sample = SimpleNamespace(
+        materialized_sample=page,
+        labeled_elements=SimpleNamespace(
+            all=lambda: [
+                SimpleNamespace(data_fta_id=fta_id, label=SimpleNamespace(slug=slug))
+                for fta_id, slug in fta_id_to_slug.items()
+            ]
+        ),
+    )
+    fathom_page, _ = convert_labeled_sample_to_fathom_sample(labeled_sample)
+    return fathom_page.decode("utf-8")
+
+
+def test_streaming_engine_only_touches_rewritten_tags():
+    page = PAGE_BEGIN + AWKWARD_MARKUP + NO_LABEL + PAGE_END
+
+    def rewrite(tag, attrs):
+        if tag == "img":
+            return {"data-fathom"}, [("data-fta_id", "new")]
+        return None
+
+    rewritten = rewrite_start_tags(page, rewrite)
+    assert rewritten == page.replace(
+        '<img data-fathom="image" src="a.png">', '<img data-fta_id="new" src="a.png">'
+    )
+    assert rewrite_start_tags(page, lambda tag, attrs: None) is page
+
+
+@pytest.mark.parametrize("engine", ["beautifulsoup", "streaming"])
+def test_fta_id_patches_round_trip(settings, engine):
+    settings.FATHOM_CONVERSION_ENGINE = engine
+    original = (
+        PAGE_BEGIN
+        + NO_LABEL
+        + WITH_FTA_ID
+        + "<table><tr><td>1</td></tr></table>"
+        + PAGE_END
+    )
+    # As the labeler would post it back: re-serialized with tbody added
+    modified = (
+        PAGE_BEGIN
+        + '<input data-fta_id="abc" id="id_question_text" name="question_text" type="text" value="/"/>'
+        + '<input id="id1" name="n" type="text" value="/"/>'
+        + '<table><tbody><tr><td data-fta_id="def">1</td></tr></tbody></table>'
+        + PAGE_END
+    )
+    patches = compute_fta_id_patches(original, modified)
+    assert patches == [["input", 0, "abc"], ["td", 0, "def"]]
+
+    soup = BeautifulSoup(
+        apply_fta_id_patches(original, patches), features="html.parser"
+    )
+    fta_ids = {
+        element["data-fta_id"]: element.name
+        for element in soup.find_all(attrs={"data-fta_id": True})
+    }
+    assert fta_ids == {"abc": "input", "def": "td"}
+    assert soup.find("input", id="id_question_text")["data-fta_id"] == "abc"
+
+
+@pytest.mark.parametrize("engine", ["beautifulsoup", "streaming"])
+def test_fta_id_patches_fall_back_to_full_page(settings, engine):
+    settings.FATHOM_CONVERSION_ENGINE = engine
+    original = PAGE_BEGIN + NO_LABEL + PAGE_END
+    # Inputs were added, positions can't be trusted
+    assert (
+        compute_fta_id_patches(original, PAGE_BEGIN + WITH_FTA_ID + NO_LABEL + PAGE_END)
+        is None
+    )
+    # Patches only carry data-fta_id
+    assert (
+        compute_fta_id_patches(original, PAGE_BEGIN + SEARCH_FATHOM_LABEL + PAGE_END)
+        is None
+    )
+    # Nor can they change any other attribute, of labeled elements or not
+    labeled = NO_LABEL.replace("<input ", '<input data-fta_id="f1" ')
+    assert compute_fta_id_patches(original, PAGE_BEGIN + labeled + PAGE_END)
+    for changed in [
+        labeled.replace('type="text"', 'type="email"'),
+        labeled.replace("<input ", '<input class="selected" '),
+    ]:
+        assert compute_fta_id_patches(original, PAGE_BEGIN + changed + PAGE_END) is None
+    body = PAGE_BEGIN.replace("<body ", '<body style="cursor: crosshair" ')
+    assert compute_fta_id_patches(original, body + labeled + PAGE_END) is None
+
+
+def make_sample(frozen_page=PAGE_BEGIN + NO_LABEL + PAGE_END, **kwargs):
+    defaults = dict(url="https://example.com/", freeze_time=timezone.now())
+    defaults.update(kwargs)
+    sample = Sample(frozen_page=frozen_page, **defaults)
+    sample.save()
+    return sample
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("storage", ["database", "blob"])
+def test_sample_notes_save_is_one_small_update(settings, storage):
+    settings.FROZEN_PAGE_STORAGE = storage
+    sample = Sample.objects.get(pk=make_sample().pk)
+    sample.frozen_page  # loaded (from the blob store too) but unchanged
+    sample.notes = "new notes"
+    with CaptureQueriesContext(connection) as queries:
+        sample.save()
+    assert len(queries) == 1
+    assert queries[0]["sql"].startswith("UPDATE")
+    assert "frozen_page" not in queries[0]["sql"]
+    assert Sample.objects.get(pk=sample.pk).notes == "new notes"
+
+    sample.url = "https://example.com/elsewhere"
+    with pytest.raises(ProtectedError):
+        sample.save()
+    sample = Sample.objects.slim().get(pk=sample.pk)
+    sample.frozen_page = PAGE_BEGIN + PAGE_END
+    with pytest.raises(ProtectedError):
+        sample.save()
+
+
+@pytest.mark.django_db
+def test_sample_bulk_updates_are_checked_by_the_database(settings):
+    # Only uncompressed pages can be checked against their digest.
+    settings.PAGE_COMPRESSION = "none"
+    sample = make_sample()
+    samples = Sample.objects.filter(pk=sample.pk)
+    other_page = PAGE_BEGIN + PAGE_END
+    for changes in [
+        {"url": "https://example.com/elsewhere"},
+        {"frozen_page": other_page},
+        {
+            "frozen_page": other_page,
+            "frozen_page_sha256": hashlib.sha256(other_page.encode()).hexdigest(),
+        },
+        {"frozen_page": "", "frozen_page_sha256": None},
+    ]:
+        with pytest.raises(IntegrityError), transaction.atomic():
+            samples.update(**changes)
+    # Moving the same page elsewhere is fine.
+    samples.update(frozen_page="", frozen_page_sha256=sample.frozen_page_sha256)
+    samples.update(frozen_page=sample.frozen_page, notes="moved back")
+    settings.PAGE_COMPRESSION = "zlib"
+    samples.update(frozen_page=sample.frozen_page)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("storage", ["database", "blob"])
+def test_upload_gzipped_sample(client, django_user_model, settings, storage):
+    settings.FROZEN_PAGE_STORAGE = storage
+    client.force_login(django_user_model.objects.create(username="uploader"))
+    page = SINGLEFILE_HEAD + BODY
+    upload = BytesIO(gzip.compress(page.encode("utf-8")))
+    upload.name = "page.html.gz"
+    response = client.post(
+        "/add_sample",
+        {"frozen_page": upload, "freeze_software": "SingleFile", "notes": ""},
+    )
+    assert response.status_code == 302
+
+    sample = Sample.objects.get()
+    assert sample.url == "https://example.com/shop"
+    assert sample.page_size == len(page)
+    assert sample.frozen_page_sha256 == hashlib.sha256(page.encode()).hexdigest()
+    assert sample.frozen_page == page
+    inline = Sample.objects.filter(frozen_page="").exists()
+    assert inline == (storage == "blob")
+    # Indexed as it came in, from the stream.
+    assert SampleSignature.objects.get(sample=sample).minhash == page_minhash(page)
+
+
+@pytest.mark.django_db
+def test_upload_rejects_unreadable_page(client, django_user_model):
+    client.force_login(django_user_model.objects.create(username="uploader"))
+    upload = BytesIO(gzip.compress(b"\xff not utf-8"))
+    upload.name = "page.html.gz"
+    response = client.post(
+        "/add_sample", {"frozen_page": upload, "freeze_software": "SingleFile"}
+    )
+    assert response.status_code == 200
+    assert "read the page" in response.content.decode()
+    assert not Sample.objects.exists()
+
+
+def test_spooled_frozen_page_memory_is_bounded(tmp_path):
+    # 20MB of page from a tiny gzip file, much bigger than any buffer.
+    path = tmp_path / "page.html.gz"
+    with gzip.open(path, "wb") as f:
+        f.write(SINGLEFILE_HEAD.encode())
+        for _ in range(200):
+            f.write((NO_LABEL * 1500).encode())
+    size = len(SINGLEFILE_HEAD) + 200 * 1500 * len(NO_LABEL)
+
+    tracemalloc.start()
+    with open(path, "rb") as f, spooled_frozen_page(File(f), 1000) as page:
+        _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 2 * 1024 * 1024
+    assert page.size == size
+    assert page.head == (SINGLEFILE_HEAD + NO_LABEL * 1500)[:1000]
+
+
+@pytest.mark.django_db
+def test_frozen_page_in_blob_store(settings):
+    settings.FROZEN_PAGE_STORAGE = "blob"
+    page = PAGE_BEGIN + SEARCH_FATHOM_LABEL + PAGE_END
+    first = make_sample(page)
+    second = make_sample(page)
+
+    # The column is empty and both samples point at the same blob
+    assert list(
+        Sample.objects.filter(pk__in=[first.pk, second.pk]).values_list(
+            "frozen_page", flat=True
+        )
+    ) == ["", ""]
+    assert first.frozen_page_sha256 == second.frozen_page_sha256
+    store = ContentAddressedStore()
+    directory = os.path.dirname(store.name(first.frozen_page_sha256))
+    assert store.storage.listdir(directory)[1] == [first.frozen_page_sha256]
+
+    # and the page is read back lazily
+    assert Sample.objects.get(pk=first.pk).frozen_page == page
+    assert first.page_size == len(page.encode("utf-8"))
+
+
+@pytest.mark.django_db
+def test_move_frozen_pages_to_blob_store(settings):
+    pages = [PAGE_BEGIN + f"<p>{i}</p>" + PAGE_END for i in range(3)]
+    samples = [make_sample(page) for page in pages]
+    assert Sample.objects.filter(frozen_page="").count() == 0
+
+    call_command("move_frozen_pages_to_blob_store", batch_size=2, stdout=StringIO())
+
+    assert Sample.objects.exclude(frozen_page="").count() == 0
+    for sample, page in zip(samples, pages):
+        assert Sample.objects.get(pk=sample.pk).frozen_page == page
+
+
+@pytest.fixture
+def api_client(django_user_model):
+    client = APIClient()
+    client.force_authenticate(django_user_model.objects.create(username="labeler"))
+    return client
+
+
+@pytest.mark.django_db
+def test_add_labeled_sample_stores_patches(api_client):
+    page = PAGE_BEGIN + SEARCH_FATHOM_LABEL + EMAIL_FATHOM_LABEL + PAGE_END
+    response = api_client.post(
+        "/api/add_labeled_sample/add_labeled_sample/",
+        {"labeled_page": page, "freeze_software": "SingleFile"},
+    )
+    assert response.status_code == 200
+
+    labeled_sample = LabeledSample.objects.get(original_sample=response.data["id"])
+    assert labeled_sample.modified_sample == ""
+    assert len(labeled_sample.fta_id_patches) == 2
+
+    # A fresh instance rebuilds the page from the patches
+    labeled_sample = LabeledSample.objects.get(pk=labeled_sample.pk)
+    soup = BeautifulSoup(labeled_sample.materialized_sample, features="html.parser")
+    assert soup.find(attrs={"data-fathom": True}) is None
+    labels = {
+        element.label.slug: element.data_fta_id
+        for element in labeled_sample.labeled_elements.all()
+    }
+    assert soup.find(id="searchbar")["data-fta_id"] == labels["search"]
+    assert soup.find(id="id2")["data-fta_id"] == labels["email"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("workers", [0, 2])
+def test_add_samples_ndjson(api_client, settings, workers):
+    settings.SAMPLE_INGEST_WORKERS = workers
+    lines = [
+        json.dumps({"frozen_page": SINGLEFILE_HEAD + BODY, "freeze_software": "x"}),
+        "not json",
+        "",
+        json.dumps({"frozen_page": FREEZEDRY_HEAD + PAGE_END, "notes": "no software"}),
+        json.dumps(
+            {"frozen_page": FREEZEDRY_HEAD + PAGE_END, "freeze_software": "freezedry"}
+        ),
+    ]
+    response = api_client.generic(
+        "POST",
+        "/api/add_sample/add_samples/",
+        "\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 200
+    results = response.data["samples"]
+    assert [sorted(result) for result in results] == [
+        ["id"],
+        ["error"],
+        ["error"],
+        ["id"],
+    ]
+    singlefile = Sample.objects.get(pk=results[0]["id"])
+    assert singlefile.freeze_software == "SingleFile"
+    assert singlefile.url == "https://example.com/shop"
+    assert singlefile.page_size == len(SINGLEFILE_HEAD + BODY)
+    assert singlefile.frozen_page_sha256
+    assert Sample.objects.get(pk=results[3]["id"]).url == "https://example.com/news"
+
+
+@pytest.mark.django_db
+def test_add_samples_multipart(api_client, settings):
+    settings.SAMPLE_INGEST_WORKERS = 0
+    pages = [SINGLEFILE_HEAD + BODY, FREEZEDRY_HEAD + PAGE_END]
+    response = api_client.post(
+        "/api/add_sample/add_samples/",
+        {
+            "frozen_page": [StringIO(page) for page in pages],
+            "freeze_software": "SingleFile",
+            "notes": "crawl",
+        },
+        format="multipart",
+    )
+    assert response.status_code == 200
+    ids = [result["id"] for result in response.data["samples"]]
+    samples = Sample.objects.in_bulk(ids)
+    assert [samples[pk].frozen_page for pk in ids] == pages
+    assert [samples[pk].freeze_software for pk in ids] == ["SingleFile", "freezedry"]
+    assert {samples[pk].notes for pk in ids} == {"crawl"}
+
+
+@pytest.mark.django_db
+def test_retrieve_sample_etags_and_compressed_variants(api_client):
+    sample = make_sample(SINGLEFILE_HEAD + BODY)
+    url = f"/api/samples/{sample.pk}/"
+
+    response = api_client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    etag = response["ETag"]
+    data = json.loads(gzip.decompress(response.content))
+    assert data["frozen_page"] == SINGLEFILE_HEAD + BODY
+    assert len(response.content) < len(BODY) / 10
+
+    # Served from the stored variant, or not at all, without reading the page
+    with CaptureQueriesContext(connection) as queries:
+        again = api_client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        not_modified = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert again.content == response.content
+    assert not_modified.status_code == 304
+    assert not_modified["ETag"] == etag
+    for query in queries.captured_queries:
+        assert '"samples_sample"."frozen_page"' not in query["sql"]
+
+    plain = api_client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+    assert not plain.has_header("Content-Encoding")
+    assert json.loads(plain.content) == data
+
+    sample.notes = "changed"
+    sample.save()
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+    assert json.loads(response.content)["notes"] == "changed"
+
+    # Only compressed bodies are stored, and only until the sample is gone.
+    folder = f"{settings.SAMPLE_RESPONSE_CACHE_LOCATION}/{sample.pk}"
+    names = default_storage.listdir(folder)[1]
+    assert names and all(name.endswith(".gzip") for name in names)
+    sample.delete()
+    assert default_storage.listdir(folder)[1] == []
+
+
+@pytest.mark.django_db
+def test_retrieve_sample_brotli(api_client):
+    brotli = pytest.importorskip("brotli")
+    sample = make_sample(SINGLEFILE_HEAD + BODY)
+    response = api_client.get(
+        f"/api/samples/{sample.pk}/", HTTP_ACCEPT_ENCODING="gzip, br"
+    )
+    assert response["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(response.content))["id"] == sample.pk
+
+
+@pytest.mark.django_db
+def test_label_view_saves_patches_and_labels(client, django_user_model):
+    client.force_login(django_user_model.objects.create(username="labeler"))
+    sample = make_sample(PAGE_BEGIN + NO_LABEL + PAGE_END)
+    url = f"/label/{sample.pk}"
+    assert client.get(url).status_code == 200
+
+    updated = (
+        PAGE_BEGIN + NO_LABEL.replace("<input ", '<input data-fta_id="f1" ') + PAGE_END
+    )
+    response = client.post(
+        url,
+        {
+            "updated-sample": updated,
+            "label-data": json.dumps([{"fta_id": "f1", "label": "email"}]),
+        },
+    )
+    assert response.status_code == 302
+
+    labeled_sample = LabeledSample.objects.get(original_sample=sample)
+    assert labeled_sample.fta_id_patches == [["input", 0, "f1"]]
+    assert labeled_sample.labeled_elements.get().label.slug == "email"
+
+
+@pytest.mark.django_db
+def test_set_labels_upserts_in_constant_queries(django_assert_num_queries):
+    labeled_sample = make_labeled_sample(labels=[("f0", "email")])
+    labels = {f"f{i}": f"label-{i % 7}" for i in range(200)}
+    # savepoint, labels, label ids, elements, release
+    with django_assert_num_queries(5):
+        labeled_sample.set_labels(labels)
+    assert labeled_sample.labeled_elements.count() == 200
+    assert labeled_sample.labeled_elements.get(data_fta_id="f0").label.slug == (
+        "label-0"
+    )
+    assert Label.objects.count() == 8
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("patched", [True, False])
+def test_label_view_loads_page_from_document_endpoint(
+    client, django_user_model, patched
+):
+    client.force_login(django_user_model.objects.create(username="labeler"))
+    sample = make_sample(PAGE_BEGIN + NO_LABEL + PAGE_END)
+    labeled_sample = LabeledSample.objects.create(original_sample=sample)
+    labeled_page = PAGE_BEGIN + NO_LABEL.replace("<input ", '<input data-fta_id="f1" ')
+    if patched:
+        labeled_sample.set_modified_sample(labeled_page + PAGE_END)
+    else:
+        labeled_sample.set_modified_sample(labeled_page + NO_LABEL + PAGE_END)
+    assert (labeled_sample.fta_id_patches is not None) == patched
+    labeled_sample.save()
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(f"/label/{sample.pk}")
+    assert response.status_code == 200
+    assert f'src="/label/{sample.pk}/document"' in response.content.decode()
+    assert "srcdoc" not in response.content.decode()
+    for query in queries.captured_queries:
+        assert '"samples_sample"."frozen_page"' not in query["sql"]
+        assert '"samples_labeledsample"."modified_sample"' not in query["sql"]
+
+    response = client.get(f"/label/{sample.pk}/document")
+    assert response.status_code == 200
+    assert response["X-Frame-Options"] == "SAMEORIGIN"
+    assert response["Content-Security-Policy"] == "child-src 'self'"
+    labeled_sample = LabeledSample.objects.get(pk=labeled_sample.pk)
+    assert b"".join(response.streaming_content).decode() == (
+        labeled_sample.materialized_sample
+    )
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(
+            f"/label/{sample.pk}/document", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+    assert response.status_code == 304
+    assert response["Content-Security-Policy"] == "child-src 'self'"
+    if patched:
+        for query in queries.captured_queries:
+            assert '"samples_sample"."frozen_page"' not in query["sql"]
+
+    assert client.get(f"/label/{sample.pk + 1}/document").status_code == 404
+
+
+@pytest.mark.django_db
+def test_document_etag_changes_with_engine(client, django_user_model, settings):
+    client.force_login(django_user_model.objects.create(username="labeler"))
+    sample = make_sample(PAGE_BEGIN + NO_LABEL + PAGE_END)
+    labeled_sample = LabeledSample.objects.create(original_sample=sample)
+    labeled_sample.set_modified_sample(
+        PAGE_BEGIN + NO_LABEL.replace("<input ", '<input data-fta_id="f1" ') + PAGE_END
+    )
+    assert labeled_sample.fta_id_patches is not None
+    labeled_sample.save()
+    url = f"/label/{sample.pk}/document"
+
+    settings.FATHOM_CONVERSION_ENGINE = "beautifulsoup"
+    etag = client.get(url)["ETag"]
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+    settings.FATHOM_CONVERSION_ENGINE = "streaming"
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+
+def make_labeled_sample(labels=(), **kwargs):
+    sample = make_sample(**kwargs)
+    labeled_sample = LabeledSample.objects.create(
+        original_sample=sample, fta_id_patches=[]
+    )
+    for fta_id, slug in labels:
+        label, _ = Label.objects.get_or_create(slug=slug)
+        LabeledElement.objects.create(
+            labeled_sample=labeled_sample, data_fta_id=fta_id, label=label
+        )
+    return labeled_sample
+
+
+@pytest.mark.django_db
+def test_export_job_resumes_from_checkpoint(settings):
+    for _ in range(5):
+        make_labeled_sample()
+    job = enqueue_export(LabeledSample.objects.all(), group_by="sample")
+    assert job.total == 5
+
+    # Pretend a worker died after exporting two samples
+    checkpointed = job.items.order_by("pk")[:2]
+    ExportJobItem.objects.filter(pk__in=[item.pk for item in checkpointed]).update(
+        done=True
+    )
+    ExportJob.objects.filter(pk=job.pk).update(processed=2)
+
+    call_command("run_export_jobs", once=True, stdout=StringIO())
+
+    job.refresh_from_db()
+    assert job.status == "done"
+    assert job.processed == 5
+    exported = []
+    for split in ("training", "testing", "validation"):
+        folder = os.path.join(settings.MEDIA_ROOT, job.folder, split)
+        if os.path.isdir(folder):
+            exported += os.listdir(folder)
+    # Only the three pending samples were written by this run
+    assert len(exported) == 3
+    assert {f"{item.labeled_sample_id}.n.html" for item in checkpointed}.isdisjoint(
+        exported
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/samples/",
+        "/samples",
+        "/admin/samples/sample/",
+        "/admin/samples/labeledsample/",
+    ],
+)
+def test_sample_lists_never_fetch_frozen_page(admin_client, url):
+    make_labeled_sample(labels=[("f1", "email")])
+    make_sample()
+    with CaptureQueriesContext(connection) as queries:
+        response = admin_client.get(url)
+    assert response.status_code == 200
+    assert queries.captured_queries
+    for query in queries.captured_queries:
+        assert '"samples_sample"."frozen_page"' not in query["sql"]
+
+
+@pytest.mark.django_db
+def test_sample_list_query_count_is_constant(admin_client):
+    def count_queries(url):
+        # Uncached, see caching.py
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = admin_client.get(url)
+        assert response.status_code == 200
+        return len(queries.captured_queries), response.content.decode()
+
+    make_labeled_sample(labels=[("f1", "email"), ("f2", "search")])
+    few, content = count_queries("/samples")
+    assert '<a href="?label=email">email</a>, <a href="?label=search">search</a>' in (
+        content
+    )
+
+    for _ in range(10):
+        make_labeled_sample(labels=[("f1", "email")])
+        make_sample()
+    many, _ = count_queries("/samples")
+    assert many == few
+
+    # Filtering by a label leaves the other labels of a sample in place
+    _, content = count_queries("/samples?label=search")
+    assert "?label=email" in content
+    assert content.count("Edit Labels") == 1
+
+
+@pytest.mark.django_db
+def test_label_summary_follows_label_changes():
+    labeled_sample = make_labeled_sample(labels=[("f1", "email"), ("f2", "search")])
+    sample = labeled_sample.original_sample
+
+    def summary():
+        return SampleLabelSummary.objects.get(sample=sample)
+
+    assert summary().labeled_sample_id == labeled_sample.pk
+    assert summary().label_slugs == ["email", "search"]
+    assert summary().nlabels == 2
+
+    # A new version supersedes the old one with a bulk update, as the API does
+    new_version = LabeledSample.objects.create(
+        original_sample=sample, fta_id_patches=[]
+    )
+    LabeledSample.objects.filter(pk=labeled_sample.pk).update(superseded_by=new_version)
+    assert (summary().labeled_sample_id, summary().nlabels) == (new_version.pk, 0)
+
+    LabeledElement.objects.create(
+        labeled_sample=new_version,
+        data_fta_id="f3",
+        label=Label.objects.get(slug="search"),
+    )
+    Label.objects.filter(slug="search").update(slug="query")
+    assert summary().label_slugs == ["query"]
+
+    # Repairs
+    SampleLabelSummary.objects.filter(sample=sample).update(nlabels=42)
+    call_command("rebuild_label_summaries", stdout=StringIO())
+    assert summary().nlabels == 1
+
+    sample.delete()
+    assert not SampleLabelSummary.objects.exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_compressed_pages(settings, codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    # Rows from before compression
+    settings.PAGE_COMPRESSION = "none"
+    pages = [
+        SINGLEFILE_HEAD + f"<body><p>Page {i}</p>" + NO_LABEL * (i + 1) + PAGE_END
+        for i in range(40)
+    ]
+    samples = [make_sample(page) for page in pages]
+    labeled_sample = LabeledSample.objects.create(
+        original_sample=samples[0], modified_sample=pages[1]
+    )
+
+    def stored(table, column, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT {column} FROM {table} WHERE id = %s", [pk])
+            return bytes(cursor.fetchone()[0])
+
+    assert stored("samples_sample", "frozen_page", samples[0].pk) == pages[0].encode()
+
+    settings.PAGE_COMPRESSION = codec
+    out = StringIO()
+    call_command(
+        "train_page_dictionary", "--codec", codec, "--size", "4096", stdout=out
+    )
+    settings.PAGE_COMPRESSION_DICTIONARY = CompressionDictionary.objects.get().pk
+    call_command("compress_pages", stdout=out)
+
+    for sample, page in zip(samples, pages):
+        data = stored("samples_sample", "frozen_page", sample.pk)
+        assert data.startswith(b"\x00") and len(data) < len(page)
+        assert Sample.objects.get(pk=sample.pk).frozen_page == page
+    data = stored("samples_labeledsample", "modified_sample", labeled_sample.pk)
+    assert data.startswith(b"\x00")
+    assert LabeledSample._base_manager.get().modified_sample == pages[1]
+    # New rows are compressed as they're written
+    new_sample = make_sample(pages[2])
+    assert stored("samples_sample", "frozen_page", new_sample.pk).startswith(b"\x00")
+
+    call_command("benchmark_page_compression", stdout=out)
+    assert f"{codec}+dictionary" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_sample_list_cursor_pagination_and_filters(api_client):
+    now = timezone.now()
+    samples = [
+        make_sample(freeze_time=now - timezone.timedelta(days=i)) for i in range(5)
+    ]
+    make_labeled_sample(labels=[("f1", "email")], freeze_software="SingleFile")
+
+    seen = []
+    url = "/api/samples/?ordering=freeze_time&page_size=2&fields=id,url"
+    while url:
+        response = api_client.get(url)
+        assert response.status_code == 200
+        assert all(set(row) == {"id", "url"} for row in response.data["results"])
+        seen += [row["id"] for row in response.data["results"]]
+        url = response.data["next"]
+    assert seen[:5] == [sample.pk for sample in reversed(samples)]
+    assert len(seen) == 6
+
+    def ids(query):
+        response = api_client.get(f"/api/samples/?fields=id&{query}")
+        assert response.status_code == 200
+        return {row["id"] for row in response.data["results"]}
+
+    labeled = Sample.objects.get(freeze_software="SingleFile").pk
+    assert ids("freeze_software=SingleFile") == {labeled}
+    assert ids("label=email") == {labeled}
+    assert ids("label=unknown") == set()
+    after = (now - timezone.timedelta(days=1, hours=1)).isoformat()
+    assert ids(f"freeze_time_after={quote(after)}") == {
+        samples[0].pk,
+        samples[1].pk,
+        labeled,
+    }
+    assert ids("freeze_time_before=2000-01-01") == set()
+
+    assert api_client.get("/api/samples/?fields=id,bogus").status_code == 400
+    assert api_client.get("/api/samples/?freeze_time_after=soon").status_code == 400
+
+
+@pytest.mark.django_db
+def test_sample_search_and_domain_facets(api_client, admin_client):
+    docs = make_sample(url="https://www.Example.com/docs/intro", notes="Login form")
+    blog = make_sample(url="https://blog.example.com/2021/post")
+    other = make_sample(url="http://other.org:8080/a?q=1")
+    assert (docs.domain, blog.domain, other.domain) == (
+        "example.com",
+        "blog.example.com",
+        "other.org",
+    )
+    # Rows written without Sample.save() are indexed by the trigger
+    Sample.objects.filter(pk=other.pk).update(notes="Checkout page")
+
+    def found(text):
+        return set(Sample.objects.search(text).values_list("id", flat=True))
+
+    assert found("example.com") == {docs.pk, blog.pk}
+    assert found("exam") == {docs.pk, blog.pk}
+    assert found("login") == {docs.pk}
+    assert found("checkout") == {other.pk}
+    assert found("docs intro") == {docs.pk}
+    assert found("docs post") == set()
+    assert found("  ") == {docs.pk, blog.pk, other.pk}
+
+    response = api_client.get("/api/samples/?q=example&fields=id")
+    assert {row["id"] for row in response.data["results"]} == {docs.pk, blog.pk}
+    response = api_client.get("/api/samples/?domain=other.org&fields=id")
+    assert [row["id"] for row in response.data["results"]] == [other.pk]
+    response = api_client.get("/api/samples/domains/?q=example")
+    assert response.data == [
+        {"domain": "blog.example.com", "count": 1},
+        {"domain": "example.com", "count": 1},
+    ]
+
+    content = admin_client.get("/samples?q=login").content.decode()
+    assert "/docs/intro" in content and "/2021/post" not in content
+    assert 'domain=example.com">example.com</a> (1)' in content
+    response = admin_client.get("/admin/samples/sample/?q=checkout")
+    assert list(response.context["cl"].result_list) == [other]
+
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_seqscan = off")
+        sql, params = (
+            Sample.objects.search("example").only("id").query.sql_with_params()
+        )
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+    assert "samples_sam_search__7ba8d3_gin" in plan
+
+
+def random_words(seed, words=300):
+    rng = random.Random(seed)
+    return [f"word{rng.randrange(2000)}" for _ in range(words)]
+
+
+def article(seed):
+    text = " ".join(random_words(seed))
+    return PAGE_BEGIN + f"<style>p {{ color: red }}</style><p>{text}</p>" + PAGE_END
+
+
+def test_minhash_estimates_similarity():
+    page = article(1)
+    variant = page.replace("<p>", "<p>Page 2 of 7 ").replace("red", "blue")
+    assert similarity(page_minhash(page), page_minhash(variant)) > 0.9
+    assert similarity(page_minhash(page), page_minhash(article(2))) < 0.1
+    # Pages without text are compared by their markup
+    assert page_minhash("<div><img></div>") != page_minhash("<table><tr></table>")
+
+
+@pytest.mark.parametrize(
+    "page",
+    [
+        article(1),
+        "<div><img></div>",
+        "<p>a few words</p>",
+        "<p>1 < 2</p><script>if (a<b) { x = '</p>' }</script><p>the rest of it</p>",
+        "<p>an unterminated</p><script>var words = 'one two three four five'",
+    ],
+)
+def test_minhash_of_pieces_is_minhash_of_page(page):
+    for size in [1, 7, 100]:
+        minhasher = MinHasher()
+        for start in range(0, len(page), size):
+            end = start + size
+            minhasher.update(page[start:end])
+        assert minhasher.minhash() == page_minhash(page)
+
+
+@pytest.mark.django_db
+def test_near_duplicate_clusters(api_client, admin_client, settings):
+    page = article(1)
+    first = make_sample(page)
+    unrelated = make_sample(article(2))
+    variant = make_sample(page.replace("<p>", "<p>Page 2 of 7 "))
+    # As if it was streamed to the blob store, indexed by the command
+    late = make_sample(page.replace("</p>", " Next page</p>"))
+    SampleSignature.objects.filter(pk=late.pk).delete()
+    call_command("index_near_duplicates", stdout=StringIO())
+
+    def clusters(*samples):
+        signatures = SampleSignature.objects.filter(sample__in=samples)
+        return dict(signatures.values_list("sample_id", "cluster"))
+
+    assert clusters(first, unrelated, variant, late) == {
+        first.pk: first.pk,
+        unrelated.pk: None,
+        variant.pk: first.pk,
+        late.pk: first.pk,
+    }
+
+    # A sample like two others that aren't alike merges them
+    words = random_words(3, words=500)
+
+    def passage(start, end):
+        return PAGE_BEGIN + "<p>" + " ".join(words[start:end]) + "</p>" + PAGE_END
+
+    settings.NEAR_DUPLICATE_THRESHOLD = 0.5
+    a = make_sample(passage(0, 300))
+    b = make_sample(passage(120, 420))
+    assert clusters(a, b) == {a.pk: None, b.pk: None}
+    c = make_sample(passage(60, 360))
+    assert clusters(a, b, c) == {a.pk: a.pk, b.pk: a.pk, c.pk: a.pk}
+    settings.NEAR_DUPLICATE_THRESHOLD = 0.8
+    call_command("index_near_duplicates", recluster=True, stdout=StringIO())
+    assert clusters(a, b, c) == {a.pk: None, b.pk: None, c.pk: None}
+    assert clusters(first)[first.pk] == first.pk
+
+    response = api_client.get("/api/samples/duplicates/")
+    assert response.data == [
+        {
+            "cluster": first.pk,
+            "size": 3,
+            "samples": [first.pk, variant.pk, late.pk],
+        }
+    ]
+    assert api_client.get(f"/api/samples/duplicates/?after={first.pk}").data == []
+    response = admin_client.get(f"/admin/samples/sample/?cluster={first.pk}")
+    assert len(response.context["cl"].result_list) == 3
+
+    # Batch uploads are indexed too
+    upload = page.replace(PAGE_BEGIN, SINGLEFILE_HEAD)
+    response = api_client.generic(
+        "POST",
+        "/api/add_sample/add_samples/",
+        json.dumps({"frozen_page": upload, "freeze_software": "SingleFile"}),
+        content_type="application/x-ndjson",
+    )
+    uploaded = response.data["samples"][0]["id"]
+    assert clusters(uploaded) == {uploaded: first.pk}
+
+    for sample in [first, unrelated, variant]:
+        LabeledSample.objects.create(original_sample=sample, fta_id_patches=[])
+    job = enqueue_export(LabeledSample.objects.all(), skip_duplicates=True)
+    assert set(job.items.values_list("labeled_sample__original_sample", flat=True)) == {
+        first.pk,
+        unrelated.pk,
+    }
+
+
+@pytest.mark.django_db
+def test_export_splits_are_stable_and_grouped(settings):
+    settings.EXPORT_SPLIT_GROUP = "domain"
+    for i in range(30):
+        make_labeled_sample(url=f"https://site{i % 10}.example/{i}")
+    job = enqueue_export(LabeledSample.objects.all(), train_pct=0.5, test_pct=0.3)
+    splits = {
+        item.labeled_sample_id: (item.split, item.labeled_sample.original_sample)
+        for item in job.items.select_related("labeled_sample__original_sample")
+    }
+    assert job.total == len(splits) == 30
+    # Worked out in SQL the same way as in Python
+    for split, sample in splits.values():
+        assert split == split_for_key(sample.domain, 0.5, 0.3)
+    sites_by_split = {}
+    for split, sample in splits.values():
+        sites_by_split.setdefault(split, set()).add(sample.domain)
+    assert len(sites_by_split) > 1
+    assert sum(len(sites) for sites in sites_by_split.values()) == 10
+
+    again = enqueue_export(LabeledSample.objects.all(), train_pct=0.5, test_pct=0.3)
+    assert {item.labeled_sample_id: item.split for item in again.items.all()} == {
+        pk: split for pk, (split, _) in splits.items()
+    }
+
+    with pytest.raises(RuntimeError):
+        enqueue_export(LabeledSample.objects.all(), train_pct=0.8, test_pct=0.3)
+
+
+@pytest.mark.django_db
+def test_incremental_export_reuses_unchanged_samples(settings, monkeypatch):
+    changed, renamed, removed, unchanged = [
+        make_labeled_sample(labels=[("f1", slug)])
+        for slug in ["email", "rename-me", "search", "search"]
+    ]
+    first = enqueue_export(LabeledSample.objects.all(), group_by="sample")
+    assert first.base is None
+    call_command("run_export_jobs", once=True, stdout=StringIO())
+
+    # Label changes bump the version, a save() of an older instance doesn't undo it
+    exported = dict(LabeledSample.objects.values_list("pk", "version"))
+    stale = LabeledSample.objects.get(pk=renamed.pk)
+    changed.set_labels({"f2": "search"})
+    Label.objects.filter(slug="rename-me").update(slug="renamed")
+    stale.save()
+    versions = dict(LabeledSample.objects.values_list("pk", "version"))
+    assert versions[changed.pk] > exported[changed.pk]
+    assert versions[renamed.pk] > exported[renamed.pk]
+    assert versions[unchanged.pk] == exported[unchanged.pk]
+    removed.original_sample.delete()
+    added = make_labeled_sample()
+
+    second = enqueue_export(LabeledSample.objects.all(), group_by="sample")
+    assert second.base == first
+    assert second.diff == {
+        "added": 1,
+        "changed": 2,
+        "unchanged": 1,
+        "removed": 1,
+        "moved": 0,
+    }
+    converted = []
+
+    def convert(page, fta_id_to_slug, *args, **kwargs):
+        converted.append(page)
+        return convert_page_to_fathom_sample(page, fta_id_to_slug, *args, **kwargs)
+
+    settings.EXPORT_WORKERS = 0
+    monkeypatch.setattr("fta.samples.exports.convert_page_to_fathom_sample", convert)
+    call_command("run_export_jobs", once=True, stdout=StringIO())
+    assert len(converted) == 3
+    assert set(
+        second.items.filter(reused_from=None).values_list("labeled_sample", flat=True)
+    ) == {changed.pk, renamed.pk, added.pk}
+
+    def manifest(job):
+        with open(os.path.join(settings.MEDIA_ROOT, job.folder, "manifest.json")) as f:
+            return json.load(f)
+
+    entries = {entry["labeled_sample"]: entry for entry in manifest(second)["samples"]}
+    assert manifest(second)["diff"] == second.diff
+    assert set(entries) == {changed.pk, renamed.pk, unchanged.pk, added.pk}
+    old_entry = next(
+        entry
+        for entry in manifest(first)["samples"]
+        if entry["labeled_sample"] == unchanged.pk
+    )
+    new_entry = entries[unchanged.pk]
+    assert new_entry["sha256"] == old_entry["sha256"]
+    assert new_entry["sample"] == unchanged.original_sample_id
+    assert new_entry["version"] == exported[unchanged.pk]
+    with open(os.path.join(settings.MEDIA_ROOT, new_entry["name"]), "rb") as f:
+        assert hashlib.sha256(f.read()).hexdigest() == new_entry["sha256"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("workers", [0, 2])
+@pytest.mark.parametrize("engine", ["beautifulsoup", "streaming"])
+def test_export_conversion_pool(settings, workers, engine):
+    settings.FATHOM_CONVERSION_ENGINE = engine
+    page = PAGE_BEGIN + WITH_FTA_ID + MULTIPLE_ELEMENTS_SAME_LABEL + PAGE_END
+    labeled = [
+        make_labeled_sample(
+            labels=[("aaa", "email"), ("1234", "search")][: i % 3], frozen_page=page
+        )
+        for i in range(7)
+    ]
+    job = enqueue_export(LabeledSample.objects.all(), incremental=False)
+    run_export_job(job, batch_size=3, workers=workers)
+    assert job.status == "done" and job.processed == 7
+    expected = {
+        labeled_sample.pk: convert_labeled_sample_to_fathom_sample(labeled_sample)[0]
+        for labeled_sample in labeled
+    }
+    for item in job.items.all():
+        with open(os.path.join(settings.MEDIA_ROOT, item.name), "rb") as f:
+            assert f.read() == expected[item.labeled_sample_id]
+
+
+@pytest.mark.django_db
+def test_replaced_fathom_artifacts_are_deleted_when_unused():
+    labeled_page = PAGE_BEGIN + NO_LABEL.replace("<input ", '<input data-fta_id="f1" ')
+    first, second = [
+        make_labeled_sample(frozen_page=PAGE_BEGIN + NO_LABEL + PAGE_END)
+        for _ in range(2)
+    ]
+    for labeled_sample in first, second:
+        labeled_sample.set_modified_sample(labeled_page + PAGE_END)
+        labeled_sample.save()
+        labeled_sample.set_labels({"f1": "email"})
+    store = ContentAddressedStore()
+    shared = build_fathom_artifact(first.pk).sha256
+    assert build_fathom_artifact(second.pk).sha256 == shared
+
+    first.set_labels({"f1": "search"})
+    relabeled = build_fathom_artifact(first.pk).sha256
+    assert relabeled != shared and store.exists(shared)
+    second.set_labels({"f1": "search"})
+    assert build_fathom_artifact(second.pk).sha256 == relabeled
+    assert not store.exists(shared) and store.exists(relabeled)
+
+    # A late build of an older version leaves nothing behind.
+    FathomArtifact.objects.filter(pk=first.pk).update(version=F("version") + 5)
+    first.set_labels({"f1": "address"})
+    converted, _ = convert_labeled_sample_to_fathom_sample(first)
+    assert build_fathom_artifact(first.pk).sha256 == relabeled
+    assert not store.exists(sha256_hexdigest(converted))
+    assert store.exists(relabeled)
+
+
+@pytest.mark.django_db
+def test_fathom_artifacts_are_rebuilt_and_copied_by_exports(settings, monkeypatch):
+    settings.EXPORT_WORKERS = 0
+    page = PAGE_BEGIN + WITH_FTA_ID + MULTIPLE_ELEMENTS_SAME_LABEL + PAGE_END
+    labeled = [
+        make_labeled_sample(labels=[("aaa", "email")][: i % 2], frozen_page=page)
+        for i in range(4)
+    ]
+    call_command("build_fathom_artifacts", stdout=StringIO())
+    assert not stale_labeled_samples().exists()
+    negative = labeled[0].fathom_artifact
+    assert negative.suffix == ".n.html"
+    assert ContentAddressedStore().read(negative.sha256) == (
+        convert_labeled_sample_to_fathom_sample(labeled[0])[0]
+    )
+
+    # New labels make the artifact stale, a late build of an older version
+    # doesn't overwrite a newer one.
+    labeled[1].set_labels({"1234": "search"})
+    assert list(stale_labeled_samples()) == [labeled[1]]
+    FathomArtifact.objects.filter(pk=labeled[2].pk).update(version=F("version") + 5)
+    version = FathomArtifact.objects.get(pk=labeled[2].pk).version
+    assert build_fathom_artifact(labeled[2].pk).version == version
+
+    # Only the ones without an artifact of the exported version are converted.
+    converted = []
+
+    def convert(*args, **kwargs):
+        converted.append(args)
+        return convert_page_to_fathom_sample(*args, **kwargs)
+
+    monkeypatch.setattr("fta.samples.exports.convert_page_to_fathom_sample", convert)
+    job = enqueue_export(LabeledSample.objects.all(), incremental=False)
+    run_export_job(job)
+    assert job.status == "done" and len(converted) == 2
+    for item in job.items.all():
+        labeled_sample = LabeledSample.objects.get(pk=item.labeled_sample_id)
+        expected, suffix = convert_labeled_sample_to_fathom_sample(labeled_sample)
+        assert item.name.endswith(suffix)
+        with open(os.path.join(settings.MEDIA_ROOT, item.name), "rb") as f:
+            assert f.read() == expected
+
+
+@pytest.mark.django_db
+def test_saving_labels_schedules_fathom_artifact(api_client, settings, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(
+        artifacts, "transaction", SimpleNamespace(on_commit=scheduled.append)
+    )
+    page = PAGE_BEGIN + SEARCH_FATHOM_LABEL + PAGE_END
+    api_client.post(
+        "/api/add_labeled_sample/add_labeled_sample/",
+        {"labeled_page": page, "freeze_software": "SingleFile"},
+    )
+    assert len(scheduled) == 1
+
+    settings.FATHOM_ARTIFACTS_ON_SAVE = False
+    api_client.post(
+        "/api/add_labeled_sample/add_labeled_sample/",
+        {"labeled_page": page, "freeze_software": "SingleFile"},
+    )
+    assert len(scheduled) == 1
+
+
+@pytest.mark.django_db
+def test_packed_export(settings):
+    settings.EXPORT_WORKERS = 0
+    page = PAGE_BEGIN + WITH_FTA_ID + MULTIPLE_ELEMENTS_SAME_LABEL + PAGE_END
+    labeled = [
+        make_labeled_sample(labels=[("aaa", "email")][: i % 2], frozen_page=page)
+        for i in range(6)
+    ]
+    expected = {
+        labeled_sample.pk: convert_labeled_sample_to_fathom_sample(labeled_sample)
+        for labeled_sample in labeled
+    }
+    # Everything in training, two files to a pack.
+    settings.EXPORT_PACK_SIZE = max(len(data) for data, _ in expected.values()) + 1
+    packed = enqueue_export(
+        LabeledSample.objects.all(), 1.0, 0.0, group_by="sample", format="packed"
+    )
+    run_export_job(packed, batch_size=4)
+    assert packed.status == "done" and packed.processed == 6
+
+    folder = os.path.join(settings.MEDIA_ROOT, packed.folder, "training")
+    assert len(glob.glob(os.path.join(folder, "*.pack"))) == 3
+    assert not glob.glob(os.path.join(folder, "*.html"))
+    found = {}
+    with SplitReader(folder) as reader:
+        for entry, data in reader.items():
+            assert reader[entry["id"]] == data
+            assert (
+                entry["sample"]
+                == LabeledSample.objects.get(pk=entry["id"]).original_sample_id
+            )
+            found[entry["id"]] = data, entry["name"]
+    assert found == {
+        pk: (data, f"{pk}{suffix}") for pk, (data, suffix) in expected.items()
+    }
+    item = packed.items.order_by("pk").last()
+    with PackReader(os.path.join(settings.MEDIA_ROOT, item.pack)) as reader:
+        assert len(reader) == 2 and item.labeled_sample_id in reader
+        assert reader[item.labeled_sample_id] == expected[item.labeled_sample_id][0]
+
+    # A regular export reads unchanged files out of the packs.
+    files = enqueue_export(LabeledSample.objects.all(), 1.0, 0.0, group_by="sample")
+    assert files.base == packed and files.diff["unchanged"] == 6
+    run_export_job(files)
+    for item in files.items.all():
+        assert item.pack == "" and item.reused_from_id is not None
+        with open(os.path.join(settings.MEDIA_ROOT, item.name), "rb") as f:
+            assert f.read() == expected[item.labeled_sample_id][0]
+
+
+@pytest.mark.django_db
+def test_export_corpus_filters_and_resumes(settings, monkeypatch, tmp_path):
+    settings.EXPORT_WORKERS = 0
+    emails = [
+        make_labeled_sample(labels=[("f1", "email")], freeze_software="SingleFile")
+        for _ in range(4)
+    ]
+    make_labeled_sample(labels=[("f1", "search")], freeze_software="SingleFile")
+    make_labeled_sample(labels=[("f1", "email")], freeze_software="Other")
+    converted = []
+
+    def convert(*args, **kwargs):
+        if len(converted) == 2:
+            raise RuntimeError("interrupted")
+        converted.append(args)
+        return convert_page_to_fathom_sample(*args, **kwargs)
+
+    monkeypatch.setattr("fta.samples.exports.convert_page_to_fathom_sample", convert)
+    options = dict(
+        label=["email"],
+        software=["SingleFile"],
+        train=1.0,
+        test=0.0,
+        output=str(tmp_path / "out"),
+        checkpoint=str(tmp_path / "export.json"),
+        batch_size=1,
+        stdout=StringIO(),
+        stderr=StringIO(),
+    )
+    with pytest.raises(CommandError, match="interrupted"):
+        call_command("export_corpus", **options)
+    with open(tmp_path / "export.json") as f:
+        state = json.load(f)
+    job = ExportJob.objects.get(pk=state["job"])
+    assert job.status == "failed" and job.processed == 2 and job.total == 4
+    assert job.location == str(tmp_path / "out")
+    assert state["timings"]["convert"] > 0
+
+    # Rerun with the same checkpoint, only the rest is converted.
+    converted.clear()
+    options["label"] = ["search"]
+    out = options["stdout"] = StringIO()
+    call_command("export_corpus", **options)
+    job.refresh_from_db()
+    assert job.status == "done" and len(converted) == 2
+    assert "Resuming export job" in out.getvalue() and "manifest:" in out.getvalue()
+    folder = tmp_path / "out" / job.folder / "training"
+    assert sorted(os.listdir(folder)) == sorted(f"{e.pk}.html" for e in emails)
+    assert (tmp_path / "out" / job.folder / "manifest.json").exists()
+
+
+@pytest.mark.django_db
+def test_cached_reads_are_invalidated_by_writes(admin_client, api_client, settings):
+    settings.SAMPLE_INGEST_WORKERS = 0
+    make_labeled_sample(labels=[("f1", "email")])
+    assert label_counts() == [("email", 1)]
+    assert label_counts() == [("email", 1)]
+    assert cache_stats()["label_counts"] == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+    labeled_sample = make_labeled_sample()
+    labeled_sample.set_labels({"f1": "search"})
+    assert label_counts() == [("email", 1), ("search", 1)]
+    assert set(label_ids()) == {"email", "search"}
+
+    samples = Sample.objects.all()
+    assert sample_count(samples, "all") == 2
+    # Bulk inserts don't send post_save
+    response = api_client.generic(
+        "POST",
+        "/api/add_sample/add_samples/",
+        json.dumps({"frozen_page": SINGLEFILE_HEAD + BODY, "freeze_software": "x"}),
+        content_type="application/x-ndjson",
+    )
+    assert response.status_code == 200
+    assert sample_count(samples, "all") == 3
+    labeled_sample.original_sample.delete()
+    assert sample_count(samples, "all") == 2
+    assert label_counts() == [("email", 1)]
+
+    # Only the first of two identical requests goes to the database for the
+    # label list, counts and facets.
+    def count_queries():
+        with CaptureQueriesContext(connection) as queries:
+            assert admin_client.get("/samples").status_code == 200
+        return len(queries.captured_queries)
+
+    assert count_queries() > count_queries()
+    out = StringIO()
+    call_command("cache_stats", stdout=out)
+    assert "sample_count" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_sample_table_pages_are_cached(admin_client):
+    samples = [make_sample(url=f"https://example.com/{i}") for i in range(30)]
+
+    def get(url):
+        with CaptureQueriesContext(connection) as queries:
+            response = admin_client.get(url)
+        assert response.status_code == 200
+        fetched = any(
+            'FROM "samples_sample"' in query["sql"] and "LIMIT" in query["sql"]
+            for query in queries.captured_queries
+        )
+        return fetched, response.content.decode()
+
+    fetched, first_page = get("/samples")
+    assert fetched and first_page.count("Edit Labels") == 25
+    assert get("/samples") == (False, first_page)
+    # Each page and sort order is its own entry.
+    fetched, second_page = get("/samples?page=2")
+    assert fetched and second_page != first_page
+    assert get("/samples?sort=-url")[0]
+
+    samples[0].notes = "now with notes"
+    samples[0].save()
+    pages = [get("/samples"), get("/samples?page=2")]
+    assert all(fetched for fetched, _ in pages)
+    assert any("now with notes" in content for _, content in pages)
+    assert cache_stats()["sample_table"]["hits"] == 1
+
+
+@pytest.mark.django_db
+def test_export_loads_pages_and_labels_per_batch(settings):
+    settings.EXPORT_WORKERS = 0
+    for i in range(6):
+        make_labeled_sample(labels=[("aaa", "email"), ("1234", "search")][: i % 3])
+    job = enqueue_export(LabeledSample.objects.all(), incremental=False)
+    with CaptureQueriesContext(connection) as queries:
+        run_export_job(job, batch_size=3)
+    assert job.status == "done" and job.processed == 6
+    # Once per batch, not per item.
+    reads = Counter(
+        query["sql"].split(" FROM ")[1].split()[0]
+        for query in queries.captured_queries
+        if query["sql"].startswith("SELECT")
+    )
+    assert reads['"samples_sample"'] == 0
+    assert reads['"samples_labeledsample"'] == 2
+    assert reads['"samples_labeledelement"'] == 2
+
+
+@pytest.mark.django_db
+def test_export_keeps_labels_of_samples_superseded_after_queueing(settings):
+    settings.EXPORT_WORKERS = 0
+    labeled_page = PAGE_BEGIN + NO_LABEL.replace("<input ", '<input data-fta_id="f1" ')
+    labeled = []
+    for _ in range(2):
+        labeled_sample = make_labeled_sample(
+            frozen_page=PAGE_BEGIN + NO_LABEL + PAGE_END
+        )
+        labeled_sample.set_modified_sample(labeled_page + PAGE_END)
+        labeled_sample.save()
+        labeled_sample.set_labels({"f1": "email"})
+        labeled.append(labeled_sample)
+    # The second one is converted again, its artifact's blob is gone.
+    ContentAddressedStore().delete(build_fathom_artifact(labeled[1].pk).sha256)
+    job = enqueue_export(LabeledSample.objects.all(), incremental=False)
+    for labeled_sample in labeled:
+        new_version = LabeledSample.objects.create(
+            original_sample=labeled_sample.original_sample, fta_id_patches=[]
+        )
+        LabeledSample.objects.filter(pk=labeled_sample.pk).update(
+            superseded_by=new_version
+        )
+
+    run_export_job(job)
+    assert job.status == "done" and job.processed == 2
+    for item in job.items.all():
+        assert item.name.endswith(f"{item.labeled_sample_id}.html")
+        with open(os.path.join(settings.MEDIA_ROOT, item.name)) as f:
+            assert 'data-fathom="email"' in f.read()
+
+
+@pytest.mark.django_db
+def test_export_corpus_rejects_unknown_labels():
+    with pytest.raises(CommandError, match="Unknown labels: nope"):
+        call_command("export_corpus", label=["nope"], stdout=StringIO())
+    assert not ExportJob.objects.exists()
+
+
+@pytest.mark.django_db
+def test_export_corpus_filters_by_freeze_date(settings, tmp_path):
+    settings.EXPORT_WORKERS = 0
+    settings.TIME_ZONE = "UTC"
+    inside = [
+        make_labeled_sample(freeze_time=timezone.make_aware(datetime(2021, 3, day)))
+        for day in [1, 2]
+    ]
+    for moment in [datetime(2021, 2, 28, 23, 59), datetime(2021, 3, 3)]:
+        make_labeled_sample(freeze_time=timezone.make_aware(moment))
+    with CaptureQueriesContext(connection) as queries:
+        call_command(
+            "export_corpus",
+            after=date(2021, 3, 1),
+            before=date(2021, 3, 3),
+            output=str(tmp_path),
+            stdout=StringIO(),
+        )
+    job = ExportJob.objects.get()
+    assert set(job.items.values_list("labeled_sample", flat=True)) == {
+        labeled_sample.pk for labeled_sample in inside
+    }
+    insert = next(q["sql"] for q in queries.captured_queries if "INSERT" in q["sql"])
+    assert "::date" not in insert
+
+
+@pytest.mark.django_db
+def test_export_splits_samples_without_domain_by_sample():
+    labeled = [make_labeled_sample(url="") for _ in range(30)]
+    assert {labeled_sample.original_sample.domain for labeled_sample in labeled} == {""}
+    job = enqueue_export(LabeledSample.objects.all(), group_by="domain")
+    splits = dict(job.items.values_list("labeled_sample__original_sample", "split"))
+    assert splits == {
+        labeled_sample.original_sample_id: split_for_key(
+            labeled_sample.original_sample_id, 0.6, 0.2
+        )
+        for labeled_sample in labeled
+    }
+    assert len(set(splits.values())) > 1
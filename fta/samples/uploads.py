@@ -0,0 +1,92 @@
+import codecs
+import hashlib
+import tempfile
+import zlib
+from contextlib import contextmanager
+from itertools import chain
+
+from .similarity import MinHasher
+
+GZIP_MAGIC = b"\x1f\x8b"
+DECOMPRESSED_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledPage:
+    def __init__(self, file, digest, size, head, minhash):
+        # Decompressed page bytes, rewound.
+        self.file = file
+        self.digest = digest
+        self.size = size
+        # The start of the page as text, for sniffing metadata.
+        self.head = head
+        # For SampleSignature, see similarity.py.
+        self.minhash = minhash
+
+    def read_text(self):
+        self.file.seek(0)
+        return self.file.read().decode("utf-8")
+
+
+def _gunzipped(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in chunks:
+        while data:
+            # Capped, a small chunk of a very repetitive page can inflate a lot.
+            yield decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE)
+            if decompressor.eof:
+                # gzip allows several members back to back
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("The gzip stream is truncated.")
+
+
+def _decompressed(chunks):
+    # Gzipped pages are recognized by their magic number, not their name.
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    chunks = chain([first], chunks)
+    if first.startswith(GZIP_MAGIC):
+        return _gunzipped(chunks)
+    return chunks
+
+
+@contextmanager
+def spooled_frozen_page(uploaded_file, head_chars):
+    """Streams an uploaded (optionally gzipped) page to a temporary file.
+
+    The SHA-256, byte size, MinHash signature and the first `head_chars`
+    characters are worked out on the way through, so only one chunk (and any
+    script it ends in) is in memory at a time. Raises ValueError if the page
+    isn't UTF-8 or not valid gzip.
+    """
+    hasher = hashlib.sha256()
+    minhasher = MinHasher()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    size = 0
+    head = []
+    head_len = 0
+    with tempfile.TemporaryFile() as file:
+        try:
+            for chunk in _decompressed(uploaded_file.chunks()):
+                hasher.update(chunk)
+                size += len(chunk)
+                file.write(chunk)
+                # Decode everything, to reject pages that couldn't be read back.
+                text = decoder.decode(chunk)
+                minhasher.update(text)
+                missing = head_chars - head_len
+                if missing > 0:
+                    head.append(text[:missing])
+                    head_len += len(head[-1])
+            minhasher.update(decoder.decode(b"", final=True))
+        except (UnicodeDecodeError, zlib.error) as e:
+            raise ValueError(str(e)) from e
+        file.seek(0)
+        yield SpooledPage(
+            file, hasher.hexdigest(), size, "".join(head), minhasher.minhash()
+        )
@@ -1,7 +1,14 @@
-import random
+import hashlib
+import re
+from collections import Counter
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
 from uuid import uuid4
 
 from bs4 import BeautifulSoup
+from django.conf import settings
+
+from . import rewriter
 
 suffixes = ["B", "KB", "MB", "GB", "TB", "PB"]
 
@@ -16,7 +23,91 @@ def humansize(nbytes):
     return "%s %s" % (f, suffixes[i])
 
 
+def url_domain(url):
+    # Host of a sample url, without "www.". Kept in step with the SQL that
+    # filled in Sample.domain for existing rows, see migration 0018.
+    try:
+        host = urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def search_terms(text):
+    # Words as the samples_sample_search_vector() SQL function splits them:
+    # runs of letters and digits, lower cased.
+    return re.findall(r"[^\W_]+", text.lower())
+
+
+class StopSniffing(Exception):
+    pass
+
+
+class FrozenMetadataSniffer(HTMLParser):
+    # Collects the markers freezers leave at the top of a page: the SingleFile
+    # comment, and freezedry's <link rel=original> and Memento-Datetime <meta>.
+    # Stops at the end of <head>.
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.singlefile_comment = None
+        self.original_url = None
+        self.memento_datetime = None
+        self.reached_body = False
+
+    def handle_comment(self, data):
+        if self.singlefile_comment is None and data.strip().startswith(
+            "Page saved with SingleFile"
+        ):
+            self.singlefile_comment = data
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "body":
+            self.stop()
+        elif tag == "link" and "original" in (attrs.get("rel") or "").split():
+            self.original_url = self.original_url or attrs.get("href")
+        elif tag == "meta" and attrs.get("http-equiv") == "Memento-Datetime":
+            self.memento_datetime = self.memento_datetime or attrs.get("content")
+
+    def handle_endtag(self, tag):
+        if tag == "head":
+            self.stop()
+
+    def stop(self):
+        self.reached_body = True
+        raise StopSniffing()
+
+    def found_markers(self):
+        return any([self.singlefile_comment, self.original_url, self.memento_datetime])
+
+
+def sniff_frozen_metadata(page, limit=None):
+    # Reads at most `limit` characters of `page`, stopping early at the end of
+    # <head>. Returns the sniffer and whether its findings can be trusted,
+    # i.e. whether more of the page could still hold a marker.
+    sniffer = FrozenMetadataSniffer()
+    prefix = page if limit is None or len(page) <= limit else page[:limit]
+    try:
+        sniffer.feed(prefix)
+        sniffer.close()
+    except StopSniffing:
+        pass
+    conclusive = (
+        sniffer.found_markers() or sniffer.reached_body or len(prefix) == len(page)
+    )
+    return sniffer, conclusive
+
+
+def use_streaming_rewriter():
+    # See FATHOM_CONVERSION_ENGINE in settings, and rewriter.py.
+    return settings.FATHOM_CONVERSION_ENGINE == "streaming"
+
+
 def convert_fathom_sample_to_labeled_sample(fathom_sample, suffix=".html"):
+    if use_streaming_rewriter():
+        return rewriter.convert_fathom_sample_to_labeled_sample(fathom_sample)
+
     soup = BeautifulSoup(fathom_sample, features="html.parser")
 
     # remove any existing data-fta_id attrs first
@@ -40,46 +131,128 @@ def convert_fathom_sample_to_labeled_sample(fathom_sample, suffix=".html"):
 
 
 def convert_labeled_sample_to_fathom_sample(labeled_sample, suffix=".html"):
-    soup = BeautifulSoup(labeled_sample.modified_sample, features="html.parser")
-    labels = labeled_sample.labeled_elements.all()
-    if len(labels) == 0:
+    fta_id_to_slug = {
+        label.data_fta_id: label.label.slug
+        for label in labeled_sample.labeled_elements.all()
+    }
+    return convert_page_to_fathom_sample(
+        labeled_sample.materialized_sample, fta_id_to_slug, suffix=suffix
+    )
+
+
+def convert_page_to_fathom_sample(
+    labeled_page, fta_id_to_slug, streaming=None, suffix=".html"
+):
+    # Only needs the page and labels, so it can run in another process. Pass
+    # `streaming` there, settings overridden at runtime don't follow.
+    if streaming is None:
+        streaming = use_streaming_rewriter()
+    if len(fta_id_to_slug) == 0:
         # Fathom looks for a `.n` suffix for negative examples
         suffix = f".n{suffix}"
-    else:
-        for label in labels:
-            tagged_elements = soup.find_all(attrs={"data-fta_id": label.data_fta_id})
-            for element in tagged_elements:
-                element.attrs["data-fathom"] = label.label.slug
+    if streaming:
+        fathom_sample = rewriter.convert_labeled_sample_to_fathom_sample(
+            labeled_page, fta_id_to_slug
+        )
+        return fathom_sample.encode("utf-8"), suffix
+
+    soup = BeautifulSoup(labeled_page, features="html.parser")
+    for fta_id, slug in fta_id_to_slug.items():
+        tagged_elements = soup.find_all(attrs={"data-fta_id": fta_id})
+        for element in tagged_elements:
+            element.attrs["data-fathom"] = slug
     return soup.encode("utf-8"), suffix
 
 
-def get_splits_from_queryset(qs, train_pct, test_pct):
-    # Returns train/test/validation splits from a queryset.
-    # Validation set is the remaining once train and test are picked.
-    # If train_pct and test_pct add to 100%, validation may still have 1
-    # item in it.
-    #
-    # This isn't perfect, it'll do for now.
-    #
-    # If you have too few samples, this is going to get wierd
+def compute_fta_id_patches(original_page, modified_page):
+    # Describes `modified_page` as the data-fta_id attributes to set on
+    # `original_page`. Elements are addressed by tag name and their position
+    # among the tags of that name, which survives the browser re-serializing
+    # the page (implied tbody etc). Returns None when the modified page can't
+    # be expressed that way and has to be stored in full, including when
+    # anything but the data-fta_id attributes changed.
+    if use_streaming_rewriter():
+        return rewriter.compute_fta_id_patches(original_page, modified_page)
+
+    modified_soup = BeautifulSoup(modified_page, features="html.parser")
+    modified_counts = Counter()
+    modified_attrs = {}
+    patches = []
+    for element in modified_soup.find_all():
+        if "data-fathom" in element.attrs:
+            return None
+        position = modified_counts[element.name]
+        if "data-fta_id" in element.attrs:
+            patches.append([element.name, position, element.attrs["data-fta_id"]])
+        modified_attrs[element.name, position] = rewriter.unlabeled_attrs(element.attrs)
+        modified_counts[element.name] += 1
+
+    original_soup = BeautifulSoup(original_page, features="html.parser")
+    original_counts = Counter()
+    original_attrs = {}
+    for element in original_soup.find_all():
+        position = original_counts[element.name]
+        original_attrs[element.name, position] = rewriter.unlabeled_attrs(element.attrs)
+        original_counts[element.name] += 1
+    for tag in {tag for tag, _, _ in patches}:
+        if original_counts[tag] != modified_counts[tag]:
+            return None
+    if not rewriter.same_attrs(
+        original_counts, original_attrs, modified_counts, modified_attrs
+    ):
+        return None
+    return patches
+
+
+def apply_fta_id_patches(original_page, patches):
+    # Inverse of compute_fta_id_patches. Any labeling attributes already in
+    # the original page are dropped, only the patched ids remain.
+    if use_streaming_rewriter():
+        return rewriter.apply_fta_id_patches(original_page, patches)
+
+    soup = BeautifulSoup(original_page, features="html.parser")
+    fta_ids = {(tag, position): fta_id for tag, position, fta_id in patches}
+    counts = Counter()
+    for element in soup.find_all():
+        element.attrs.pop("data-fta_id", None)
+        element.attrs.pop("data-fathom", None)
+        fta_id = fta_ids.get((element.name, counts[element.name]))
+        if fta_id is not None:
+            element.attrs["data-fta_id"] = fta_id
+        counts[element.name] += 1
+    return str(soup)
+
+
+SPLITS = ("training", "testing", "validation")
+# Split buckets are the first 32 bits of the MD5 of a sample's grouping key.
+SPLIT_BUCKETS = 2**32
+
+
+def split_thresholds(train_pct, test_pct):
+    # Buckets below the first threshold are for training, below the second
+    # for testing, the rest for validation.
     if train_pct + test_pct > 1.0:
         raise RuntimeError(
             f"train_pct ({train_pct}) + test_pct ({test_pct}) must sum to less than 1.0."
         )
-    n = qs.count()
-    n_train = round(train_pct * n)
-    n_test = round(test_pct * n)
-
-    # Warning: this has the potential to get inefficient, but should be fine while we're
-    # only doing modest samples.
-    qs_set = set(qs)
-    train_set = set(random.sample(qs_set, n_train))
-    remaining = qs_set - train_set
-    test_set = set(random.sample(remaining, n_test))
-    validation_set = remaining - test_set
-
-    return {
-        "training": train_set,
-        "testing": test_set,
-        "validation": validation_set,
-    }
+    return round(train_pct * SPLIT_BUCKETS), round(
+        (train_pct + test_pct) * SPLIT_BUCKETS
+    )
+
+
+def split_bucket(key):
+    # Same as exports.SplitBucket, which does this in SQL.
+    return int(hashlib.md5(str(key).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def split_for_key(key, train_pct, test_pct):
+    """The split samples with grouping key `key` go to.
+
+    Always the same for a key, and each key's samples all go to the same one,
+    so splits are only roughly the requested sizes when there are few keys.
+    """
+    bucket = split_bucket(key)
+    for split, threshold in zip(SPLITS, split_thresholds(train_pct, test_pct)):
+        if bucket < threshold:
+            return split
+    return SPLITS[-1]
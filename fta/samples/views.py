@@ -1,18 +1,40 @@
 import json
 from datetime import datetime
 
-from bs4 import BeautifulSoup
 from dateutil.parser import parse
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import Http404
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import redirect, render, reverse
-from django.utils.encoding import smart_str
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
+from django.utils.http import parse_etags, quote_etag
+from django.views import View
+from django.views.decorators.clickjacking import xframe_options_sameorigin
 from django.views.generic.edit import FormView
 from django_tables2 import SingleTableView
 
+from .artifacts import schedule_fathom_artifact
+from .blobs import ContentAddressedStore, sha256_hexdigest
+from .caching import domain_facets, label_counts, label_ids, sample_count, sample_table
 from .forms import SampleLabelForm, UploadSampleForm
-from .models import Label, LabeledElement, LabeledSample, Sample
+from .models import LabeledElement, LabeledSample, Sample
 from .tables import SampleTable
+from .uploads import spooled_frozen_page
+from .utils import sniff_frozen_metadata
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator taking the number of objects from `count`, a callable."""
+
+    def __init__(self, object_list, per_page, *args, count, **kwargs):
+        super().__init__(object_list, per_page, *args, **kwargs)
+        self._count = count
+
+    @cached_property
+    def count(self):
+        return self._count()
 
 
 class SampleListView(LoginRequiredMixin, SingleTableView):
@@ -22,20 +44,47 @@ class SampleListView(LoginRequiredMixin, SingleTableView):
 
     def get_queryset(self, *args, **kwargs):
         requested_label = self.request.GET.get("label", None)
-        all_samples = Sample.objects.get_queryset()
+        all_samples = Sample.objects.slim().with_label_stats()
 
         if requested_label == "-":
-            filtered_qs = all_samples.filter(nlabels__exact=0)
+            filtered_qs = all_samples.filter(label_summary__nlabels=0)
         else:
-            try:
-                requested_label = Label.objects.get(slug=requested_label)
+            requested_label_id = label_ids().get(requested_label)
+            if requested_label_id is not None:
                 filtered_qs = all_samples.filter(
-                    labeled_sample__labeled_elements__label=requested_label
-                ).distinct()
-            except Label.DoesNotExist:
+                    label_summary__label_ids__contains=[requested_label_id]
+                )
+            else:
                 # Default to all
                 filtered_qs = all_samples
-        return filtered_qs
+        if self.request.GET.get("domain"):
+            filtered_qs = filtered_qs.filter(domain=self.request.GET["domain"])
+        return filtered_qs.search(self.request.GET.get("q", ""))
+
+    def filters(self):
+        # What the cached counts of this list depend on, besides the data.
+        return tuple(
+            self.request.GET.get(name, "") for name in ["label", "domain", "q"]
+        )
+
+    def get_table_pagination(self, table):
+        queryset = self.object_list
+        return {
+            "paginator_class": CachedCountPaginator,
+            "count": lambda: sample_count(queryset, *self.filters()),
+        }
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["domain_facets"] = domain_facets(self.object_list, *self.filters())
+        context["label_counts"] = label_counts()
+        # The page of samples is only fetched when the table is rendered. Its
+        # links keep the rest of the query string, so all of it is the key.
+        table = context["table"]
+        context["table_html"] = sample_table(
+            lambda: table.as_html(self.request), sorted(self.request.GET.lists())
+        )
+        return context
 
 
 class SampleLabelView(LoginRequiredMixin, FormView):
@@ -52,13 +101,14 @@ class SampleLabelView(LoginRequiredMixin, FormView):
     def dispatch(self, request, *args, **kwargs):
         requested_sample_id = kwargs["sample"]
         try:
-            sample = Sample.objects.get(pk=requested_sample_id)
-            self.sample, created = LabeledSample.objects.get_or_create(
-                original_sample=sample
-            )
-            if created:
-                self.sample.modified_sample = sample.frozen_page
-                self.sample.save()
+            sample = Sample.objects.slim().get(pk=requested_sample_id)
+            # A new labeled sample starts out as the original page with no
+            # patches, there is no need to copy the page.
+            # The page itself is loaded by the iframe, see SampleDocumentView.
+            self.sample, created = LabeledSample.objects.defer(
+                "modified_sample"
+            ).get_or_create(original_sample=sample, defaults={"fta_id_patches": []})
+            self.sample.original_sample = sample
             return super().dispatch(request, *args, **kwargs)
         except Sample.DoesNotExist:
             raise Http404(f"Sample does not exist with ID {requested_sample_id}")
@@ -78,71 +128,144 @@ class SampleLabelView(LoginRequiredMixin, FormView):
     def post(self, request, *args, **kwargs):
         # We're willy nilly saving user input into database
         # This is only okay while all this is behind a managed login.
-        self.sample.modified_sample = request.POST.get("updated-sample", "")
+        self.sample.set_modified_sample(request.POST.get("updated-sample", ""))
         self.sample.save()
         label_data_list = json.loads(request.POST.get("label-data", "[]"))
-        for label_data in label_data_list:
-            label, _ = Label.objects.get_or_create(slug=label_data["label"])
-            # Make sure that the label overrides the old one.
-            try:
-                element = LabeledElement.objects.get(
-                    labeled_sample=self.sample,
-                    data_fta_id=label_data["fta_id"],
-                )
-            except LabeledElement.DoesNotExist:
-                element = LabeledElement(
-                    labeled_sample=self.sample,
-                    data_fta_id=label_data["fta_id"],
-                )
-            element.label = label
-            element.save()
+        # Later entries for the same element win, as they were applied last.
+        self.sample.set_labels(
+            {
+                label_data["fta_id"]: label_data["label"]
+                for label_data in label_data_list
+            }
+        )
+        schedule_fathom_artifact(self.sample)
         return super().post(request, *args, **kwargs)
 
 
-def get_frozen_metadata(page, freeze_software):
-    # Defaults
-    url = ""
-    freeze_time = datetime.now()
+@method_decorator(xframe_options_sameorigin, name="dispatch")
+class SampleDocumentView(LoginRequiredMixin, View):
+    """The page being labeled, as loaded into the labeling iframe."""
+
+    chunk_size = 64 * 1024
+
+    def get(self, request, *args, **kwargs):
+        labeled_sample = (
+            LabeledSample._base_manager.filter(
+                original_sample=kwargs["sample"], superseded_by=None
+            )
+            .select_related("original_sample")
+            .defer("modified_sample", "original_sample__frozen_page")
+            .order_by("-pk")
+            .first()
+        )
+        if labeled_sample is None:
+            raise Http404(f"Sample has not been labeled with ID {kwargs['sample']}")
+        etag = self.get_etag(labeled_sample)
+        page = None
+        if etag is None:
+            page = labeled_sample.materialized_sample
+            etag = quote_etag(sha256_hexdigest(page.encode("utf-8")))
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponseNotModified()
+        else:
+            if page is None:
+                page = labeled_sample.materialized_sample
+            response = StreamingHttpResponse(
+                self.iter_chunks(page), content_type="text/html; charset=utf-8"
+            )
+        response["ETag"] = etag
+        # Labels can be saved at any time, always check.
+        response["Cache-Control"] = "private, no-cache"
+        # Same as the meta tag of the labeling page, for what is framed in it.
+        response["Content-Security-Policy"] = "child-src 'self'"
+        return response
+
+    def iter_chunks(self, page):
+        for start in range(0, len(page), self.chunk_size):
+            end = start + self.chunk_size
+            yield page[start:end].encode("utf-8")
+
+    def get_etag(self, labeled_sample):
+        # Pages stored as patches can be identified without building them.
+        # The engine applying the patches is part of it, the engines don't
+        # serialize pages the same way.
+        digest = labeled_sample.original_sample.frozen_page_sha256
+        if labeled_sample.fta_id_patches is None or digest is None:
+            return None
+        version = json.dumps(
+            [digest, labeled_sample.fta_id_patches, settings.FATHOM_CONVERSION_ENGINE]
+        )
+        return quote_etag(sha256_hexdigest(version.encode("utf-8")))
+
+
+def singlefile_metadata(head):
+    comment = head.singlefile_comment
+    if comment is None:
+        return None
+    pieces = comment.strip().split("\n")
+    assert pieces[0].startswith("Page saved with SingleFile")
+    assert len(pieces) == 3 or len(pieces) == 5
+    url = pieces[1].split("url:")[1].strip()
+    raw_time = pieces[2].split("date:")[1].strip().split("(")[0]
+    freeze_time = parse(raw_time)
     page_width = None
     page_height = None
-    try:
-        if freeze_software == "SingleFile":
-            soup = BeautifulSoup(page, features="html.parser")
-            singlefile_comment = soup.html.contents[0]
-            pieces = singlefile_comment.strip().split("\n")
-            assert pieces[0].startswith("Page saved with SingleFile")
-            assert len(pieces) == 3 or len(pieces) == 5
-            url = pieces[1].split("url:")[1].strip()
-            raw_time = pieces[2].split("date:")[1].strip().split("(")[0]
-            freeze_time = parse(raw_time)
-            if len(pieces) == 5:
-                page_width = int(pieces[3].split("window width:")[1])
-                page_height = int(pieces[4].split("window height:")[1])
-        elif freeze_software == "freezedry":
-            soup = BeautifulSoup(page, features="html.parser")
-            freezedry_link = soup.find("link", rel="original")
-            freezedry_datetime = soup.find(
-                "meta",
-                attrs={
-                    "http-equiv": "Memento-Datetime",
-                },
-            )
-            if freezedry_link:
-                url = freezedry_link["href"]
-            if freezedry_datetime:
-                freeze_time = parse(freezedry_datetime["content"])
-    except:  # noqa
-        # It's okay if it fails. It just means freeze_software declaration
-        # was probably wrong, so set to unknown.
-        freeze_software = "Unknown"
-    return url, freeze_time, freeze_software, page_width, page_height
-
-
-def sample_from_required(frozen_page, freeze_software, notes):
+    if len(pieces) == 5:
+        page_width = int(pieces[3].split("window width:")[1])
+        page_height = int(pieces[4].split("window height:")[1])
+    return url, freeze_time, page_width, page_height
+
+
+def freezedry_metadata(head):
+    if head.original_url is None and head.memento_datetime is None:
+        return None
+    url = head.original_url or ""
+    freeze_time = datetime.now()
+    if head.memento_datetime:
+        freeze_time = parse(head.memento_datetime)
+    return url, freeze_time, None, None
+
+
+FREEZE_SOFTWARE_METADATA = {
+    "SingleFile": singlefile_metadata,
+    "freezedry": freezedry_metadata,
+}
+
+
+def get_frozen_metadata(page, freeze_software):
+    # Only the top of the page is read, the markers we look for come before
+    # the body. The whole page is only scanned when that's inconclusive.
+    head, conclusive = sniff_frozen_metadata(
+        page, limit=settings.FROZEN_METADATA_SNIFF_LIMIT
+    )
+    if not conclusive:
+        head, _ = sniff_frozen_metadata(page)
+
+    # Try what we were told first, then whatever else we can recognize.
+    for software in [freeze_software, *FREEZE_SOFTWARE_METADATA]:
+        metadata_parser = FREEZE_SOFTWARE_METADATA.get(software)
+        if metadata_parser is None:
+            continue
+        try:
+            metadata = metadata_parser(head)
+        except:  # noqa
+            # It's okay if it fails. It just means freeze_software declaration
+            # was probably wrong, try the next one.
+            continue
+        if metadata is not None:
+            url, freeze_time, page_width, page_height = metadata
+            return url, freeze_time, software, page_width, page_height
+    return "", datetime.now(), "Unknown", None, None
+
+
+def sample_from_required(frozen_page, freeze_software, notes, head=None, **fields):
+    # `head` is the start of the page, to read metadata from when the page
+    # itself isn't at hand. Any other Sample fields can be passed through.
     url, freeze_time, freeze_software, page_width, page_height = get_frozen_metadata(
-        frozen_page, freeze_software
+        frozen_page if head is None else head, freeze_software
     )
     return Sample(
+        **fields,
         frozen_page=frozen_page,
         url=url,
         freeze_time=freeze_time,
@@ -162,10 +285,35 @@ class UploadSampleView(LoginRequiredMixin, FormView):
         form = self.form_class(request.POST, request.FILES)
         if form.is_valid():
             data = form.cleaned_data
-            frozen_page = smart_str(data["frozen_page"].read())
-            freeze_software = data["freeze_software"]
-            sample = sample_from_required(frozen_page, freeze_software, data["notes"])
-            sample.save()
-            return redirect("list_samples")
-        else:
-            return render(request, self.template_name, {"form": form})
+            try:
+                sample = self.sample_from_upload(
+                    data["frozen_page"], data["freeze_software"], data["notes"]
+                )
+            except ValueError as e:
+                form.add_error("frozen_page", f"Couldn't read the page: {e}")
+            else:
+                sample.save()
+                return redirect("list_samples")
+        return render(request, self.template_name, {"form": form})
+
+    def sample_from_upload(self, uploaded_file, freeze_software, notes):
+        # The upload is streamed through once. With blob storage it goes
+        # straight to the store and is never held in memory as a whole.
+        with spooled_frozen_page(
+            uploaded_file, settings.FROZEN_METADATA_SNIFF_LIMIT
+        ) as page:
+            if settings.FROZEN_PAGE_STORAGE == "blob":
+                ContentAddressedStore().put_file(page.file, page.digest)
+                sample = sample_from_required(
+                    "",
+                    freeze_software,
+                    notes,
+                    head=page.head,
+                    frozen_page_sha256=page.digest,
+                    page_size=page.size,
+                )
+            else:
+                sample = sample_from_required(page.read_text(), freeze_software, notes)
+        # Picked up by index_new_sample, so the page isn't read back for it.
+        sample.minhash = page.minhash
+        return sample
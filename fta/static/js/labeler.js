@@ -223,6 +223,14 @@ function createOverlaysForPreExistingLabels({
 // This code is extremely hacky with timeouts and intervals, but it's the only
 // way to make it reliable against all possible timings.
 function callWhenLoaded(iframe, callback) {
+    // An iframe loading its src shows about:blank until the page arrives, wait
+    // for the page rather than picking in the placeholder.
+    if (iframe.contentDocument !== null && iframe.contentDocument.URL === "about:blank") {
+        iframe.addEventListener("load", function() {
+            callback()
+        }, {once: true});
+        return;
+    }
     // IFrame has a document
     if (iframe.contentDocument !== null) {
         // ...but body is still null, loading
@@ -1,5 +1,6 @@
 from django.conf import settings as django_settings
 from storages.backends.gcloud import GoogleCloudStorage
+from storages.utils import clean_name
 
 
 class StaticRootGoogleCloudStorage(GoogleCloudStorage):
@@ -11,3 +12,8 @@ class StaticRootGoogleCloudStorage(GoogleCloudStorage):
 class MediaRootGoogleCloudStorage(GoogleCloudStorage):
     file_overwrite = True
     bucket_name = django_settings.GS_MEDIA_BUCKET_NAME
+
+    def copy(self, source, name):
+        # Copied within the bucket, without downloading it.
+        blob = self.bucket.blob(self._normalize_name(clean_name(source)))
+        self.bucket.copy_blob(blob, self.bucket, self._normalize_name(clean_name(name)))